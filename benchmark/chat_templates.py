@@ -0,0 +1,55 @@
+import timeit
+
+from vojaybot.handler.chat import create_chat_handlers
+from vojaybot.router import CommandRouter
+from vojaybot.template import ResponseTemplate
+
+TEMPLATES = {
+    'static': 'Follow the stream to get notified when it starts',
+    'user': 'Hi {user}',
+    'user and count': 'Hug number {count} goes to {user}',
+    'all placeholders': '{user} hugs {args[0]} in {channel}, that is hug number {count:,} ({args})',
+}
+
+COMMAND_COUNT = 500
+
+
+if __name__ == '__main__':
+    print('rendering a response')
+
+    args = ['vojay', 'again']
+
+    for name, text in TEMPLATES.items():
+        number = 1_000_000
+        template = ResponseTemplate(text)
+
+        formatted = timeit.timeit(
+            lambda: text.format(user='viewer', channel='vojay', args=args, count=1234), number=number
+        ) / number * 1e9
+        rendered = timeit.timeit(lambda: template.render('viewer', 'vojay', args, 1234), number=number) / number * 1e9
+
+        print(f'{name:<20} str.format {formatted:>7.1f} ns   ResponseTemplate {rendered:>7.1f} ns')
+
+    # A reload parses all commands, compiles the templates which changed and swaps the routing table
+    commands = {
+        f'command{i}': {'aliases': [f'alias{i}'], 'response': f'{TEMPLATES["all placeholders"]} {i}'}
+        for i in range(COMMAND_COUNT)
+    }
+
+    router = CommandRouter()
+    old = []
+
+    def reload():
+        global old
+
+        created = create_chat_handlers(commands)
+        router.replace(old, created)
+        old = [handler for _, handler, _ in created]
+
+    compiled = timeit.timeit(reload, number=1) * 1e3
+
+    number = 20
+    reloaded = timeit.timeit(reload, number=number) / number * 1e3
+
+    print(f'loading {COMMAND_COUNT} commands with {COMMAND_COUNT} aliases: {compiled:.1f} ms, reloading them '
+          f'unchanged: {reloaded:.1f} ms')
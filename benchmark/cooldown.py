@@ -0,0 +1,32 @@
+import timeit
+
+from vojaybot.cooldown import Cooldown, CooldownTracker
+
+USER_COUNT = 10_000
+
+
+if __name__ == '__main__':
+    tracker = CooldownTracker('light', Cooldown(user=30, channel=5, everyone=1), max_entries=USER_COUNT)
+    tracker.acquire('viewer', 'vojay')
+
+    number = 1_000_000
+    baseline = timeit.timeit(lambda: None, number=number) / number * 1e9
+    rejected = timeit.timeit(lambda: tracker.acquire('viewer', 'vojay'), number=number) / number * 1e9 - baseline
+
+    print(f'command on cooldown  {rejected:>7.1f} ns')
+
+    # Every command of another user passes the user cooldown, only the channel and global cooldowns are disabled
+    tracker = CooldownTracker('light', Cooldown(user=30), max_entries=USER_COUNT)
+    users = [f'viewer{i}' for i in range(USER_COUNT * 10)]
+    now = 0.0
+
+    def accept():
+        global now
+
+        for user in users:
+            now += 0.001
+            tracker.acquire(user, 'vojay', now)
+
+    accepted = timeit.timeit(accept, number=1) / len(users) * 1e9
+
+    print(f'accepted command     {accepted:>7.1f} ns ({len(users):,} users, at most {USER_COUNT:,} tracked)')
@@ -0,0 +1,122 @@
+import json
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+POINTS_PATTERN = re.compile(r'^/kappa/v2/points/(?P<channel>[^/]+)/(?P<user>[^/]+)(?:/(?P<delta>-?\d+))?$')
+BULK_POINTS_PATTERN = re.compile(r'^/kappa/v2/points/(?P<channel>[^/]+)$')
+
+
+class FakeStreamElementsServer:
+    """
+    Minimal local stand-in for the StreamElements points API, used to benchmark StreamElementsClient without network
+    latency or rate limits. Failures can be injected with fail_next to exercise retries, latency delays every
+    response to simulate the real API.
+    """
+
+    def __init__(self, port: int = 0, default_points: int = 1000, latency: float = 0.0):
+        self.points: Dict[str, int] = {}
+        self.default_points = default_points
+        self.latency = latency
+        self.request_count = 0
+
+        # (status, retry_after) responses returned before handling requests normally again
+        self._failures: List[Tuple[int, Optional[float]]] = []
+        self._lock = threading.Lock()
+
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            # Required for keep-alive connections
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+
+                # Headers and body are written separately, without TCP_NODELAY keep-alive requests would wait for
+                # delayed ACKs
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, body=None, headers=None):
+                data = json.dumps(body or {}).encode('UTF-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length)) if length else None
+
+                if server.latency:
+                    time.sleep(server.latency)
+
+                status, response, headers = server.handle(self.command, self.path, body)
+                self._respond(status, response, headers)
+
+            do_GET = _handle
+            do_PUT = _handle
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_uri(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/kappa/v2'
+
+    def fail_next(self, status: int, count: int = 1, retry_after: Optional[float] = None):
+        with self._lock:
+            self._failures.extend([(status, retry_after)] * count)
+
+    def handle(self, method, path, body):
+        with self._lock:
+            self.request_count += 1
+
+            if self._failures:
+                status, retry_after = self._failures.pop(0)
+                headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+
+                return status, {'error': 'injected failure'}, headers
+
+            if match := POINTS_PATTERN.match(path):
+                channel, user, delta = match['channel'], match['user'], match['delta']
+                points = self.points.setdefault(user, self.default_points)
+
+                if method == 'GET' and delta is None:
+                    return 200, {'channel': channel, 'username': user, 'points': points}, None
+
+                if method == 'PUT' and delta is not None:
+                    self.points[user] = points + int(delta)
+                    return 200, {'channel': channel, 'username': user, 'amount': int(delta),
+                                 'newAmount': self.points[user]}, None
+
+            if method == 'PUT' and (match := BULK_POINTS_PATTERN.match(path)):
+                for user in body['users']:
+                    points = self.points.setdefault(user['username'], self.default_points)
+                    self.points[user['username']] = points + user['current'] if body['mode'] == 'add' \
+                        else user['current']
+
+                return 200, {'channel': match['channel'], 'mode': body['mode'], 'users': body['users']}, None
+
+            return 404, {'error': 'not found'}, None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,215 @@
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from vojaybot.connection import IrcServer
+from vojaybot.irc import IrcLineReader, parse_message
+
+
+def create_self_signed_certificate(directory: str) -> Tuple[str, str]:
+    """
+    Create a throwaway certificate for 127.0.0.1 with the openssl command line tool.
+
+    :return: Paths of certificate and key
+    """
+    certificate = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-keyout', key, '-out', certificate,
+            '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'
+        ],
+        check=True,
+        capture_output=True
+    )
+
+    return certificate, key
+
+
+class _Client:
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.nick: Optional[str] = None
+        self.channels: List[str] = []
+
+        # Lines are sent by the client thread (e.g. PONG) and by FakeTwitchServer.send
+        self._lock = threading.Lock()
+
+    def send(self, data: bytes):
+        with self._lock:
+            self.sock.sendall(data)
+
+
+class FakeTwitchServer:
+    """
+    Minimal local stand-in for Twitch IRC, used to load test the bot without Twitch. It answers the login with the
+    welcome message, acknowledges JOINs and PINGs and hands every PRIVMSG sent by the bot to on_privmsg together with
+    the time it was received. Chat traffic is replayed to the clients which joined a channel with send.
+
+    With tls=True the server uses a self-signed certificate, point the bot at it with server.irc_server, which trusts
+    that certificate.
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        tls: bool = False,
+        on_privmsg: Optional[Callable[[str, str, float], None]] = None
+    ):
+        self._on_privmsg = on_privmsg
+        self._clients: List[_Client] = []
+        self._joined = threading.Condition()
+        self._stopped = False
+
+        self._server_context: Optional[ssl.SSLContext] = None
+        self._client_context: Optional[ssl.SSLContext] = None
+
+        if tls:
+            with tempfile.TemporaryDirectory() as directory:
+                certificate, key = create_self_signed_certificate(directory)
+
+                self._server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                self._server_context.load_cert_chain(certificate, key)
+                self._client_context = ssl.create_default_context(cafile=certificate)
+
+        self._sock = socket.create_server(('127.0.0.1', port))
+        self._thread = threading.Thread(target=self._accept, name='fake-twitch-accept', daemon=True)
+
+    @property
+    def irc_server(self) -> IrcServer:
+        return IrcServer(
+            '127.0.0.1',
+            self._sock.getsockname()[1],
+            tls=self._client_context is not None,
+            ssl_context=self._client_context
+        )
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break
+
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            if self._server_context is not None:
+                try:
+                    sock = self._server_context.wrap_socket(sock, server_side=True)
+                except (OSError, ssl.SSLError):
+                    sock.close()
+                    continue
+
+            client = _Client(sock)
+            threading.Thread(target=self._serve, args=(client,), name='fake-twitch-client', daemon=True).start()
+
+    def _serve(self, client: _Client):
+        try:
+            for line in IrcLineReader(client.sock).lines():
+                self._handle(client, line)
+        except OSError:
+            pass
+
+        with self._joined:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def _handle(self, client: _Client, line: str):
+        # Timestamp first, so outbound latency does not include parsing
+        received_at = time.perf_counter()
+        message = parse_message(line)
+
+        if message.command == 'PRIVMSG':
+            if self._on_privmsg is not None:
+                self._on_privmsg(message.params[0].lstrip('#'), message.text, received_at)
+        elif message.command == 'PING':
+            client.send(f':tmi.twitch.tv PONG tmi.twitch.tv :{message.text}\r\n'.encode('UTF-8'))
+        elif message.command == 'CAP':
+            client.send(f':tmi.twitch.tv CAP * ACK :{message.text}\r\n'.encode('UTF-8'))
+        elif message.command == 'NICK':
+            client.nick = message.params[0]
+            client.send(f':tmi.twitch.tv 001 {client.nick} :Welcome, GLHF!\r\n'.encode('UTF-8'))
+        elif message.command == 'JOIN':
+            channels = [channel.lstrip('#') for channel in message.params[0].split(',')]
+            client.send(''.join(
+                f':{client.nick}!{client.nick}@{client.nick}.tmi.twitch.tv JOIN #{channel}\r\n' for channel in channels
+            ).encode('UTF-8'))
+
+            with self._joined:
+                client.channels.extend(channels)
+
+                if client not in self._clients:
+                    self._clients.append(client)
+
+                self._joined.notify_all()
+
+    def wait_for_channels(self, channels: Iterable[str], timeout: float = 10.0):
+        """
+        Block until all channels were joined by connected clients.
+        """
+        channels = set(channels)
+
+        with self._joined:
+            if not self._joined.wait_for(
+                lambda: channels <= {channel for client in self._clients for channel in client.channels},
+                timeout
+            ):
+                raise TimeoutError(f'channels not joined within {timeout}s')
+
+    def send(self, channel: str, lines: Iterable[str]):
+        """
+        Send lines to all clients which joined channel, with a single write per client, like a burst of messages
+        arriving at once.
+        """
+        data = ''.join(f'{line}\r\n' for line in lines).encode('UTF-8')
+
+        with self._joined:
+            clients = [client for client in self._clients if channel in client.channels]
+
+        for client in clients:
+            client.send(data)
+
+    def request_reconnect(self):
+        """
+        Send RECONNECT to all clients which joined a channel, like Twitch does before a server restart.
+        """
+        with self._joined:
+            clients = list(self._clients)
+
+        for client in clients:
+            client.send(b':tmi.twitch.tv RECONNECT\r\n')
+
+    def drop_clients(self):
+        """
+        Close all connections which joined a channel, while still accepting new ones.
+        """
+        with self._joined:
+            clients, self._clients = self._clients, []
+
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            client.sock.close()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop accepting connections and close all of them.
+        """
+        self._stopped = True
+        self._sock.close()
+        self.drop_clients()
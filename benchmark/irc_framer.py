@@ -0,0 +1,76 @@
+import socket
+import threading
+import time
+
+from vojaybot.irc import IrcLineReader
+
+LINE_COUNT = 200_000
+
+LINES = [
+    ':vojay!vojay@vojay.tmi.twitch.tv PRIVMSG #vojay :!licht grün',
+    ':viewer_1!viewer_1@viewer_1.tmi.twitch.tv PRIVMSG #vojay :Grüße aus Köln, schöner Stream heute VoHiYo',
+    ':raider!raider@raider.tmi.twitch.tv PRIVMSG #vojay :' + 'PogChamp ' * 40,
+    ':viewer_2!viewer_2@viewer_2.tmi.twitch.tv PRIVMSG #vojay :!dice',
+]
+
+
+def build_payload(line_count):
+    lines = (LINES[i % len(LINES)] for i in range(line_count))
+    return ''.join(f'{line}\r\n' for line in lines).encode('UTF-8')
+
+
+def send_payload(sock, payload):
+    sock.sendall(payload)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def legacy_loop(sock):
+    """
+    The read loop TwitchBot used before IrcLineReader. Errors are replaced while decoding, otherwise the first
+    character split across two chunks would end the benchmark.
+    """
+    count = 0
+
+    while data := sock.recv(1024):
+        raw_message = data.decode('UTF-8', 'replace')
+
+        for _ in raw_message.splitlines():
+            count += 1
+
+    return count
+
+
+def line_reader_loop(sock, read_size):
+    count = 0
+
+    for _ in IrcLineReader(sock, read_size).lines():
+        count += 1
+
+    return count
+
+
+def run(name, loop, payload, *args):
+    receiver, sender = socket.socketpair()
+    thread = threading.Thread(target=send_payload, args=(sender, payload))
+
+    start = time.perf_counter()
+    thread.start()
+    count = loop(receiver, *args)
+    duration = time.perf_counter() - start
+
+    thread.join()
+    receiver.close()
+    sender.close()
+
+    print(f'{name:<24} {count:>8} lines {duration:>7.3f}s {count / duration:>12,.0f} lines/s '
+          f'({count - LINE_COUNT:+} lines compared to sent)')
+
+
+if __name__ == '__main__':
+    data = build_payload(LINE_COUNT)
+    print(f'sending {LINE_COUNT} lines, {len(data) / 1024 / 1024:.1f} MiB over a local socket pair')
+
+    run('legacy recv(1024)', legacy_loop, data)
+
+    for size in [1024, 4096, 16384, 65536]:
+        run(f'IrcLineReader({size})', line_reader_loop, data, size)
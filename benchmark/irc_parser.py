@@ -0,0 +1,76 @@
+import timeit
+
+from vojaybot.irc import parse_message
+
+# Real shaped lines as Twitch sends them with the twitch.tv/tags and twitch.tv/commands capabilities requested
+CORPUS = [
+    '@badge-info=subscriber/14;badges=broadcaster/1,subscriber/12;client-nonce=6a1f;color=#1E90FF;display-name=vojay;'
+    'emotes=;first-msg=0;flags=;id=8a6c2f0e-7b1d-4e1e-9a3b-2a1f0c9d7e11;mod=0;room-id=123456;subscriber=1;'
+    'tmi-sent-ts=1606050000000;turbo=0;user-id=123456;user-type= :vojay!vojay@vojay.tmi.twitch.tv '
+    'PRIVMSG #vojay :!licht rechts grün',
+    '@badge-info=;badges=;color=;display-name=Viewer_1;emotes=25:0-4,12-16/1902:6-10;first-msg=0;flags=;'
+    'id=1d9a7f3e-5c2b-4b8e-8f3a-9e0d1c2b3a44;mod=0;room-id=123456;subscriber=0;tmi-sent-ts=1606050000001;turbo=0;'
+    'user-id=987654;user-type= :viewer_1!viewer_1@viewer_1.tmi.twitch.tv PRIVMSG #vojay :Kappa Keepo Kappa',
+    '@badge-info=;badges=moderator/1;color=#8A2BE2;display-name=ModeratorX;emotes=;first-msg=0;flags=;'
+    'id=0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0;mod=1;room-id=123456;subscriber=0;tmi-sent-ts=1606050000002;turbo=0;'
+    'user-id=555555;user-type=mod :moderatorx!moderatorx@moderatorx.tmi.twitch.tv PRIVMSG #vojay :!dice',
+    '@badge-info=;badges=;color=;display-name=Raider;emotes=;first-msg=1;flags=;'
+    'id=aa11bb22-cc33-dd44-ee55-ff6677889900;mod=0;room-id=123456;subscriber=0;tmi-sent-ts=1606050000003;turbo=0;'
+    'user-id=424242;user-type= :raider!raider@raider.tmi.twitch.tv PRIVMSG #vojay :' + 'Grüße aus dem Raid! ' * 10,
+    'PING :tmi.twitch.tv',
+    ':tmi.twitch.tv 001 vojaybot :Welcome, GLHF!',
+]
+
+# Same lines without tags, as TwitchBot received them before requesting the twitch.tv/tags capability
+UNTAGGED_CORPUS = [line.split(' ', 1)[1] if line.startswith('@') else line for line in CORPUS]
+
+
+def legacy_handle(raw_message):
+    """
+    Tokenization as done by TwitchBot before parse_message: _handle, _parse and _handle_chat each split the line.
+    """
+    if raw_message.startswith('PING :tmi.twitch.tv'):
+        return None
+
+    components = raw_message.split()
+
+    if components[1] != 'PRIVMSG':
+        return None
+
+    components = raw_message.split()
+    user, host = components[0].split('!')[1].split('@')
+    channel = components[2]
+    message = ' '.join(components[3:])[1:]
+    parsed_message = {'user': user, 'host': host, 'channel': channel, 'message': message}
+
+    if parsed_message['message'].startswith('!'):
+        return parsed_message['message'].lower().split()
+
+    return parsed_message
+
+
+def single_pass_handle(raw_message):
+    message = parse_message(raw_message)
+
+    if message.command != 'PRIVMSG':
+        return None
+
+    if message.text.startswith('!'):
+        return message.text.lower().split()
+
+    return message
+
+
+def run(name, function, corpus, number=20_000):
+    duration = timeit.timeit(lambda: [function(line) for line in corpus], number=number)
+    lines = number * len(corpus)
+
+    print(f'{name:<36} {duration / lines * 1e6:>7.3f} µs/line {lines / duration:>12,.0f} lines/s')
+
+
+if __name__ == '__main__':
+    run('legacy split, untagged', legacy_handle, UNTAGGED_CORPUS)
+    run('parse_message, untagged', single_pass_handle, UNTAGGED_CORPUS)
+    run('parse_message, tagged', single_pass_handle, CORPUS)
+    run('parse_message + user-id, tagged', lambda line: parse_message(line).user_id, CORPUS)
+    run('parse_message + badges, tagged', lambda line: parse_message(line).badges, CORPUS)
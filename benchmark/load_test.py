@@ -0,0 +1,453 @@
+import argparse
+import gc
+import logging
+import os
+import random
+import resource
+import threading
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from benchmark.fake_stream_elements import FakeStreamElementsServer
+from benchmark.fake_twitch_server import FakeTwitchServer
+from vojaybot.async_twitch import AsyncTwitchBot
+from vojaybot.connection import JOIN_BATCH_PERIOD, JOIN_BATCH_SIZE
+from vojaybot.execution import ExecutionMode
+from vojaybot.handler.dice import DiceHandler
+from vojaybot.handler.hue_light import HueLightHandler
+from vojaybot.log import create_console, setup_logging
+from vojaybot.metrics import Metrics
+from vojaybot.profiler import Diagnostics
+from vojaybot.scheduler import RateLimit
+from vojaybot.spam import DuplicateFilter
+from vojaybot.stream_elements import StreamElementsClient, StreamElementsPointsDecorator, StreamElementsPointsLedger
+from vojaybot.twitch import CommandHandler, CommandHandlerDecorator, TwitchBot, call_handler
+
+# The local server has no rate limit, the default measures the bot instead of the Twitch rate limit
+RATE_LIMIT_UNLIMITED = RateLimit(messages=1_000_000, period=1.0, burst=100_000)
+
+CHAT_TEXTS = [
+    'PogChamp PogChamp PogChamp raid hype',
+    'Grüße aus Köln, schöner Stream heute VoHiYo',
+    'hello chat',
+    'KEKW ' * 20,
+]
+
+UNICODE_TEXT = ('Grüße aus Köln 🎉🔥 日本語のチャットです Привет чат 👩‍👩‍👧‍👦 ' * 12)[:480]
+
+# Relative frequency of commands, unknown commands are routed but have no handler
+COMMAND_MIX = {
+    '!echo hello': 4,
+    '!dice': 3,
+    '!light red': 2,
+    '!licht rechts blau': 1,
+    '!gamble': 1,
+    '!unknown command': 1,
+}
+
+LIGHTS = {
+    'links': {'hue_light_id': 1, 'aliases': ['left']},
+    'rechts': {'hue_light_id': 2, 'aliases': ['right']},
+}
+
+
+class Batch(NamedTuple):
+    # Seconds after the start of the replay at which the batch is sent
+    offset: float
+    channel: str
+    ids: List[str]
+    lines: List[str]
+
+
+def percentiles(values: List[float]) -> str:
+    if not values:
+        return 'n/a'
+
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    return f'p50 {at(0.5):8.2f} ms  p90 {at(0.9):8.2f} ms  p99 {at(0.99):8.2f} ms  max {values[-1] * 1000:8.2f} ms'
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size, falls back to the peak resident set size where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoadStats:
+    """
+    Collects timestamps of a single load test run. Messages are identified by their id tag.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+
+        self.sent_at: Dict[str, float] = {}
+        self.replied_at: Dict[str, float] = {}
+
+        self.command_latencies: List[float] = []
+        self.outbound_latencies: List[float] = []
+        self.end_to_end_latencies: List[float] = []
+
+        self.handled = 0
+        self.replies_received = 0
+        self.done_at: Optional[float] = None
+
+    def sent(self, ids: List[str]):
+        now = time.perf_counter()
+
+        with self._lock:
+            self.sent_at.update(dict.fromkeys(ids, now))
+
+    def handled_command(self, msg_id: str):
+        now = time.perf_counter()
+
+        with self._lock:
+            self.handled += 1
+            self.command_latencies.append(now - self.sent_at[msg_id])
+            self._finished.notify_all()
+
+    def replied(self, msg_id: str):
+        with self._lock:
+            self.replied_at[msg_id] = time.perf_counter()
+
+    def received(self, channel: str, text: str, received_at: float):
+        # Only echo replies carry the id of the message they answer, e.g. "echo 42"
+        if not text.startswith('echo '):
+            return
+
+        msg_id = text[5:]
+
+        with self._lock:
+            self.replies_received += 1
+            self.outbound_latencies.append(received_at - self.replied_at[msg_id])
+            self.end_to_end_latencies.append(received_at - self.sent_at[msg_id])
+            self._finished.notify_all()
+
+    def wait(self, commands: int, timeout: float) -> bool:
+        """
+        Wait until all commands were handled and all echo replies reached the server.
+        """
+        with self._finished:
+            return self._finished.wait_for(
+                lambda: self.handled >= commands and self.replies_received >= len(self.replied_at),
+                timeout
+            )
+
+
+class MeasuredHandler(CommandHandlerDecorator):
+    """
+    Records the time from sending a command until its handler returned, no matter if it succeeded.
+    """
+
+    def __init__(self, handler: CommandHandler, stats: LoadStats):
+        super().__init__(handler)
+        self._stats = stats
+
+        # Measuring must not change where and in which order the handler runs
+        self.execution_mode = handler.execution_mode
+        self.execution_key = handler.execution_key
+
+    def _pre_handle(self, user: str, command: str, args: List[str]) -> bool:
+        return True
+
+    def _post_handle(self, user: str, command: str, args: List[str]) -> bool:
+        return True
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        try:
+            return call_handler(self._command_handler, user, command, args)
+        finally:
+            self._stats.handled_command(self._message.msg_id)
+
+
+class EchoHandler(CommandHandler):
+    """
+    Replies with the id of the command, so the fake server can measure outbound latency.
+    """
+
+    execution_mode = ExecutionMode.INLINE
+
+    def __init__(self, stats: LoadStats):
+        self._stats = stats
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        msg_id = self._message.msg_id
+
+        self._stats.replied(msg_id)
+        self._send_chat_message(f'echo {msg_id}')
+
+        return True
+
+
+class DoneHandler(CommandHandler):
+    """
+    Handles the command sent after the replayed traffic. The read thread parses lines in order, so once it was routed,
+    all lines before it were parsed.
+    """
+
+    def __init__(self, stats: LoadStats, channels: int):
+        self._stats = stats
+        self._remaining = channels
+        self._lock = threading.Lock()
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        with self._lock:
+            self._remaining -= 1
+
+            if not self._remaining:
+                self._stats.done_at = time.perf_counter()
+
+        return True
+
+
+class StubHueBridge:
+    """
+    Stand-in for phue.Bridge, every update takes latency seconds like a request to a real bridge.
+    """
+
+    def __init__(self, latency: float = 0.005):
+        self._latency = latency
+        self.updates = 0
+
+    def get_light_id_by_name(self, name):
+        return int(name)
+
+    def set_light(self, light_id, state):
+        time.sleep(self._latency)
+        self.updates += 1
+
+    def set_group(self, group_id, state):
+        time.sleep(self._latency)
+        self.updates += 1
+
+
+def chat_line(msg_id: str, user_index: int, channel: str, text: str) -> str:
+    user = f'viewer{user_index}'
+
+    return (f'@badge-info=subscriber/12;badges=subscriber/12,premium/1;color=#1E90FF;display-name={user};emotes=;'
+            f'first-msg=0;flags=;id={msg_id};mod=0;room-id=1;subscriber=1;tmi-sent-ts=1650000000000;turbo=0;'
+            f'user-id={user_index};user-type= :{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel} :{text}')
+
+
+def generate_traffic(args, channels: List[str]) -> Iterator[Batch]:
+    rng = random.Random(args.seed)
+    commands, weights = list(COMMAND_MIX.keys()), list(COMMAND_MIX.values())
+    texts = [UNICODE_TEXT] if args.scenario == 'unicode' else CHAT_TEXTS
+
+    def text():
+        if rng.random() < args.command_ratio:
+            return rng.choices(commands, weights)[0]
+
+        return rng.choice(texts)
+
+    def lines(first_id, count, channel):
+        ids = [str(i) for i in range(first_id, first_id + count)]
+        return ids, [chat_line(msg_id, rng.randrange(args.users), channel, text()) for msg_id in ids]
+
+    if args.scenario in ('raid', 'unicode'):
+        # Every channel receives all of its messages at once, like a raid arriving
+        per_channel = args.messages // len(channels)
+
+        for i, channel in enumerate(channels):
+            yield Batch(0.0, channel, *lines(i * per_channel, per_channel, channel))
+    else:
+        # Messages are spread evenly across channels and sent in small batches every 10ms with the given rate
+        interval = 0.01
+        batch_size = max(1, int(args.rate * interval))
+
+        for i, first_id in enumerate(range(0, args.messages, batch_size)):
+            channel = channels[i % len(channels)]
+            yield Batch(i * interval, channel, *lines(first_id, min(batch_size, args.messages - first_id), channel))
+
+
+def create_bot(args, server: FakeTwitchServer, channels: List[str], stats: LoadStats, se_client, ledger, bridge,
+               metrics):
+    kwargs = dict(
+        command_handling_thread_pool_size=args.threads,
+        server=server.irc_server,
+        rate_limit=None if args.twitch_rate_limit else RATE_LIMIT_UNLIMITED,
+        coalesce_window=args.coalesce_window,
+        metrics=metrics,
+        console=args.console,
+        max_pending_commands=args.max_pending_commands,
+        max_queued_messages=args.max_queued_messages,
+        message_filters=[DuplicateFilter()] if args.spam_filter else ()
+    )
+
+    if args.engine == 'async':
+        bot = AsyncTwitchBot('loadtest', channels, 'oauth:token', **kwargs)
+    else:
+        bot = TwitchBot('loadtest', channels, 'oauth:token', connection_count=args.connections, **kwargs)
+
+    usage = 'Usage: !light <color> or !light <light> <color>'
+    light_handler = HueLightHandler(None, LIGHTS, usage, bridge=bridge, metrics=metrics)
+
+    # Handlers run where they declare to run, unless all of them are forced into the thread pool for comparison
+    mode = ExecutionMode.THREAD if args.execution == 'thread' else None
+
+    bot.register_handler('echo', MeasuredHandler(EchoHandler(stats), stats), mode=mode)
+    bot.register_handler('dice', MeasuredHandler(DiceHandler(), stats), mode=mode)
+    bot.register_handler('light', MeasuredHandler(light_handler, stats), 'licht', mode=mode)
+    bot.register_handler('gamble', MeasuredHandler(
+        StreamElementsPointsDecorator(EchoHandler(stats), 10, se_client, ledger=ledger), stats
+    ), mode=mode)
+    bot.register_handler('done', DoneHandler(stats, len(channels)), mode=mode)
+
+    return bot
+
+
+def run(args):
+    channels = [f'channel{i}' for i in range(args.channels)]
+    batches = list(generate_traffic(args, channels))
+
+    line_count = sum(len(batch.lines) for batch in batches)
+    command_count = sum(
+        1 for batch in batches for line in batch.lines
+        if (text := line.rsplit(' :', 1)[1]).startswith('!') and not text.startswith('!unknown')
+    )
+
+    stats = LoadStats()
+    metrics = Metrics() if args.metrics else None
+
+    se_server = FakeStreamElementsServer().start()
+    se_client = StreamElementsClient('token', 'channel', base_uri=se_server.base_uri, metrics=metrics)
+    ledger = StreamElementsPointsLedger(se_client, flush_interval=0.5)
+    bridge = StubHueBridge()
+
+    server = FakeTwitchServer(tls=args.tls, on_privmsg=stats.received).start()
+    bot = create_bot(args, server, channels, stats, se_client, ledger, bridge, metrics)
+
+    bot_thread = threading.Thread(target=bot.run, name='load-test-bot', daemon=True)
+    bot_thread.start()
+
+    # Only 20 channels are joined every 10 seconds
+    server.wait_for_channels(channels, 10.0 + JOIN_BATCH_PERIOD * ((len(channels) - 1) // JOIN_BATCH_SIZE))
+
+    gc.collect()
+    rss_before = rss_bytes()
+
+    diagnostics = Diagnostics(bot.tracer, args.profile) if args.profile else None
+
+    if diagnostics is not None:
+        diagnostics.start()
+
+    start = time.perf_counter()
+
+    for batch in batches:
+        if (delay := start + batch.offset - time.perf_counter()) > 0:
+            time.sleep(delay)
+
+        stats.sent(batch.ids)
+        server.send(batch.channel, batch.lines)
+
+    for i, channel in enumerate(channels):
+        done_id = f'done{i}'
+        stats.sent([done_id])
+        server.send(channel, [chat_line(done_id, 0, channel, '!done')])
+
+    completed = stats.wait(command_count, args.timeout)
+    duration = (stats.done_at or time.perf_counter()) - start
+
+    profiled = diagnostics.stop(detailed=True) if diagnostics is not None else None
+
+    gc.collect()
+    rss_after = rss_bytes()
+
+    bot.stop()
+    server.stop()
+    bot_thread.join()
+    ledger.close()
+    se_client.close()
+    se_server.stop()
+
+    replies = [connection.scheduler.stats() for connection in bot.connections]
+
+    print(f'{args.scenario}: {line_count} lines, {command_count} commands, {len(channels)} channel(s), '
+          f'{args.engine} engine, {"TLS" if args.tls else "plain"}')
+
+    if not completed:
+        print(f'  timed out after {args.timeout}s, {stats.handled}/{command_count} commands handled, '
+              f'{stats.replies_received}/{len(stats.replied_at)} replies received')
+
+    print(f'  parsed            {line_count / duration:12,.0f} lines/s ({duration:.3f}s)')
+    print(f'  command latency   {percentiles(stats.command_latencies)}')
+    print(f'  outbound latency  {percentiles(stats.outbound_latencies)}')
+    print(f'  end-to-end        {percentiles(stats.end_to_end_latencies)}')
+    print(f'  replies           {sum(s.sent for s in replies)} sent, {sum(s.dropped for s in replies)} dropped, '
+          f'{sum(s.coalesced for s in replies)} coalesced, {sum(s.overflowed for s in replies)} overflowed')
+    print(f'  commands shed     {sum(p.rejected for p in bot.pools)} rejected, {sum(p.dropped for p in bot.pools)} '
+          f'dropped, {sum(p.expired for p in bot.pools)} expired')
+    print(f'  stubs             {se_server.request_count} StreamElements requests, {bridge.updates} Hue updates')
+    print(f'  memory            {(rss_after - rss_before) / 2 ** 20:+.1f} MiB RSS '
+          f'({rss_before / 2 ** 20:.1f} MiB -> {rss_after / 2 ** 20:.1f} MiB)')
+
+    if profiled is not None:
+        print(f'  profile           {profiled}')
+
+        for line in bot.tracer.format_summary().splitlines():
+            print(f'    {line}')
+
+    if metrics is not None:
+        print('  metrics')
+
+        # Buckets are left out, count and sum are enough to compare runs
+        for line in metrics.render().splitlines():
+            if not line.startswith('#') and '_bucket{' not in line:
+                print(f'    {line}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the bot against a local fake Twitch IRC server')
+
+    parser.add_argument('scenario', choices=['raid', 'mix', 'unicode'], nargs='?', default='raid',
+                        help='raid and unicode send all messages at once, mix sends them with the given rate')
+    parser.add_argument('--messages', type=int, default=20_000)
+    parser.add_argument('--rate', type=float, default=2000, help='messages per second of the mix scenario')
+    parser.add_argument('--command-ratio', type=float, default=0.1)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4, help='command handling thread pool size')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread')
+    parser.add_argument('--execution', choices=['handler', 'thread'], default='handler',
+                        help='run handlers with their own execution mode or all of them in the thread pool')
+    # Unbounded by default, so every run handles all commands and replies, set them to see what is shed under overload
+    parser.add_argument('--max-pending-commands', type=int, default=None)
+    parser.add_argument('--max-queued-messages', type=int, default=None)
+    parser.add_argument('--tls', action='store_true', help='use TLS with a self-signed certificate')
+    parser.add_argument('--twitch-rate-limit', action='store_true', help='send replies with the Twitch rate limit')
+    parser.add_argument('--coalesce-window', type=float, default=None)
+    parser.add_argument('--spam-filter', action='store_true',
+                        help='run a DuplicateFilter, the chat texts repeat, so most chat messages are collapsed')
+    parser.add_argument('--metrics', action='store_true', help='enable metrics and print them after the run')
+    parser.add_argument('--profile', metavar='DIR', help='trace and profile the bot, and write the results to DIR')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='keep the console output and chat log of the bot')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+
+    # Without --verbose the bot neither prints nor logs, logging every chat message would dominate the results
+    arguments.console = None
+
+    if arguments.verbose:
+        arguments.console = create_console()
+        setup_logging(arguments.console)
+    else:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    run(arguments)
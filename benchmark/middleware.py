@@ -0,0 +1,116 @@
+import argparse
+import statistics
+import threading
+import time
+from typing import List
+
+from benchmark.fake_stream_elements import FakeStreamElementsServer
+from vojaybot.middleware import CommandContext, Middleware
+from vojaybot.stream_elements import StreamElementsClient, StreamElementsPointsDecorator, StreamElementsPointsLedger
+from vojaybot.twitch import CommandHandler, CommandHandlerDecorator
+
+
+class SilentHandler(CommandHandler):
+
+    # The only reply of a command is the one of the points check
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        return True
+
+
+class FollowerCheck(Middleware):
+    """
+    Stands in for a request to the Twitch API with the same latency as the StreamElements API.
+    """
+
+    def __init__(self, latency: float):
+        self._latency = latency
+
+    def check(self, context: CommandContext) -> bool:
+        time.sleep(self._latency)
+        return True
+
+
+class FollowerDecorator(CommandHandlerDecorator):
+
+    def __init__(self, handler: CommandHandler, latency: float):
+        super().__init__(handler)
+        self._latency = latency
+
+    def _pre_handle(self, user: str, command: str, args: List[str]) -> bool:
+        time.sleep(self._latency)
+        return True
+
+    def _post_handle(self, user: str, command: str, args: List[str]) -> bool:
+        return True
+
+
+class LegacyPointsDecorator(CommandHandlerDecorator):
+    """
+    StreamElementsPointsDecorator without a ledger as it was before it became a MiddlewarePipeline: the balance is
+    fetched before the handler, fetched again and reduced after it, all before the command returns.
+    """
+
+    def __init__(self, handler: CommandHandler, costs: int, se_client: StreamElementsClient):
+        super().__init__(handler)
+
+        self._costs = costs
+        self._se_client = se_client
+
+    def _pre_handle(self, user: str, command: str, args: List[str]) -> bool:
+        return self._se_client.get_points(user) >= self._costs
+
+    def _post_handle(self, user: str, command: str, args: List[str]) -> bool:
+        points = self._se_client.get_points(user)
+        points_new = self._se_client.reduce_points(user, self._costs)
+
+        self._send_chat_message(f'@{user}: {points} -> {points_new}')
+        return True
+
+
+def run(name: str, handler: CommandHandler, calls: int):
+    replied = threading.Semaphore(0)
+    handler.message_processor = lambda message, priority, merge_key: replied.release()
+
+    handled = []
+    answered = []
+
+    for i in range(calls):
+        started_at = time.perf_counter()
+        handler.handle(f'viewer{i}', 'paid', [])
+        handled.append(time.perf_counter() - started_at)
+
+        # The reply of the post-action tells the viewer the command went through
+        replied.acquire()
+        answered.append(time.perf_counter() - started_at)
+
+    print(f'{name:<34} handled after {statistics.median(handled) * 1000:>6.1f} ms, '
+          f'viewer notified after {statistics.median(answered) * 1000:>6.1f} ms (median of {calls})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency of a paid command with a follower check')
+
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per API request')
+    parser.add_argument('--calls', type=int, default=20)
+
+    args = parser.parse_args()
+
+    server = FakeStreamElementsServer(default_points=1_000_000, latency=args.latency).start()
+    client = StreamElementsClient('token', 'channel', base_uri=server.base_uri)
+    ledger = StreamElementsPointsLedger(client)
+
+    print(f'every API request takes {args.latency * 1000:.0f} ms')
+
+    run('nested decorators', FollowerDecorator(
+        LegacyPointsDecorator(SilentHandler(), 10, client), args.latency
+    ), args.calls)
+    run('pipeline', StreamElementsPointsDecorator(
+        SilentHandler(), 10, client, middleware=[FollowerCheck(args.latency)]
+    ), args.calls)
+    run('pipeline with ledger', StreamElementsPointsDecorator(
+        SilentHandler(), 10, client, ledger=ledger, middleware=[FollowerCheck(args.latency)]
+    ), args.calls)
+
+    ledger.close()
+    client.close()
+    server.stop()
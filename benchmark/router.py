@@ -0,0 +1,59 @@
+import timeit
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from vojaybot.router import CommandRouter
+
+COMMAND_COUNT = 500
+
+MESSAGES = {
+    'chat message': 'Grüße aus Köln, schöner Stream heute VoHiYo',
+    'unknown command': '!doesnotexist with some arguments',
+    'known command': '!command250 rechts grün',
+    'known alias, upper case': '!ALIAS250 Rechts Grün',
+}
+
+
+def legacy_dispatch(handlers, chat_message):
+    """
+    Dispatch as done by TwitchBot._handle_chat before the CommandRouter.
+    """
+    if chat_message.startswith('!'):
+        message_components = chat_message.lower().split()
+
+        command = message_components[0][1:].lower()
+        args = message_components[1:]
+
+        if command in handlers:
+            return handlers[command], command, args
+
+    return None
+
+
+if __name__ == '__main__':
+    router = CommandRouter()
+    handlers = {}
+
+    for i in range(COMMAND_COUNT):
+        handler = object()
+        router.register(f'command{i}', handler, f'alias{i}')
+        handlers[f'command{i}'] = handlers[f'alias{i}'] = handler
+
+    print(f'dispatch cost per message with {COMMAND_COUNT} commands and {COMMAND_COUNT} aliases registered')
+
+    for name, text in MESSAGES.items():
+        number = 1_000_000
+        legacy = timeit.timeit(lambda: legacy_dispatch(handlers, text), number=number) / number * 1e9
+        routed = timeit.timeit(lambda: router.route(text), number=number) / number * 1e9
+
+        print(f'{name:<28} legacy {legacy:>7.1f} ns   CommandRouter {routed:>7.1f} ns')
+
+    # TwitchBot used to hand every line over to the executor before routing it, now only routed commands are
+    executor = ThreadPoolExecutor(4)
+    text = MESSAGES['chat message']
+    number = 100_000
+
+    legacy = timeit.timeit(lambda: executor.submit(legacy_dispatch, handlers, text), number=number) / number * 1e9
+    routed = timeit.timeit(lambda: router.route(text) and executor.submit(print), number=number) / number * 1e9
+
+    print(f'{"chat message incl. hand-off":<28} legacy {legacy:>7.1f} ns   CommandRouter {routed:>7.1f} ns')
+    executor.shutdown()
@@ -0,0 +1,84 @@
+import argparse
+import random
+import string
+import time
+from typing import List
+
+from vojaybot.irc import IrcMessage, parse_message
+from vojaybot.spam import DuplicateFilter, FilterAction, fingerprint, normalize
+
+# Copy-paste waves of a raid, sent with small changes to get around the duplicate check of Twitch
+WAVES = [
+    'PogChamp PogChamp PogChamp raid hype',
+    'VOJAY RAID VOJAY RAID VOJAY RAID VOJAY RAID VOJAY RAID',
+    '░░░░░▄▄▀▀▀▀▀▀▀▀▀▄▄░░░░░ copy this if you love the stream ░░░░░▄▄▀▀▀▀▀▀▀▀▀▄▄░░░░░',
+    'The Vojay Raid has arrived, bow to the raiders KEKW KEKW',
+]
+
+SUFFIXES = ['', ' ', '\u200b', '\U000e0000', '!', ' KEKW', ' !!']
+
+WORDS = [
+    'hello', 'chat', 'stream', 'hype', 'nice', 'what', 'is', 'the', 'song', 'called', 'gg', 'lol', 'welcome',
+    'raiders', 'first', 'time', 'here', 'love', 'this', 'game', 'lights', 'are', 'so', 'cool', 'Kappa', 'LUL',
+]
+
+# Lines per second of a large raid, the rate of the raid scenario of the load test. The filter runs on the reading
+# thread, so it has to keep up with a multiple of that to leave time for everything else.
+RAID_RATE = 2000
+
+
+def create_messages(count: int, spam_ratio: float, users: int, seed: int) -> List[IrcMessage]:
+    randomizer = random.Random(seed)
+    messages = []
+
+    for _ in range(count):
+        if randomizer.random() < spam_ratio:
+            text = randomizer.choice(WAVES) + randomizer.choice(SUFFIXES)
+        else:
+            # Unique chat, every message gets a random token so it is never seen before
+            token = ''.join(randomizer.choices(string.ascii_lowercase, k=6))
+            text = ' '.join(randomizer.choices(WORDS, k=randomizer.randint(2, 10))) + f' {token}'
+
+        user = f'viewer{randomizer.randrange(users)}'
+        messages.append(parse_message(f':{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #vojay :{text}'))
+
+    return messages
+
+
+def run(messages: List[IrcMessage]) -> float:
+    message_filter = DuplicateFilter()
+    actions = dict.fromkeys(FilterAction, 0)
+
+    started_at = time.perf_counter()
+
+    for message in messages:
+        actions[message_filter.check(message)] += 1
+
+    seconds = time.perf_counter() - started_at
+    rate = len(messages) / seconds
+    counts = ', '.join(f'{action.name.lower()} {count:,}' for action, count in actions.items() if count)
+
+    print(f'  {rate:>9,.0f} lines/s  {seconds / len(messages) * 1e6:>5.1f} µs per line  ({counts})')
+    return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of the duplicate filter at raid-like message mixes')
+
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    fingerprints = [fingerprint(normalize(WAVES[0] + suffix)) for suffix in SUFFIXES]
+    distances = [bin(fingerprints[0] ^ other).count('1') for other in fingerprints]
+    print(f'fingerprint distance of the variants of a wave: {distances}')
+
+    slowest = float('inf')
+
+    for spam_ratio in (0.0, 0.5, 0.9):
+        print(f'{spam_ratio:.0%} copy-paste spam')
+        slowest = min(slowest, run(create_messages(args.messages, spam_ratio, args.users, args.seed)))
+
+    print(f'slowest mix keeps up with {slowest / RAID_RATE:.1f}x a raid of {RAID_RATE:,} lines/s on a single core')
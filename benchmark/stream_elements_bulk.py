@@ -0,0 +1,41 @@
+import time
+
+from benchmark.fake_stream_elements import FakeStreamElementsServer
+from vojaybot.stream_elements import StreamElementsClient
+
+USERS = 1000
+COSTS = 10
+
+
+def run(name, server, function):
+    request_count = server.request_count
+    start = time.perf_counter()
+
+    results = function()
+
+    duration = time.perf_counter() - start
+    failed = sum(1 for success in results.values() if not success)
+
+    print(f'{name:<32} {server.request_count - request_count:>5} requests {duration:>7.3f}s '
+          f'{len(results)} users, {failed} failed')
+
+
+if __name__ == '__main__':
+    server = FakeStreamElementsServer().start()
+    client = StreamElementsClient('token', 'channel', base_uri=server.base_uri)
+    users = [f'user{i}' for i in range(USERS)]
+
+    print(f'deducting {COSTS} points from {USERS} users of a local fake StreamElements API')
+
+    run('try_reduce_points per user', server,
+        lambda: {user: client.try_reduce_points(user, COSTS) is not None for user in users})
+    run('bulk_update_points', server,
+        lambda: client.bulk_update_points((user, -COSTS) for user in users))
+
+    # The first chunk fails, only its users are reported as failed
+    server.fail_next(500)
+    run('bulk_update_points, 1 chunk fails', server,
+        lambda: client.bulk_update_points(((user, -COSTS) for user in users), chunk_size=500))
+
+    client.close()
+    server.stop()
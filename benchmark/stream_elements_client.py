@@ -0,0 +1,47 @@
+import time
+
+import requests
+
+from benchmark.fake_stream_elements import FakeStreamElementsServer
+from vojaybot.stream_elements import StreamElementsClient
+
+CALLS = 500
+
+
+def unpooled_get_points(base_uri, user):
+    """
+    How StreamElementsClient requested points before it used a Session, a new connection for every call.
+    """
+    response = requests.request('GET', f'{base_uri}/points/channel/{user}', headers={'Accept': 'application/json'})
+    return int(response.json()['points'])
+
+
+def run(name, function):
+    start = time.perf_counter()
+
+    for i in range(CALLS):
+        function(f'user{i % 50}')
+
+    duration = time.perf_counter() - start
+    print(f'{name:<28} {duration:>7.3f}s {duration / CALLS * 1000:>7.3f} ms/call')
+
+
+if __name__ == '__main__':
+    server = FakeStreamElementsServer().start()
+    client = StreamElementsClient('token', 'channel', base_uri=server.base_uri)
+
+    print(f'{CALLS} get_points calls against a local fake StreamElements API')
+    run('requests.request', lambda user: unpooled_get_points(server.base_uri, user))
+    run('StreamElementsClient', client.get_points)
+
+    server.fail_next(429, count=2, retry_after=0.1)
+    start = time.perf_counter()
+    points = client.get_points('user')
+    print(f'get_points with two 429 responses (Retry-After: 0.1): {points} points after '
+          f'{time.perf_counter() - start:.3f}s')
+
+    server.fail_next(500)
+    print(f'reduce_points with a 500 response is not retried: {client.reduce_points("user", 10)}')
+
+    client.close()
+    server.stop()
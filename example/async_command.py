@@ -0,0 +1,38 @@
+import asyncio
+from typing import List
+
+from vojaybot.async_twitch import AsyncTwitchBot
+from vojaybot.handler.dice import DiceHandler
+from vojaybot.log import create_console, setup_logging
+from vojaybot.twitch import CommandHandler
+
+
+class CountdownHandler(CommandHandler):
+
+    async def handle(self, user: str, command: str, args: List[str]) -> bool:
+        # Waiting does not block anything else, all other commands are handled in the meantime
+        for i in range(3, 0, -1):
+            self._send_chat_message(f'@{user}: {i}')
+            await asyncio.sleep(1)
+
+        self._send_chat_message(f'@{user}: go!')
+        return True
+
+
+if __name__ == '__main__':
+    bot_username = 'your_twitch_account'
+    channel_name = 'your_twitch_channel'
+
+    # Get token at https://twitchapps.com/tmi/
+    oauth_token = 'oauth_token'
+
+    console = create_console()
+    setup_logging(console)
+
+    bot = AsyncTwitchBot(bot_username, channel_name, oauth_token, console=console)
+
+    # Async handlers run on the event loop, synchronous handlers like the DiceHandler are offloaded to a thread pool
+    bot.register_handler('countdown', CountdownHandler())
+    bot.register_handler('dice', DiceHandler())
+
+    bot.run()
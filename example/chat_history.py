@@ -0,0 +1,62 @@
+import time
+from typing import List
+
+from vojaybot.execution import ExecutionMode
+from vojaybot.log import create_console, setup_logging
+from vojaybot.twitch import TwitchBot, CommandHandler
+
+
+class LastSeenHandler(CommandHandler):
+
+    # Looking up the history takes microseconds
+    execution_mode = ExecutionMode.INLINE
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        if not args:
+            self._send_chat_message(f'@{user}: usage !lastseen <user>')
+            return False
+
+        # The latest message is the !lastseen command itself if someone looks for themselves
+        if (seen_at := self.chat_history.last_seen(args[0])) is None:
+            self._send_chat_message(f'@{user}: {args[0]} did not write anything lately')
+        else:
+            self._send_chat_message(f'@{user}: {args[0]} wrote {time.time() - seen_at:.0f}s ago')
+
+        return True
+
+
+class QuoteHandler(CommandHandler):
+
+    execution_mode = ExecutionMode.INLINE
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        if not args:
+            self._send_chat_message(f'@{user}: usage !quote <user>')
+            return False
+
+        # Commands are no quotes, so a few more messages are looked at
+        for entry in self.chat_history.last_messages(args[0], 5):
+            if not entry.text.startswith('!'):
+                self._send_chat_message(f'"{entry.text}" - {entry.user}')
+                return True
+
+        self._send_chat_message(f'@{user}: nothing to quote from {args[0]}')
+        return False
+
+
+if __name__ == '__main__':
+    bot_username = 'your_twitch_account'
+    channel_name = 'your_twitch_channel'
+
+    # Get token at https://twitchapps.com/tmi/
+    oauth_token = 'oauth_token'
+
+    console = create_console()
+    setup_logging(console)
+
+    # The bot keeps the latest 10,000 chat messages, no matter how busy the chat is
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console, history_size=10_000)
+    bot.register_handler('lastseen', LastSeenHandler())
+    bot.register_handler('quote', QuoteHandler(), 'zitat')
+
+    bot.run()
@@ -1,6 +1,7 @@
 import random
 from typing import List
 
+from vojaybot.log import create_console, setup_logging
 from vojaybot.twitch import TwitchBot, CommandHandler
 
 
@@ -18,7 +19,10 @@ if __name__ == '__main__':
     # Get token at https://twitchapps.com/tmi/
     oauth_token = 'oauth_token'
 
-    bot = TwitchBot(bot_username, channel_name, oauth_token)
+    console = create_console()
+    setup_logging(console)
+
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console)
     bot.register_handler('random', RandomHandler(), 'zufall')
 
     bot.run()
@@ -0,0 +1,70 @@
+import time
+from typing import List
+
+from vojaybot.execution import ExecutionMode
+from vojaybot.log import create_console, setup_logging
+from vojaybot.twitch import TwitchBot, CommandHandler
+
+
+class PingHandler(CommandHandler):
+
+    # Replies right away, so there is no need to hand it over to a thread
+    execution_mode = ExecutionMode.INLINE
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        self._send_chat_message(f'@{user}: pong')
+        return True
+
+
+class WeatherHandler(CommandHandler):
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        # Stands in for a slow HTTP request
+        time.sleep(2)
+
+        self._send_chat_message(f'@{user}: sunny')
+        return True
+
+
+class PrimeHandler(CommandHandler):
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        limit = min(int(args[0]), 1_000_000) if args and args[0].isdigit() else 100_000
+
+        sieve = bytearray([1]) * (limit + 1)
+        sieve[0:2] = b'\x00\x00'
+
+        for i in range(2, int(limit ** 0.5) + 1):
+            if sieve[i]:
+                sieve[i * i::i] = bytes(len(range(i * i, limit + 1, i)))
+
+        self._send_chat_message(f'@{user}: there are {sum(sieve)} primes up to {limit}')
+        return True
+
+
+if __name__ == '__main__':
+    bot_username = 'your_twitch_account'
+    channel_name = 'your_twitch_channel'
+
+    # Get token at https://twitchapps.com/tmi/
+    oauth_token = 'oauth_token'
+
+    console = create_console()
+    setup_logging(console)
+
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console)
+
+    # Slow weather lookups only ever occupy their own two threads, at most ten further lookups wait for them. Users
+    # get a reply instead of silence if even more arrive, lookups which waited for more than 30s are skipped.
+    bot.add_thread_pool(
+        'weather', 2, max_pending=10, max_age=30.0, busy_message='@{user}, too many weather lookups, try again later'
+    )
+    bot.add_process_pool(size=2)
+
+    bot.register_handler('ping', PingHandler())
+    bot.register_handler('weather', WeatherHandler(), 'wetter', pool='weather')
+
+    # Counting primes keeps a core busy, in a worker process it does not slow down reading the chat
+    bot.register_handler('primes', PrimeHandler(), mode=ExecutionMode.PROCESS)
+
+    bot.run()
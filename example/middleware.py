@@ -0,0 +1,58 @@
+import time
+
+from vojaybot.handler.dice import DiceHandler
+from vojaybot.log import create_console, setup_logging
+from vojaybot.middleware import CommandContext, Middleware
+from vojaybot.scheduler import MessagePriority
+from vojaybot.stream_elements import StreamElementsClient, StreamElementsPointsDecorator, StreamElementsPointsLedger
+from vojaybot.twitch import TwitchBot
+
+
+class SubscriberOnly(Middleware):
+
+    # Only looks at the tags Twitch sent along with the command, so it runs before any request is started
+    blocking = False
+
+    def check(self, context: CommandContext) -> bool:
+        if context.message is not None and context.message.tag('subscriber') == '1':
+            return True
+
+        context.reply(f'@{context.user}: only for subscribers', MessagePriority.ERROR)
+        return False
+
+
+class FollowerCheck(Middleware):
+
+    def check(self, context: CommandContext) -> bool:
+        # Stands in for a request to the Twitch API, it runs at the same time as the points check
+        time.sleep(0.3)
+        return True
+
+
+if __name__ == '__main__':
+    bot_username = 'your_twitch_account'
+    channel_name = 'your_twitch_channel'
+
+    # Get token at https://twitchapps.com/tmi/
+    oauth_token = 'oauth_token'
+
+    console = create_console()
+    setup_logging(console)
+
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console)
+
+    se_client = StreamElementsClient('stream_elements_jwt_token', 'stream_elements_channel_id')
+    ledger = StreamElementsPointsLedger(se_client)
+
+    # Subscribers who follow the channel and have 10 points can roll the dice. The command waits for the slower of
+    # the follower and the points check, not for both of them. Points are refunded if another check fails.
+    dice_handler = StreamElementsPointsDecorator(
+        DiceHandler(), 10, se_client, ledger=ledger, middleware=[SubscriberOnly(), FollowerCheck()]
+    )
+
+    bot.register_handler('dice', dice_handler)
+
+    try:
+        bot.run()
+    finally:
+        ledger.close()
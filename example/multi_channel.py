@@ -0,0 +1,36 @@
+from typing import List
+
+from vojaybot.handler.chat import register_chat_handlers
+from vojaybot.handler.dice import DiceHandler
+from vojaybot.log import create_console, setup_logging
+from vojaybot.twitch import TwitchBot, run_worker_processes
+
+bot_username = 'your_twitch_account'
+
+# Get token at https://twitchapps.com/tmi/
+oauth_token = 'oauth_token'
+
+
+def create_bot(channels: List[str]) -> TwitchBot:
+    # Every worker process calls this function to create its own bot for a part of the channels, each bot spreads
+    # its channels across two connections. Logging is set up here as well, since every process needs its own logging
+    # thread.
+    console = create_console(banner=False)
+    setup_logging(console)
+
+    bot = TwitchBot(bot_username, channels, oauth_token, connection_count=2, console=console)
+
+    bot.register_handler('dice', DiceHandler())
+    register_chat_handlers({'hi': {'aliases': ['hello'], 'response': 'Hi {user}'}}, bot)
+
+    return bot
+
+
+if __name__ == '__main__':
+    channels = ['your_twitch_channel', 'another_channel', 'yet_another_channel', 'one_more_channel']
+
+    # A single bot can join multiple channels, replies are sent to the channel the command was sent in
+    # create_bot(channels).run()
+
+    # With worker processes, the channels are spread across multiple processes to use multiple cores
+    run_worker_processes(create_bot, channels, 2)
@@ -1,4 +1,5 @@
 from vojaybot.handler.chat import register_chat_handlers
+from vojaybot.log import create_console, setup_logging
 from vojaybot.twitch import TwitchBot
 
 if __name__ == '__main__':
@@ -13,7 +14,10 @@ if __name__ == '__main__':
         'bye': {'aliases': ['cya'], 'response': 'Bye {user}'}
     }
 
-    bot = TwitchBot(bot_username, channel_name, oauth_token)
+    console = create_console()
+    setup_logging(console)
+
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console)
     register_chat_handlers(commands, bot)
 
     bot.run()
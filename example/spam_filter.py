@@ -0,0 +1,43 @@
+from typing import List
+
+from vojaybot.handler.dice import DiceHandler
+from vojaybot.log import create_console, setup_logging
+from vojaybot.spam import DuplicateFilter, FilterAction
+from vojaybot.twitch import TwitchBot, CommandHandler, CommandHandlerDecorator
+
+
+class SpamWaveDecorator(CommandHandlerDecorator):
+    """
+    Pauses a command while the chat is flooded with copy-paste spam, e.g. a paid command nobody would notice anyway.
+    """
+
+    def __init__(self, handler: CommandHandler, spam_filter: DuplicateFilter):
+        super().__init__(handler)
+
+        self._spam_filter = spam_filter
+
+    def _pre_handle(self, user: str, command: str, args: List[str]) -> bool:
+        # The command itself may be part of the wave, e.g. everybody pasting the same !dice
+        return not self._spam_filter.in_wave() and self._message.duplicates == 0
+
+    def _post_handle(self, user: str, command: str, args: List[str]) -> bool:
+        return True
+
+
+if __name__ == '__main__':
+    bot_username = 'your_twitch_account'
+    channel_name = 'your_twitch_channel'
+
+    # Get token at https://twitchapps.com/tmi/
+    oauth_token = 'oauth_token'
+
+    console = create_console()
+    setup_logging(console)
+
+    # From the 5th copy of a message within 10 seconds on, copies are neither logged nor routed
+    spam_filter = DuplicateFilter(window=10.0, threshold=5, action=FilterAction.DROP)
+
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console, message_filters=[spam_filter])
+    bot.register_handler('dice', SpamWaveDecorator(DiceHandler(), spam_filter))
+
+    bot.run()
@@ -1,4 +1,5 @@
 from vojaybot.handler.dice import DiceHandler
+from vojaybot.log import create_console, setup_logging
 from vojaybot.stream_elements import StreamElementsClient, StreamElementsPointsDecorator
 from vojaybot.twitch import TwitchBot
 
@@ -9,7 +10,10 @@ if __name__ == '__main__':
     # Get token at https://twitchapps.com/tmi/
     oauth_token = 'oauth_token'
 
-    bot = TwitchBot(bot_username, channel_name, oauth_token)
+    console = create_console()
+    setup_logging(console)
+
+    bot = TwitchBot(bot_username, channel_name, oauth_token, console=console)
 
     # Apart from the bot, we need a Stream Elements client, the token and channel_id can be seen in your account
     jwt_token = 'stream_elements_jwt_token'
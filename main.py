@@ -1,29 +1,73 @@
 import toml
 
+from vojaybot.connection import ReconnectPolicy
+from vojaybot.cooldown import Cooldown
 from vojaybot.handler.chat import register_chat_handlers_from_toml_config
+from vojaybot.handler.diagnostics import DiagnosticsHandler
 from vojaybot.handler.dice import DiceHandler
 from vojaybot.handler.hue_light import HueLightHandler
-from vojaybot.stream_elements import StreamElementsClient, StreamElementsPointsDecorator
+from vojaybot.log import configure_chat_log, create_console, setup_logging
+from vojaybot.metrics import Metrics
+from vojaybot.profiler import ControlServer, Diagnostics
+from vojaybot.spam import DuplicateFilter
+from vojaybot.stream_elements import StreamElementsClient, StreamElementsPointsDecorator, StreamElementsPointsLedger
 from vojaybot.twitch import TwitchBot
 
 if __name__ == '__main__':
+    # Importing vojaybot has no side effects, the console and logging are set up by this entry point only
+    console = create_console()
+
     # See: https://en.wikipedia.org/wiki/TOML
     config = toml.load('config/config.toml')
 
     bot_username = config['twitch']['bot_username']
     channel_name = config['twitch']['channel_name']
     oauth_token = config['twitch']['oauth_token']
+    standby = config['twitch'].get('standby', False)
 
     bridge_ip = config['hue']['bridge_ip']
     lights = config['hue']['lights']
+    group_id = config['hue'].get('group_id')
 
     jwt_token = config['streamelements']['jwt_token']
     channel_id = config['streamelements']['channel_id']
 
-    se_client = StreamElementsClient(jwt_token, channel_id)
+    # Busy chats produce a lot of log output, the chat log can be sampled (share of messages logged), rate limited
+    # (messages per second) or disabled. Commands are always logged.
+    chat_log = config.get('logging', {})
+    configure_chat_log(
+        chat_log.get('chat_sample_rate', 1.0),
+        chat_log.get('chat_max_per_second'),
+        chat_log.get('chat_log', True)
+    )
+
+    # Metrics are only collected if a port is configured, they can then be scraped by Prometheus
+    metrics_port = config.get('metrics', {}).get('port')
+    metrics = Metrics() if metrics_port else None
+
+    # Log records are rendered by a background thread, so logging never slows down reading or handling messages
+    setup_logging(console, metrics=metrics)
+
+    se_client = StreamElementsClient(jwt_token, channel_id, metrics=metrics)
+
+    # The ledger caches balances and deducts points locally, StreamElements is updated in the background. This way
+    # paid commands do not need to wait for the StreamElements API and points can not be spent twice.
+    ledger = StreamElementsPointsLedger(se_client)
+
+    # Copy-paste spam waves still reach the handlers, but only their first few messages are written to the chat log.
+    # The filter costs tens of microseconds per chat message on the read thread, so it is only enabled on demand.
+    spam_filter = config.get('spam_filter', {})
+    message_filters = [
+        DuplicateFilter(spam_filter.get('window', 30.0), spam_filter.get('threshold', 3))
+    ] if spam_filter.get('enabled', False) else []
 
     # Get token at https://twitchapps.com/tmi/
-    bot = TwitchBot(bot_username, channel_name, oauth_token)
+    # Lost connections are re-established automatically. With a standby connection, the bot switches over without
+    # missing any chat when Twitch restarts a server.
+    bot = TwitchBot(
+        bot_username, channel_name, oauth_token, metrics=metrics, console=console,
+        reconnect=ReconnectPolicy(standby=standby), message_filters=message_filters
+    )
 
     # Each bot command is basically a handler, handling that command. You can also specify aliases to use the same
     # Handler with multiple commands.
@@ -31,7 +75,7 @@ if __name__ == '__main__':
 
     # With the StreamElementsPointsDecorator you can easily wrap any other Handler to add costs to it based on the
     # StreamElements points system
-    bot.register_handler('waste-points', StreamElementsPointsDecorator(DiceHandler(), 100, se_client))
+    bot.register_handler('waste-points', StreamElementsPointsDecorator(DiceHandler(), 100, se_client, ledger=ledger))
 
     # The HueLightHandler allows viewers to control Philips Hue lights, in combination with the previously described
     # StreamElementsPointsDecorator it is possible to add costs based on StreamElements points for it.
@@ -41,7 +85,9 @@ if __name__ == '__main__':
             f'Farbe. Du kannst auch nur ein bestimmtes Licht ändern, zum Beispiel mit "!licht rechts grün". Jede ' \
             f'Aktion kostet dich {costs} vcoins, mit "!licht farben" siehst du alle Farben.'
 
-    hue_light_handler = HueLightHandler(bridge_ip, lights, usage)
+    # Light changes are paid, so the handler waits until the bridge applied them. Otherwise it would succeed as soon as
+    # a change is queued, and viewers would be charged for changes that fail later on, e.g. if the bridge is down.
+    hue_light_handler = HueLightHandler(bridge_ip, lights, usage, group_id, metrics=metrics, confirm=True)
 
     # If running for the first time, you need to press the Hue bridge button and call the following method once.
     # After that it is not necessary to run connect again.
@@ -57,15 +103,36 @@ if __name__ == '__main__':
         costs,
         se_client,
         transaction_succeed_msg,
-        transaction_failed_msg
+        transaction_failed_msg,
+        ledger
     )
 
-    bot.register_handler('light', light_handler, 'licht')
+    # Every viewer can use the lights once per 30 seconds. Commands on cooldown are dropped before they cost any
+    # StreamElements or Hue request, viewers are told once when they can try again.
+    light_cooldown = Cooldown(user=30, message='@{user}, !{command} geht wieder in {remaining} Sekunden')
+    bot.register_handler('light', light_handler, 'licht', cooldown=light_cooldown)
 
     # With register_chat_handlers we have a quick way to add static, simple chat commands. This can cover all commands
     # which should just respond with a fixed text message. You can easily configure them in a toml file and add all
     # commands at once like this. If you use {user} somewhere in the response text, it automatically gets replaced
-    # with the user that sent the command.
-    register_chat_handlers_from_toml_config('config/commands.toml', bot)
-
-    bot.run()
+    # with the user that sent the command, see ResponseTemplate for further placeholders. Changes of the file are
+    # picked up while the bot is running.
+    register_chat_handlers_from_toml_config('config/commands.toml', bot, watch=True)
+
+    # If the bot lags, the broadcaster can trace and profile it while it is running, without a restart
+    diagnostics_config = config.get('diagnostics', {})
+    diagnostics = Diagnostics(bot.tracer, diagnostics_config.get('output_dir', 'profiles'))
+    bot.register_handler('diag', DiagnosticsHandler(diagnostics))
+
+    if control_port := diagnostics_config.get('port'):
+        ControlServer(diagnostics, control_port).start()
+
+    if metrics is not None:
+        metrics.serve(metrics_port)
+
+    try:
+        bot.run()
+    finally:
+        # Make sure all deductions reach StreamElements and all light changes reach the Hue bridge before exiting
+        ledger.close()
+        hue_light_handler.close()
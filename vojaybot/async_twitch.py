@@ -0,0 +1,469 @@
+import asyncio
+import contextvars
+import inspect
+import logging
+import time
+from typing import List, Optional, Set
+
+from vojaybot.connection import (
+    JOIN_BATCH_SIZE, LOGIN_TIMEOUT, LoginFailedError, LoginHandshake, join_message, login_message
+)
+from vojaybot.execution import ShedError
+from vojaybot.irc import IrcMessage, parse_message
+from vojaybot.router import Route
+from vojaybot.tracing import Stage
+from vojaybot.twitch import CommandHandler, TwitchBot, _handle_in_process, current_message
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTwitchBot(TwitchBot):
+    """
+    Runs the bot on an asyncio event loop instead of dedicated read and write threads. Every command becomes a
+    task, so hundreds of in-flight commands only cost coroutines instead of blocking threads.
+
+    Handlers implemented with async def handle run directly on the event loop and should only use non-blocking I/O.
+    Synchronous handlers are offloaded automatically to their thread or process pool (see register_handler), so
+    existing handlers keep working unchanged. Inline handlers are called directly by the event loop.
+
+    All channels are joined with a single connection, a single event loop easily keeps up with the traffic of many
+    channels. Lost connections are re-established like with TwitchBot, a standby connection is not supported.
+    """
+
+    def __init__(self, bot_username, channel_name, oauth_token, **kwargs):
+        if kwargs.get('connection_count', 1) != 1:
+            raise ValueError('AsyncTwitchBot uses a single connection for all channels')
+
+        super().__init__(bot_username, channel_name, oauth_token, **kwargs)
+
+        if self._reconnect.standby:
+            raise ValueError('AsyncTwitchBot does not support a standby connection')
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+        # Created by run_async, they belong to its event loop
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connected: Optional[asyncio.Event] = None
+        self._stopped: Optional[asyncio.Event] = None
+
+        self._received_at = 0.0
+        self._reconnect_requested = False
+
+        # The event loop only keeps weak references to tasks, so in-flight commands are referenced here
+        self._tasks: Set[asyncio.Task] = set()
+
+        # Lines received during the login which are not part of it, e.g. chat of an already joined channel
+        self._backlog: List[str] = []
+
+        # Joins the channels which were not joined with the login
+        self._join_task: Optional[asyncio.Task] = None
+
+        self._send_seconds = self._metrics.histogram(
+            'vojaybot_irc_send_seconds', 'Time spent writing chat messages to the socket', ('connection',)
+        ).labels(self.connections[0].name) if self._metrics is not None else None
+
+    def _register_metrics(self, metrics):
+        super()._register_metrics(metrics)
+
+        metrics.callback('vojaybot_commands_in_flight', 'Commands currently being handled', lambda: len(self._tasks))
+
+    def _can_run_inline(self, handler: CommandHandler) -> bool:
+        # Handlers implemented with async def are awaited on the event loop anyway. Wrappers around them are called
+        # like synchronous handlers, asyncio.run would fail within the running event loop.
+        return inspect.iscoroutinefunction(handler.handle) or not handler._uses_coroutines()
+
+    def _send(self, message):
+        self._writer.write(bytes(f'{message}\r\n', 'UTF-8'))
+
+    async def _call_handler(self, handler: CommandHandler, user: str, command: str, args: List[str]) -> bool:
+        if inspect.iscoroutinefunction(handler.handle):
+            return await handler.handle(user, command, args)
+
+        pool, index, _ = execution = self._executions[handler]
+        key = execution.key_of(handler, user, command, args)
+
+        # Synchronous handlers would block the event loop, so they are executed by their pool. The context is
+        # copied, so handlers can still access the current message in the worker thread.
+        if index is None:
+            future = pool.submit(contextvars.copy_context().run, handler.handle, user, command, args, key=key)
+        else:
+            future = pool.submit(_handle_in_process, index, current_message.get(), command, args, key=key)
+
+        if future is None:
+            self._on_rejected(pool, current_message.get(), command)
+            return False
+
+        try:
+            if index is None:
+                return await asyncio.wrap_future(future)
+
+            success, replies = await asyncio.wrap_future(future)
+        except ShedError:
+            # Counted by the pool, the command was never handled
+            return False
+
+        self._queue_replies(handler, replies)
+
+        return success
+
+    async def _dispatch(self, handler: CommandHandler, message: IrcMessage, command: str, args: List[str]):
+        # Every task runs in its own copy of the context, so there is no need to reset the current message
+        current_message.set(message)
+
+        traced = self._tracer.enabled
+        started_at = time.perf_counter() if self._metrics is not None or traced else None
+        result = 'error'
+
+        try:
+            success = await self._call_handler(handler, message.user, command, args)
+            result = 'succeeded' if success else 'failed'
+        except Exception:
+            logger.exception(f'command {command} raised an exception')
+            return
+        finally:
+            if self._metrics is not None:
+                self._command_seconds.labels(command).observe(time.perf_counter() - started_at)
+                self._commands.labels(command, result).inc()
+
+            # Includes waiting for the pool of synchronous handlers
+            if traced:
+                self._tracer.record(Stage.HANDLE, started_at, name=command)
+
+        logger.info('command %s %s', command, result)
+
+    def _handle_async(self, raw_message):
+        if self._metrics is not None:
+            self._messages_received.inc()
+
+        started_at = time.perf_counter() if self._tracer.enabled else None
+
+        try:
+            message = parse_message(raw_message)
+        except ValueError:
+            logger.warning(f'ignoring invalid message {raw_message}')
+            return
+
+        if started_at is not None:
+            self._tracer.record(Stage.PARSE, started_at)
+
+        # Like with TwitchBot, an exception while routing must only cost this line and not end the read loop
+        try:
+            if message.command == 'PING':
+                self._send(f'PONG :{message.text}')
+            elif message.command == 'RECONNECT':
+                self._reconnect_requested = True
+            elif message.command == 'PRIVMSG':
+                if route := self._route(message):
+                    handler, command, args = route
+
+                    if self._executions[handler].pool is None and not inspect.iscoroutinefunction(handler.handle):
+                        self._handle_inline(message, route)
+                        return
+
+                    task = asyncio.create_task(self._dispatch(handler, message, command, args))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        except Exception:
+            logger.exception(f'ignoring message which could not be dispatched: {raw_message}')
+
+    def _handle_inline(self, message: IrcMessage, route: Route):
+        try:
+            if self._metrics is None:
+                self._handle_chat(message, route)
+            else:
+                self._handle_chat_measured(message, route, None)
+        except Exception:
+            logger.exception(f'command {route.command} raised an exception')
+
+    async def _watchdog(self):
+        """
+        Send a PING if nothing was received for a while and close the connection if Twitch does not answer it, a
+        connection can silently die without ever being closed. Runs next to the read loop, so reading a line only
+        costs storing the time it was received.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            idle = loop.time() - self._received_at
+
+            if idle < self._reconnect.ping_interval:
+                await asyncio.sleep(self._reconnect.ping_interval - idle)
+                continue
+
+            pinged_at = loop.time()
+            self._send('PING :tmi.twitch.tv')
+
+            await asyncio.sleep(self._reconnect.pong_timeout)
+
+            if self._received_at < pinged_at:
+                logger.warning(f'connection did not answer PING within {self._reconnect.pong_timeout}s')
+                self._writer.close()
+                return
+
+    async def _read_async(self):
+        """
+        Read until the connection is lost or Twitch asked to reconnect.
+        """
+        loop = asyncio.get_running_loop()
+
+        for line in self._backlog:
+            self._handle_async(line)
+
+        self._backlog.clear()
+        self._received_at = loop.time()
+
+        watchdog = asyncio.create_task(self._watchdog())
+
+        try:
+            while True:
+                started_at = time.perf_counter() if self._tracer.enabled else None
+
+                try:
+                    data = await self._reader.readuntil(b'\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError as e:
+                    logger.warning(f'discarding {e.consumed} bytes, line exceeds the read limit')
+                    await self._reader.readexactly(e.consumed)
+                    continue
+
+                self._received_at = loop.time()
+                logger.debug(data)
+
+                # The StreamReader already split off the line, framing only decodes it
+                if started_at is not None:
+                    received_at = time.perf_counter()
+                    line = data[:-2].decode('UTF-8', 'replace')
+
+                    self._tracer.record(Stage.RECV, started_at, received_at)
+                    self._tracer.record(Stage.FRAME, received_at)
+                else:
+                    line = data[:-2].decode('UTF-8', 'replace')
+
+                if line:
+                    self._handle_async(line)
+
+                if self._reconnect_requested:
+                    self._reconnect_requested = False
+                    logger.info('reconnecting as requested by Twitch')
+                    return
+
+                # Pongs are written while handling the line, give the transport the chance to flush them
+                await self._writer.drain()
+        finally:
+            watchdog.cancel()
+
+        # Unless it was closed by the bot itself, e.g. by stop or the watchdog
+        if not self._writer.is_closing():
+            logger.info('connection closed by Twitch')
+
+    async def _write_async(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            # The scheduler is shared with synchronous handlers running in other threads and blocks until the rate
+            # limit allows to send the next message, so waiting for it is done in the default executor
+            queued = await loop.run_in_executor(None, self.scheduler.get)
+
+            if queued is None:
+                break
+
+            channel, message = queued
+
+            # While the connection is re-established, messages wait instead of being sent to a dead connection
+            await self._connected.wait()
+
+            if self._stopped.is_set():
+                break
+
+            started_at = time.perf_counter()
+
+            try:
+                self._send(f'PRIVMSG #{channel} :{message}')
+                await self._writer.drain()
+            except OSError as e:
+                logger.warning(f'sending to {channel} failed ({e}), the message is sent after reconnecting')
+                self.scheduler.requeue(channel, message)
+
+                self._connected.clear()
+                self._writer.close()
+                continue
+
+            if self._send_seconds is not None:
+                self._send_seconds.observe(time.perf_counter() - started_at)
+
+            if self._tracer.enabled:
+                self._tracer.record(Stage.SEND, started_at)
+
+    async def _sleep(self, seconds: float) -> bool:
+        """
+        Sleep unless the bot is stopped in the meantime.
+
+        :return: False if the bot was stopped
+        """
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            return True
+
+        return False
+
+    async def _await_login(self, handshake: LoginHandshake):
+        while not handshake.done:
+            try:
+                line = (await self._reader.readuntil(b'\r\n'))[:-2].decode('UTF-8', 'replace')
+            except asyncio.IncompleteReadError:
+                raise ConnectionError('connection closed during login') from None
+
+            try:
+                if handshake.handle(parse_message(line)):
+                    continue
+            except ValueError:
+                pass
+
+            self._backlog.append(line)
+
+    async def _wait_for_joins(self, count: int) -> bool:
+        """
+        Wait until count JOINs may be sent, see JoinLimiter.
+
+        :return: False if the bot was stopped
+        """
+        if (delay := self._join_limiter.reserve(count)) <= 0:
+            return True
+
+        logger.info(f'waiting {delay:.1f}s for the JOIN rate limit')
+        return await self._sleep(delay)
+
+    async def _join_later(self, channels: List[str], writer: asyncio.StreamWriter):
+        """
+        Join channels in batches as the JOIN rate limit allows, next to the read loop, which must not wait for it.
+        """
+        for i in range(0, len(channels), JOIN_BATCH_SIZE):
+            batch = channels[i:i + JOIN_BATCH_SIZE]
+
+            if not await self._wait_for_joins(len(batch)):
+                return
+
+            # After a reconnect, the new connection joins all channels by itself
+            if writer is not self._writer or writer.is_closing():
+                return
+
+            writer.write(bytes(f'{join_message(batch)}\r\n', 'UTF-8'))
+
+    async def _connect_async(self, timeout: float = LOGIN_TIMEOUT):
+        first_batch = self._channels[:JOIN_BATCH_SIZE]
+
+        # Like with TwitchConnection.connect, the first batch is joined with the login only if the JOIN limit allows
+        # it right away, reconnects count against the limit as well
+        if not self._join_limiter.try_reserve(len(first_batch)):
+            first_batch = []
+
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(
+            self._server.host,
+            self._server.port,
+            ssl=self._server.create_ssl_context(),
+            limit=64 * 1024
+        ), timeout)
+
+        handshake = LoginHandshake(self._bot_username, first_batch)
+
+        # Login and the first JOIN are sent with a single write, see login_message
+        self._writer.write(login_message(self._oauth_token, self._bot_username, first_batch))
+        await self._writer.drain()
+
+        try:
+            await asyncio.wait_for(self._await_login(handshake), timeout)
+        except asyncio.TimeoutError:
+            if not handshake.welcomed:
+                raise ConnectionError(f'connection was not welcomed within {timeout}s') from None
+
+            logger.warning(f'JOIN of {", ".join(sorted(handshake.pending))} not acknowledged within {timeout}s')
+
+        if remaining := self._channels[len(first_batch):]:
+            # The event loop only keeps a weak reference to the task
+            self._join_task = asyncio.create_task(self._join_later(remaining, self._writer))
+
+    async def _supervise(self):
+        """
+        Read and reconnect with backoff until the bot is stopped or Twitch rejects the login. Expects the bot to be
+        connected before.
+        """
+        attempt = 0
+
+        while not self._stopped.is_set():
+            if not self._connected.is_set():
+                try:
+                    await self._connect_async()
+                except LoginFailedError as e:
+                    logger.error(f'giving up: {e}')
+                    return
+                except (OSError, asyncio.TimeoutError) as e:
+                    if self._writer is not None:
+                        self._writer.close()
+
+                    delay = self._reconnect.backoff(attempt)
+                    attempt += 1
+
+                    logger.warning(f'reconnecting failed ({e}), retrying in {delay:.1f}s')
+                    await self._sleep(delay)
+                    continue
+
+                attempt = 0
+                self._connected.set()
+
+            try:
+                await self._read_async()
+            except OSError as e:
+                if not self._stopped.is_set():
+                    logger.warning(f'connection lost: {e}')
+            finally:
+                self._connected.clear()
+                self._writer.close()
+
+    async def run_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._connected = asyncio.Event()
+        self._stopped = asyncio.Event()
+
+        self._print_handlers()
+        await self._connect_async()
+        self._connected.set()
+
+        self._print_markdown('Twitch connection successful and bot started! `Have fun`!')
+        self._print_markdown('## Log')
+
+        write_task = asyncio.create_task(self._write_async())
+
+        try:
+            await self._supervise()
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+
+            # Wakes up the writer waiting for the scheduler, otherwise its executor thread would block the shutdown
+            self._stop()
+            await write_task
+
+            self._shutdown_pools()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    def _stop(self):
+        self._stopped.set()
+        self.scheduler.close()
+
+        # Wakes up the writer in case it waits for the connection
+        self._connected.set()
+
+        if self._writer is not None:
+            self._writer.close()
+
+    def stop(self):
+        """
+        Close the connection, run returns once all in-flight commands are done. Can be called from any thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop)
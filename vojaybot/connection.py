@@ -0,0 +1,695 @@
+import logging
+import random
+import socket
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, List, NamedTuple, Optional, Tuple
+
+from vojaybot.irc import IrcLineReader, IrcMessage, parse_message
+from vojaybot.metrics import Metrics
+from vojaybot.scheduler import SendScheduler
+from vojaybot.tracing import Stage, Tracer
+
+if TYPE_CHECKING:
+    import ssl
+
+logger = logging.getLogger(__name__)
+
+TWITCH_IRC_HOST = 'irc.chat.twitch.tv'
+TWITCH_IRC_PORT = 6697
+
+# Twitch allows 20 JOIN attempts per 10 seconds per account, no matter how many connections they are spread across,
+# see JoinLimiter
+# See: https://dev.twitch.tv/docs/irc/guide#command--message-limits
+JOIN_BATCH_SIZE = 20
+JOIN_BATCH_PERIOD = 10.0
+
+
+class IrcServer(NamedTuple):
+    """
+    The IRC server the bot connects to, Twitch by default. For load tests the bot can be pointed at a local server,
+    either without TLS or with an ssl_context that trusts its self-signed certificate.
+    """
+    host: str = TWITCH_IRC_HOST
+    port: int = TWITCH_IRC_PORT
+    tls: bool = True
+    ssl_context: Optional['ssl.SSLContext'] = None
+
+    def create_ssl_context(self) -> Optional['ssl.SSLContext']:
+        """
+        :return: SSLContext to wrap the connection with, None if TLS is disabled
+        """
+        if not self.tls:
+            return None
+
+        import ssl
+        return self.ssl_context or ssl.create_default_context()
+
+
+TWITCH_IRC_SERVER = IrcServer()
+
+LOGIN_TIMEOUT = 10.0
+
+
+class ReconnectPolicy(NamedTuple):
+    """
+    How connections recover when Twitch goes away. Lost connections are re-established with exponential backoff and
+    full jitter, so many bots (or connections) that lost their connection at once do not reconnect at once.
+
+    A connection which did not receive anything for ping_interval seconds sends a PING and is considered dead if
+    nothing arrives within pong_timeout seconds, since a connection can silently die without ever being closed.
+
+    With standby, every connection keeps a second, logged in connection without channels in reserve. When Twitch
+    announces a restart with RECONNECT, the connection switches over to it within milliseconds instead of going
+    through a complete reconnect.
+    """
+    initial_backoff: float = 1.0
+    max_backoff: float = 60.0
+    ping_interval: float = 60.0
+    pong_timeout: float = 10.0
+    standby: bool = False
+
+    def backoff(self, attempt: int) -> float:
+        # See: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+
+
+DEFAULT_RECONNECT_POLICY = ReconnectPolicy()
+
+# Seconds after which a standby connection checks if it was taken over
+STANDBY_POLL_INTERVAL = 0.05
+
+
+class LoginFailedError(ConnectionError):
+    """
+    Twitch rejected the login, e.g. because of an invalid oauth token. Reconnecting does not help in that case.
+    """
+    pass
+
+
+def login_message(oauth_token: str, bot_username: str, channels: List[str]) -> bytes:
+    """
+    Everything needed to log in and join the first channels, Twitch handles the commands in order, so they can be
+    sent with a single write instead of waiting in between.
+    """
+    lines = [
+        # Tags add information like user-id or badges to every message
+        'CAP REQ :twitch.tv/tags twitch.tv/commands',
+        f'PASS {oauth_token}',
+        f'NICK {bot_username}',
+    ]
+
+    if channels:
+        lines.append(f'JOIN {",".join(f"#{channel}" for channel in channels)}')
+
+    return bytes(''.join(f'{line}\r\n' for line in lines), 'UTF-8')
+
+
+class LoginHandshake:
+    """
+    Follows the replies to login_message, the login is complete once Twitch welcomed the bot (001) and acknowledged
+    every JOIN. Twitch answers a failed login with a NOTICE before the welcome.
+    """
+
+    def __init__(self, bot_username: str, channels: List[str]):
+        self._bot_username = bot_username.lower()
+        self.pending = set(channels)
+        self.welcomed = False
+
+    @property
+    def done(self) -> bool:
+        return self.welcomed and not self.pending
+
+    def handle(self, message: IrcMessage) -> bool:
+        """
+        :return: True if the message was part of the handshake, False if it has to be handled like any other message
+        """
+        if message.command == '001':
+            self.welcomed = True
+            return True
+
+        if message.command == 'NOTICE' and not self.welcomed:
+            raise LoginFailedError(f'login failed: {message.text}')
+
+        if message.command == 'JOIN' and (message.user or '').lower() == self._bot_username:
+            self.pending.discard(message.channel)
+            return True
+
+        if message.command == 'NOTICE' and message.channel in self.pending:
+            # E.g. the channel is suspended, Twitch will never acknowledge the JOIN
+            logger.warning(f'joining {message.channel} failed: {message.text}')
+            self.pending.discard(message.channel)
+            return True
+
+        return False
+
+
+def join_message(channels: List[str]) -> str:
+    return f'JOIN {",".join(f"#{channel}" for channel in channels)}'
+
+
+class JoinLimiter:
+    """
+    Spaces out the JOINs of all connections of an account, at most size JOINs are sent within any period seconds.
+    A TwitchBot shares one limiter between all of its connections, logins and reconnects included.
+
+    The send times of the latest size JOINs are kept in a ring, a JOIN may be sent period seconds after the JOIN size
+    positions before it. Reserving JOINs only computes when they may be sent, the caller waits for that itself.
+
+    With shared, the ring lives in shared memory and is guarded by a process lock, so the worker processes of
+    run_worker_processes share the limit as well. Monotonic clocks are system-wide on Linux, macOS and Windows.
+    """
+
+    def __init__(self, size: int = JOIN_BATCH_SIZE, period: float = JOIN_BATCH_PERIOD, shared: bool = False):
+        if size < 1:
+            raise ValueError('size must be >= 1')
+
+        self._size = size
+        self._period = period
+
+        if shared:
+            import multiprocessing
+
+            self._lock = multiprocessing.Lock()
+            self._times = multiprocessing.RawArray('d', [float('-inf')] * size)
+            self._head = multiprocessing.RawArray('i', 1)
+        else:
+            self._lock = threading.Lock()
+            self._times = [float('-inf')] * size
+            self._head = [0]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def reserve(self, count: int) -> float:
+        """
+        Reserve count JOINs, which are sent together, e.g. as a single JOIN message with count channels.
+
+        :return: Seconds to wait before sending them
+        """
+        return self._reserve(count, wait=True)
+
+    def try_reserve(self, count: int) -> bool:
+        """
+        Reserve count JOINs only if they may be sent right away.
+
+        :return: False if nothing was reserved
+        """
+        return self._reserve(count, wait=False) is not None
+
+    def _reserve(self, count: int, wait: bool) -> Optional[float]:
+        if not 0 < count <= self._size:
+            raise ValueError(f'count must be between 1 and {self._size}')
+
+        times, size = self._times, self._size
+
+        with self._lock:
+            now = time.monotonic()
+            head = self._head[0]
+
+            # JOINs are sent in the order they were reserved, and the last of them must not be sent before the JOIN
+            # size positions before it left the period
+            at = max(now, times[(head - 1) % size], times[(head + count - 1) % size] + self._period)
+
+            if at > now and not wait:
+                return None
+
+            for i in range(head, head + count):
+                times[i % size] = at
+
+            self._head[0] = (head + count) % size
+
+        return at - now
+
+
+class _Standby:
+    """
+    A logged in connection without channels, kept in reserve by a TwitchConnection. It is kept alive by answering
+    PINGs in a background thread until it is taken over.
+    """
+
+    def __init__(self, name: str, sock: socket.socket, reader: IrcLineReader):
+        self._sock = sock
+        self._reader = reader
+        self._alive = True
+        self._taken = threading.Event()
+
+        # The socket is polled, so the thread notices a take over quickly
+        self._sock.settimeout(STANDBY_POLL_INTERVAL)
+        self._thread = threading.Thread(target=self._keep_alive, name=f'{name}-standby', daemon=True)
+        self._thread.start()
+
+    def _keep_alive(self):
+        while not self._taken.is_set():
+            try:
+                lines = self._reader.read_lines()
+            except socket.timeout:
+                continue
+            except OSError:
+                lines = None
+
+            if lines is None:
+                self._alive = False
+                return
+
+            for line in lines:
+                if line.startswith('PING'):
+                    try:
+                        self._sock.sendall(bytes(f'PONG{line[4:]}\r\n', 'UTF-8'))
+                    except OSError:
+                        self._alive = False
+                        return
+                elif line.endswith(' RECONNECT'):
+                    # The standby is about to be closed by Twitch as well
+                    self._alive = False
+                    return
+
+    def take(self) -> Optional[Tuple[socket.socket, IrcLineReader]]:
+        """
+        Stop keeping the connection alive and hand it over.
+
+        :return: Socket and reader, None if the standby connection died in the meantime
+        """
+        self._taken.set()
+        self._thread.join()
+
+        if not self._alive:
+            self._sock.close()
+            return None
+
+        self._sock.settimeout(None)
+        return self._sock, self._reader
+
+    def close(self):
+        self._taken.set()
+        self._thread.join()
+        self._sock.close()
+
+
+class TwitchConnection:
+    """
+    A single IRC connection to Twitch, joined to one or more channels. Every connection has its own SendScheduler,
+    since the PRIVMSG rate limit applies to each connection. Received lines are passed to on_line together with the
+    connection they were received on, so replies like PONG go back over the same connection.
+
+    read supervises the connection and reconnects according to the ReconnectPolicy, until close is called or Twitch
+    rejects the login. The scheduler outlives the socket, messages queued while the connection is down are sent once
+    it is re-established, and a message that could not be sent is queued again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        bot_username: str,
+        oauth_token: str,
+        channels: List[str],
+        scheduler: SendScheduler,
+        on_line: Callable[['TwitchConnection', str], None],
+        read_size: int = 4096,
+        server: IrcServer = TWITCH_IRC_SERVER,
+        metrics: Optional[Metrics] = None,
+        reconnect: ReconnectPolicy = DEFAULT_RECONNECT_POLICY,
+        tracer: Optional[Tracer] = None,
+        join_limiter: Optional[JoinLimiter] = None
+    ):
+        self._name = name
+        self._bot_username = bot_username
+        self._oauth_token = oauth_token
+        self._channels = channels
+        self._scheduler = scheduler
+        self._on_line = on_line
+        self._read_size = read_size
+        self._server = server
+        self._reconnect = reconnect
+        self._tracer = tracer
+        self._join_limiter = join_limiter if join_limiter is not None else JoinLimiter()
+
+        self._irc: Optional[socket.socket] = None
+        self._reader: Optional[IrcLineReader] = None
+
+        # Lines received during the login which are not part of it, e.g. chat of an already joined channel
+        self._backlog: List[str] = []
+
+        # Sends come from the read thread (e.g. PONG) and the write thread, and the socket is swapped on reconnects
+        self._send_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._closed = threading.Event()
+
+        self._standby: Optional[_Standby] = None
+        self._reconnect_requested = False
+
+        # Incremented whenever another socket is attached, JOINs for an earlier socket are not sent anymore
+        self._generation = 0
+
+        self._send_seconds = metrics.histogram(
+            'vojaybot_irc_send_seconds', 'Time spent writing chat messages to the socket', ('connection',)
+        ).labels(name) if metrics is not None else None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def channels(self) -> List[str]:
+        return self._channels
+
+    @property
+    def scheduler(self) -> SendScheduler:
+        return self._scheduler
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set() and not self._closed.is_set()
+
+    def send(self, message):
+        with self._send_lock:
+            if self._irc is None:
+                raise ConnectionError(f'connection {self._name} is not connected')
+
+            self._irc.sendall(bytes(f'{message}\r\n', 'UTF-8'))
+
+    def send_chat_message(self, channel, message):
+        self.send(f'PRIVMSG #{channel} :{message}')
+
+    def request_reconnect(self):
+        """
+        Called when Twitch sent RECONNECT, the connection switches over once the current lines are handled.
+        """
+        self._reconnect_requested = True
+
+    def _wait_for_joins(self, count: int) -> bool:
+        """
+        Wait until count JOINs may be sent without exceeding the JOIN limit of the account.
+
+        :return: False if the connection was closed in the meantime
+        """
+        if (delay := self._join_limiter.reserve(count)) > 0:
+            logger.info(f'connection {self._name} waits {delay:.1f}s for the JOIN rate limit')
+
+        return not self._closed.wait(delay)
+
+    def _join_later(self, channels: List[str]):
+        """
+        Join channels in batches on a background thread, as the JOIN rate limit allows. The read thread must not wait
+        for the limit, it would stop reading and answering PINGs for JOIN_BATCH_PERIOD seconds per batch.
+        """
+        if not channels:
+            return
+
+        generation = self._generation
+
+        def join():
+            for i in range(0, len(channels), JOIN_BATCH_SIZE):
+                batch = channels[i:i + JOIN_BATCH_SIZE]
+
+                if not self._wait_for_joins(len(batch)):
+                    return
+
+                with self._send_lock:
+                    # After a reconnect, the new socket joins all channels by itself
+                    if self._irc is None or self._generation != generation:
+                        return
+
+                    try:
+                        self._irc.sendall(bytes(f'{join_message(batch)}\r\n', 'UTF-8'))
+                    except OSError as e:
+                        # The read thread notices the lost connection as well and reconnects
+                        logger.warning(f'joining channels on connection {self._name} failed: {e}')
+                        return
+
+        threading.Thread(target=join, name=f'{self._name}-join', daemon=True).start()
+
+    def _open(self, channels: List[str], timeout: float) -> Tuple[socket.socket, IrcLineReader, List[str]]:
+        """
+        Open a new connection, log in and join channels. Returns as soon as Twitch acknowledged the login and the
+        JOINs, instead of waiting a fixed time.
+
+        :return: Socket, its line reader and the lines received during the login which were not part of it
+        """
+        sock = socket.create_connection((self._server.host, self._server.port), timeout)
+
+        try:
+            if (context := self._server.create_ssl_context()) is not None:
+                sock = context.wrap_socket(sock, server_hostname=self._server.host)
+
+            handshake = LoginHandshake(self._bot_username, channels)
+            sock.sendall(login_message(self._oauth_token, self._bot_username, channels))
+
+            # The line reader takes care of lines and UTF-8 characters that are split across multiple chunks
+            reader = IrcLineReader(sock, self._read_size, tracer=self._tracer)
+            backlog = []
+
+            try:
+                while not handshake.done:
+                    if (lines := reader.read_lines()) is None:
+                        raise ConnectionError(f'connection {self._name} closed during login')
+
+                    for line in lines:
+                        try:
+                            if handshake.handle(parse_message(line)):
+                                continue
+                        except ValueError:
+                            pass
+
+                        backlog.append(line)
+            except socket.timeout:
+                if not handshake.welcomed:
+                    raise ConnectionError(f'connection {self._name} was not welcomed within {timeout}s') from None
+
+                logger.warning(f'JOIN of {", ".join(sorted(handshake.pending))} not acknowledged within {timeout}s')
+
+            sock.settimeout(None)
+            return sock, reader, backlog
+        except BaseException:
+            sock.close()
+            raise
+
+    def _attach(self, sock: socket.socket, reader: IrcLineReader, backlog: List[str]):
+        with self._send_lock:
+            previous, self._irc = self._irc, sock
+            self._reader = reader
+            self._backlog.extend(backlog)
+            self._generation += 1
+
+        if previous is not None:
+            previous.close()
+
+        self._connected.set()
+
+    def _warm_standby(self):
+        def warm():
+            try:
+                sock, reader, _ = self._open([], LOGIN_TIMEOUT)
+            except OSError as e:
+                logger.warning(f'standby connection of {self._name} failed: {e}')
+                return
+
+            if self._closed.is_set():
+                sock.close()
+                return
+
+            previous, self._standby = self._standby, _Standby(self._name, sock, reader)
+
+            if previous is not None:
+                previous.close()
+
+        threading.Thread(target=warm, name=f'{self._name}-warm-standby', daemon=True).start()
+
+    def _fail_over(self) -> bool:
+        """
+        Switch to the standby connection.
+
+        :return: False if there is no usable standby connection
+        """
+        standby, self._standby = self._standby, None
+
+        if standby is None or (taken := standby.take()) is None:
+            return False
+
+        sock, reader = taken
+        self._attach(sock, reader, [])
+
+        logger.info(f'connection {self._name} switched to its standby connection')
+
+        # Chat is received as soon as Twitch handled the JOIN, there is no need to wait for the acknowledgement. The
+        # first batch is usually sent right away, unless other connections used up the JOIN limit.
+        self._join_later(self._channels)
+        self._warm_standby()
+
+        return True
+
+    def connect(self, timeout: float = LOGIN_TIMEOUT):
+        """
+        Log in and join all channels.
+        """
+        first_batch = self._channels[:JOIN_BATCH_SIZE]
+
+        # The first batch is joined with the login if the JOIN limit allows it right away. Otherwise, e.g. while other
+        # connections of the bot are joining, all channels are joined in the background, connecting never waits.
+        if not first_batch or not self._join_limiter.try_reserve(len(first_batch)):
+            first_batch = []
+
+        self._attach(*self._open(first_batch, timeout))
+        self._join_later(self._channels[len(first_batch):])
+
+        if self._reconnect.standby:
+            self._warm_standby()
+
+    def _disconnect(self):
+        self._connected.clear()
+
+        with self._send_lock:
+            sock, self._irc = self._irc, None
+
+        if sock is not None:
+            # Closing alone does not wake up a thread blocked in recv
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            sock.close()
+
+    def _connection_lost(self):
+        """
+        Called by the write thread if sending failed, shuts the socket down so the read thread reconnects.
+        """
+        with self._send_lock:
+            if self._irc is not None:
+                try:
+                    self._irc.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _read_lines(self):
+        """
+        Read until the connection is lost or Twitch asked to reconnect and there is no standby connection.
+        """
+        for line in self._backlog:
+            self._on_line(self, line)
+
+        self._backlog.clear()
+
+        # Kept locally, close may reset the attributes at any time from another thread
+        sock, reader = self._irc, self._reader
+
+        awaiting_pong = False
+        sock.settimeout(self._reconnect.ping_interval)
+
+        while True:
+            try:
+                lines = reader.read_lines()
+            except socket.timeout:
+                if awaiting_pong:
+                    logger.warning(f'connection {self._name} did not answer PING within '
+                                   f'{self._reconnect.pong_timeout}s')
+                    return
+
+                # Nothing was received for a while, Twitch has to answer the PING if the connection is still alive
+                self.send('PING :tmi.twitch.tv')
+                awaiting_pong = True
+                sock.settimeout(self._reconnect.pong_timeout)
+                continue
+
+            if lines is None:
+                if not self._closed.is_set():
+                    logger.info(f'connection {self._name} closed by Twitch')
+
+                return
+
+            if awaiting_pong:
+                awaiting_pong = False
+                sock.settimeout(self._reconnect.ping_interval)
+
+            for line in lines:
+                logger.debug(line)
+                self._on_line(self, line)
+
+            if self._reconnect_requested:
+                self._reconnect_requested = False
+
+                if not self._fail_over():
+                    logger.info(f'connection {self._name} reconnects as requested by Twitch')
+                    return
+
+                sock, reader = self._irc, self._reader
+                sock.settimeout(self._reconnect.ping_interval)
+
+    def read(self):
+        """
+        Read and reconnect until the connection is closed. Expects connect to be called before.
+        """
+        attempt = 0
+
+        while not self._closed.is_set():
+            if not self._connected.is_set():
+                try:
+                    self.connect()
+                except LoginFailedError as e:
+                    logger.error(f'connection {self._name} gives up: {e}')
+                    break
+                except OSError as e:
+                    delay = self._reconnect.backoff(attempt)
+                    attempt += 1
+
+                    logger.warning(f'reconnecting {self._name} failed ({e}), retrying in {delay:.1f}s')
+                    self._closed.wait(delay)
+                    continue
+
+                attempt = 0
+
+            try:
+                self._read_lines()
+            except OSError as e:
+                if not self._closed.is_set():
+                    logger.warning(f'connection {self._name} lost: {e}')
+
+            self._disconnect()
+
+        # Nothing can be sent anymore, this also stops the write thread
+        self.close()
+
+    def write(self):
+        # Handlers add their messages to the scheduler, whenever they want to send a message to Twitch. The scheduler
+        # hands them out respecting the rate limit and this function then takes care of actually sending them.
+        while (queued := self._scheduler.get()) is not None:
+            channel, message = queued
+
+            # While the connection is re-established, messages wait instead of being sent to a dead socket
+            self._connected.wait()
+
+            if self._closed.is_set():
+                break
+
+            started_at = time.perf_counter()
+
+            try:
+                self.send_chat_message(channel, message)
+            except OSError as e:
+                logger.warning(f'sending to {channel} failed ({e}), the message is sent after reconnecting')
+                self._scheduler.requeue(channel, message)
+                self._connection_lost()
+                continue
+
+            if self._send_seconds is not None:
+                self._send_seconds.observe(time.perf_counter() - started_at)
+
+            if self._tracer is not None and self._tracer.enabled:
+                self._tracer.record(Stage.SEND, started_at)
+
+    def close(self):
+        """
+        Stop reading and writing, the connection is not re-established anymore.
+        """
+        self._closed.set()
+
+        if self._standby is not None:
+            self._standby.close()
+            self._standby = None
+
+        self._disconnect()
+        self._scheduler.close()
+
+        # Wakes up the write thread in case it waits for the connection
+        self._connected.set()
@@ -0,0 +1,200 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from string import Formatter
+from typing import Callable, Hashable, NamedTuple, Optional
+
+NOTICE_FIELDS = frozenset(('user', 'command', 'remaining'))
+
+
+class Cooldown(NamedTuple):
+    """
+    Minimum seconds between commands, 0 disables a scope. The cooldown of a handler applies to its command, the
+    cooldown of the bot to all commands, e.g. to limit how many commands a single viewer can send at all.
+
+    Example:
+
+    # Every viewer can change the lights once per minute, and nobody more than once per 5 seconds
+    Cooldown(user=60, everyone=5, message='@{user}, !{command} is available again in {remaining}s')
+    """
+    # Commands of the same user
+    user: float = 0.0
+    # Commands in the same channel
+    channel: float = 0.0
+    # Commands of anyone in any channel
+    everyone: float = 0.0
+    # Notice for users who hit the cooldown, with the placeholders {user}, {command} and {remaining} (whole seconds).
+    # Every user gets it at most once per cooldown, so spamming a command does not turn into spamming notices. Other
+    # placeholders are rejected when the cooldown is registered, see compile_notice.
+    message: Optional[str] = None
+
+
+def compile_notice(message: str) -> Callable[[str, str, int], str]:
+    """
+    Check the notice of a Cooldown, so a typo in a placeholder is rejected when the cooldown is registered or a config
+    is loaded, instead of raising an exception once the first user hits the cooldown.
+
+    :return: Function of user, command and remaining seconds which renders the notice
+    """
+    try:
+        parsed = list(Formatter().parse(message))
+    except ValueError as e:
+        raise ValueError(f'invalid cooldown message {message!r}: {e}') from None
+
+    for _, field, spec, _ in parsed:
+        if field is None:
+            continue
+
+        if field not in NOTICE_FIELDS:
+            raise ValueError(
+                f'unknown placeholder {{{field}}} in cooldown message {message!r}, '
+                f'use one of {", ".join(sorted(NOTICE_FIELDS))}'
+            )
+
+        if spec and '{' in spec:
+            raise ValueError(f'nested placeholders are not supported in cooldown message {message!r}')
+
+    # Format specs and conversions are only checked by formatting, with values of the types used later on
+    try:
+        message.format(user='', command='', remaining=0)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'invalid cooldown message {message!r}: {e}') from None
+
+    return lambda user, command, remaining: message.format(user=user, command=command, remaining=remaining)
+
+
+class _ReadyTable(OrderedDict):
+    """
+    Time at which each key is ready again. All entries have the same duration, so keeping them in insertion order
+    also keeps them ordered by expiry. Expired entries are removed from the front whenever a key is added, and at most
+    max_entries keys are kept, the ones which expire first are dropped for more.
+
+    An OrderedDict is used, since removing entries from the front of a plain dict leaves holes that every later
+    look at its first entry has to skip. Checking a key is a plain get, without any Python code in between.
+    """
+
+    def __init__(self, seconds: float, max_entries: int):
+        super().__init__()
+
+        self.seconds = seconds
+        self.max_entries = max_entries
+
+    def remaining(self, key: Hashable, now: float) -> float:
+        return max(0.0, self.get(key, 0.0) - now)
+
+    def start(self, key: Hashable, now: float):
+        # The key moves to the end, where the latest expiries are
+        self[key] = now + self.seconds
+        self.move_to_end(key)
+
+        # At most one key is added per call, so removing at most one keeps up with them
+        oldest = next(iter(self))
+
+        if self[oldest] <= now or len(self) > self.max_entries:
+            del self[oldest]
+
+
+class CooldownTracker:
+    """
+    Enforces a Cooldown before a command is handed to its executor, so commands on cooldown never cost more than
+    looking up when they are ready again: a dict lookup per scope, no lock, no allocation. Only accepted commands
+    take a lock, so two threads can not both pass the same cooldown.
+
+    Memory is bounded by max_entries users and channels per scope.
+    """
+
+    def __init__(self, name: str, cooldown: Cooldown, max_entries: int = 10_000):
+        self._name = name
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+
+        self._users = _ReadyTable(cooldown.user, max_entries) if cooldown.user > 0 else None
+        self._channels = _ReadyTable(cooldown.channel, max_entries) if cooldown.channel > 0 else None
+        self._ready_at = 0.0
+
+        # Users who got a notice are not notified again for the longest of the cooldowns
+        longest = max(cooldown.user, cooldown.channel, cooldown.everyone)
+        self._notified = _ReadyTable(longest, max_entries) if cooldown.message is not None else None
+        self._render_notice = compile_notice(cooldown.message) if cooldown.message is not None else None
+
+        self._rejected = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def cooldown(self) -> Cooldown:
+        return self._cooldown
+
+    @property
+    def rejected(self) -> int:
+        return self._rejected
+
+    def _ready(self, user: str, channel: str, now: float) -> bool:
+        users = self._users
+        channels = self._channels
+
+        return self._ready_at <= now and (users is None or users.get(user, 0.0) <= now) and \
+            (channels is None or channels.get(channel, 0.0) <= now)
+
+    def remaining(self, user: str, channel: str, now: Optional[float] = None) -> float:
+        """
+        :return: Seconds until a command of user in channel is ready again, 0 if it is ready
+        """
+        now = time.monotonic() if now is None else now
+        remaining = max(0.0, self._ready_at - now)
+
+        for table, key in ((self._users, user), (self._channels, channel)):
+            if table is not None:
+                remaining = max(remaining, table.remaining(key, now))
+
+        return remaining
+
+    def acquire(self, user: str, channel: str, now: Optional[float] = None) -> bool:
+        """
+        Start the cooldown of a command, unless it is still on cooldown.
+
+        :return: False if the command is on cooldown and must not be handled
+        """
+        now = time.monotonic() if now is None else now
+
+        if not self._ready(user, channel, now):
+            self._rejected += 1
+            return False
+
+        with self._lock:
+            # Another thread may have started the cooldown in the meantime
+            if not self._ready(user, channel, now):
+                self._rejected += 1
+                return False
+
+            if self._cooldown.everyone > 0:
+                self._ready_at = now + self._cooldown.everyone
+
+            if self._users is not None:
+                self._users.start(user, now)
+
+            if self._channels is not None:
+                self._channels.start(channel, now)
+
+        return True
+
+    def notice(self, user: str, channel: str, command: str, now: Optional[float] = None) -> Optional[str]:
+        """
+        :return: The notice for a user whose command is on cooldown, None if there is none or the user already got it
+        """
+        if self._notified is None:
+            return None
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            if self._notified.get(user, 0.0) > now:
+                return None
+
+            self._notified.start(user, now)
+
+        remaining = math.ceil(self.remaining(user, channel, now))
+        return self._render_notice(user, command, remaining)
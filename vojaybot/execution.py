@@ -0,0 +1,321 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from enum import Enum
+from functools import partial
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+DEFAULT_POOL = 'default'
+PROCESS_POOL = 'process'
+
+
+class ExecutionMode(str, Enum):
+    """
+    Where a handler runs, see TwitchBot.register_handler.
+    """
+    # Directly by the thread reading from Twitch, for handlers which only take microseconds, e.g. static replies
+    INLINE = 'inline'
+    # By a thread pool, for handlers which block on I/O, e.g. HTTP requests
+    THREAD = 'thread'
+    # By a process pool, for CPU bound handlers which would otherwise hold the GIL and slow down everything else
+    PROCESS = 'process'
+
+
+class ExecutionKey(str, Enum):
+    """
+    Commands with the same key are handled one after another in the order they were received, commands with
+    different keys in parallel, see TwitchBot.register_handler.
+    """
+    # Commands of the same user, across all handlers of the pool sharing this key, e.g. everything spending points
+    USER = 'user'
+    # Commands of the same handler, no matter which alias was used
+    COMMAND = 'command'
+    # Commands for the same resource, as returned by CommandHandler.resource_key
+    RESOURCE = 'resource'
+
+
+class OverflowPolicy(str, Enum):
+    """
+    What a bounded queue does when it is full.
+    """
+    # New items are rejected
+    REJECT = 'reject'
+    # The oldest waiting item is dropped to make room, under overload it is the one that is least relevant anyway
+    DROP_OLDEST = 'drop_oldest'
+    # The oldest item with the lowest priority is dropped, unless the new item has an even lower priority. Only
+    # queues with priorities support it, e.g. the SendScheduler.
+    DROP_LOWEST_PRIORITY = 'drop_lowest_priority'
+
+
+class ShedError(Exception):
+    """
+    The call was dropped by its HandlerPool, because it was overloaded, and never ran.
+    """
+    pass
+
+
+def _call_unless_expired(submitted_at: float, max_age: float, fn: Callable, *args):
+    # A module level function, so it can be sent to worker processes as well
+    if time.monotonic() - submitted_at > max_age:
+        raise ShedError(f'waited longer than {max_age}s')
+
+    return fn(*args)
+
+
+# Result, function, arguments and time of submission of a call
+_Task = Tuple[Future, Callable, Tuple[Any, ...], float]
+
+
+class HandlerPool:
+    """
+    A named pool of workers with its own limits. size workers handle commands, up to max_pending further commands
+    wait for a free worker. What happens to further commands is up to the overflow policy, without max_pending,
+    commands wait without limit. Commands which waited longer than max_age seconds are dropped instead of being
+    handled way too late. Dropped commands fail with ShedError.
+
+    Every subsystem (e.g. Hue, StreamElements) can get its own pool, so a slow subsystem only delays its own
+    commands instead of occupying all workers.
+
+    Calls submitted with a key are queued per key, only the first call of every key is handed to the workers and
+    the next one once it is done. Queues are removed as soon as they are empty, so only keys with calls in flight
+    take up memory, no matter how many different keys there ever were.
+    """
+
+    mode = ExecutionMode.THREAD
+
+    def __init__(
+        self,
+        name: str,
+        size: int,
+        max_pending: Optional[int] = None,
+        overflow: OverflowPolicy = OverflowPolicy.REJECT,
+        max_age: Optional[float] = None,
+        busy_message: Optional[str] = None
+    ):
+        """
+        :param overflow: REJECT or DROP_OLDEST, calls waiting for the running call of their key are never dropped
+        :param busy_message: Reply to rejected commands, e.g. '@{user}, the bot is busy, try again later'
+        """
+        if size < 1:
+            raise ValueError('size must be >= 1')
+
+        if overflow is OverflowPolicy.DROP_LOWEST_PRIORITY:
+            raise ValueError('commands have no priority')
+
+        self._name = name
+        self._size = size
+        self._max_pending = max_pending
+        self._overflow = OverflowPolicy(overflow)
+        self._max_age = max_age
+        self._busy_message = busy_message
+
+        # Commands which are handled or waiting, the semaphore is only needed if there is a limit
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size + max_pending) if max_pending is not None else None
+
+        self._rejected = 0
+        self._dropped = 0
+        self._expired = 0
+
+        # Calls handed to the executor in the order they were submitted, only kept to drop the oldest waiting one
+        self._waiting: Deque[Future] = deque()
+
+        # Calls waiting for the running call of the same key, keys without running call have no entry
+        self._keyed: Dict[Hashable, Deque[_Task]] = {}
+
+        # Workers are only started once the pool is actually used
+        self._executor: Optional[Executor] = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def busy_message(self) -> Optional[str]:
+        return self._busy_message
+
+    @property
+    def pending(self) -> int:
+        """
+        Commands waiting for a free worker.
+        """
+        return max(0, self._in_flight - self._size)
+
+    @property
+    def rejected(self) -> int:
+        return self._rejected
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def expired(self) -> int:
+        return self._expired
+
+    @property
+    def keys(self) -> int:
+        """
+        Keys with calls in flight.
+        """
+        return len(self._keyed)
+
+    def _create_executor(self) -> Executor:
+        return ThreadPoolExecutor(self._size, thread_name_prefix=f'{self._name}-pool')
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._create_executor()
+
+        return self._executor
+
+    def _acquire(self) -> bool:
+        if self._slots.acquire(blocking=False):
+            return True
+
+        if self._overflow is not OverflowPolicy.DROP_OLDEST:
+            return False
+
+        while True:
+            try:
+                future = self._waiting.popleft()
+            except IndexError:
+                return False
+
+            # Only calls which did not start yet can be cancelled, cancelling releases their slot right away
+            if future.cancel():
+                self._dropped += 1
+                return self._slots.acquire(blocking=False)
+
+    def submit(self, fn: Callable, *args, key: Optional[Hashable] = None) -> Optional[Future]:
+        """
+        :param key: Calls with the same key run one after another in the order they were submitted
+        :return: Future of the call, None if the pool is at its limit and the call was rejected
+        """
+        if self._slots is not None and not self._acquire():
+            self._rejected += 1
+            return None
+
+        result = Future()
+        task = (result, fn, args, time.monotonic())
+
+        with self._lock:
+            self._in_flight += 1
+
+            if key is not None:
+                if (queue := self._keyed.get(key)) is not None:
+                    queue.append(task)
+                    return result
+
+                self._keyed[key] = deque()
+
+        self._start(key, *task)
+        return result
+
+    def _start(self, key: Optional[Hashable], result: Future, fn: Callable, args: Tuple[Any, ...], submitted_at):
+        if self._max_age is not None:
+            future = self.executor.submit(_call_unless_expired, submitted_at, self._max_age, fn, *args)
+        else:
+            future = self.executor.submit(fn, *args)
+
+        future.add_done_callback(partial(self._finished, key, result))
+
+        if self._overflow is OverflowPolicy.DROP_OLDEST:
+            self._waiting.append(future)
+
+            # Calls which already started can not be dropped anymore
+            while self._waiting and (self._waiting[0].running() or self._waiting[0].done()):
+                self._waiting.popleft()
+
+    def _finished(self, key: Optional[Hashable], result: Future, future: Future):
+        with self._lock:
+            self._in_flight -= 1
+
+        if self._slots is not None:
+            self._slots.release()
+
+        # The result is set before the next call of the key starts, so everything done by callbacks of the result,
+        # e.g. queueing replies, happens in order as well
+        if future.cancelled():
+            result.set_exception(ShedError(f'dropped by pool {self._name} to make room for newer commands'))
+        elif (exception := future.exception()) is not None:
+            if isinstance(exception, ShedError):
+                self._expired += 1
+
+            result.set_exception(exception)
+        else:
+            result.set_result(future.result())
+
+        if key is None:
+            return
+
+        with self._lock:
+            queue = self._keyed[key]
+
+            if not queue:
+                del self._keyed[key]
+                return
+
+            task = queue.popleft()
+
+        self._start(key, *task)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+
+
+class ProcessHandlerPool(HandlerPool):
+    """
+    A pool of worker processes. Objects needed by the workers (e.g. handlers) are registered before the pool is
+    first used and passed to initializer once per worker process, so they are not pickled for every call.
+    """
+
+    mode = ExecutionMode.PROCESS
+
+    def __init__(
+        self,
+        name: str,
+        size: int,
+        max_pending: Optional[int] = None,
+        overflow: OverflowPolicy = OverflowPolicy.REJECT,
+        max_age: Optional[float] = None,
+        busy_message: Optional[str] = None,
+        initializer: Optional[Callable[[Tuple[Any, ...]], None]] = None
+    ):
+        super().__init__(name, size, max_pending, overflow, max_age, busy_message)
+
+        self._initializer = initializer
+        self._objects: List[Any] = []
+
+    def register(self, obj: Any) -> int:
+        """
+        :return: Index of obj in the tuple passed to the initializer
+        """
+        if self._executor is not None:
+            raise RuntimeError(f'pool {self._name} already started, register everything before the bot runs')
+
+        self._objects.append(obj)
+        return len(self._objects) - 1
+
+    def _create_executor(self) -> Executor:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Forking a process with running threads (reader, writer, pools) can leave locks held forever in the child,
+        # so workers are spawned. Registered objects therefore have to be picklable.
+        return ProcessPoolExecutor(
+            self._size,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=self._initializer,
+            initargs=(tuple(self._objects),)
+        )
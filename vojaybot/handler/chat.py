@@ -1,50 +1,231 @@
-from typing import List
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import toml
 
+from vojaybot.cooldown import Cooldown, compile_notice
+from vojaybot.execution import ExecutionMode
+from vojaybot.template import ResponseTemplate
 from vojaybot.twitch import CommandHandler
 
+logger = logging.getLogger(__name__)
+
+
+def create_chat_handlers(handlers, counters: Optional[Dict[str, Iterator[int]]] = None) \
+        -> List[Tuple[str, 'ChatHandler', List[str]]]:
+    """
+    Create chat handlers without registering them, all response templates are compiled, so invalid definitions
+    raise an error before any handler is created.
+
+    :param handlers: Dictionary with handler definitions, see register_chat_handlers
+    :param counters: Counters of {count} placeholders by command, counters of new commands are added to it
+    :return: Tuples of command, handler and aliases
+    """
+    counters = {} if counters is None else counters
+    templates = {}
+
+    for command, meta in handlers.items():
+        if 'response' not in meta:
+            raise ValueError(f'command {command} has no response')
+
+        templates[command] = ResponseTemplate(meta['response'])
+
+    created = []
+
+    for command, template in templates.items():
+        meta = handlers[command]
+        counter = counters.setdefault(command, itertools.count(1)) if 'count' in template.fields else None
+
+        # Either seconds per user or a table with the fields of Cooldown
+        cooldown = meta.get('cooldown')
+
+        if isinstance(cooldown, (int, float)):
+            cooldown = Cooldown(user=cooldown)
+        elif cooldown is not None:
+            try:
+                cooldown = Cooldown(**cooldown)
+            except TypeError as e:
+                raise ValueError(f'invalid cooldown of command {command}: {e}') from None
+
+            if not all(isinstance(seconds, (int, float)) for seconds in cooldown[:3]):
+                raise ValueError(f'cooldowns of command {command} must be seconds')
+
+            if cooldown.message is not None:
+                if not isinstance(cooldown.message, str):
+                    raise ValueError(f'cooldown message of command {command} must be a string')
+
+                compile_notice(cooldown.message)
+
+        created.append((command, ChatHandler(template, counter, cooldown), list(meta.get('aliases', []))))
+
+    return created
+
 
 def register_chat_handlers(handlers, bot):
     """
-    Register a set of chat handlers that respond with a static message. Those messages can have a {user}
-    placeholder and aliases can be defined. The handlers parameter must be a dictionary with the following
+    Register a set of chat handlers that respond with a static message. Those messages can have placeholders, see
+    ResponseTemplate, and aliases can be defined. The handlers parameter must be a dictionary with the following
     format:
 
     {
         "hi": {"aliases": ["hello"], "response": "Hi {user}"},
-        "bye": {"aliases": ["cya"], "response": "Bye {user}"}
+        "bye": {"aliases": ["cya"], "response": "Bye {user}"},
+        "hug": {"aliases": [], "response": "{user} hugs {args[0]}, that is hug number {count}", "cooldown": 60}
     }
 
+    The optional cooldown is either the seconds between commands of the same user or a dictionary with the fields of
+    vojaybot.cooldown.Cooldown.
+
     :param handlers: Dictionary with handler definitions
     :param bot: An instance of vojaybot.twitch.TwitchBot
     :return: None
     """
-    for command, meta in handlers.items():
-        response = meta['response']
-        aliases = meta['aliases']
+    for command, handler, aliases in create_chat_handlers(handlers):
+        bot.register_handler(command, handler, *aliases)
 
-        bot.register_handler(command, ChatHandler(response), *aliases)
 
+def register_chat_handlers_from_toml_config(config, bot, watch: bool = False) -> 'ChatConfigWatcher':
+    """
+    Register the chat handlers of the commands table of a TOML file.
 
-def register_chat_handlers_from_toml_config(config, bot):
-    commands_config = toml.load(config)
-    commands = commands_config['commands']
+    :param watch: Reload the handlers whenever the file changes, while the bot is running
+    :return: The watcher of the file, which can also reload the handlers on demand
+    """
+    watcher = ChatConfigWatcher(config, bot)
+
+    if watch:
+        watcher.start()
+
+    return watcher
 
-    register_chat_handlers(commands, bot)
+
+class ChatConfigWatcher:
+    """
+    Registers the chat handlers of a TOML file and replaces them whenever the file changes, so commands can be
+    added or changed without restarting the bot and losing its connections and queued replies.
+
+    A background thread compares the modification time and size of the file every interval seconds, a stat call
+    which costs next to nothing. Changed files are parsed and compiled on that thread, the new handlers are then
+    swapped in at once with TwitchBot.replace_handlers, so handling commands never waits for a reload. Files with
+    errors, e.g. saved halfway or with an unknown placeholder, are logged and the previous handlers stay active.
+    {count} counters survive reloads.
+    """
+
+    def __init__(self, config, bot, interval: float = 2.0):
+        self._config = config
+        self._bot = bot
+        self._interval = interval
+
+        self._counters: Dict[str, Iterator[int]] = {}
+        self._handlers: List[ChatHandler] = []
+        self._signature: Optional[Tuple[int, int]] = None
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Errors in the initial config are raised, the bot should not start with missing commands
+        self._load()
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._config)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        signature = self._stat()
+        commands = toml.load(self._config).get('commands')
+
+        if commands is None:
+            raise ValueError('there is no commands table')
+
+        created = create_chat_handlers(commands, self._counters)
+
+        self._bot.replace_handlers(self._handlers, created)
+        self._handlers = [handler for _, handler, _ in created]
+        self._signature = signature
+
+        # Counters of removed commands are forgotten, so renaming commands back and forth does not grow them
+        names = {command for command, _, _ in created}
+        self._counters = {command: counter for command, counter in self._counters.items() if command in names}
+
+    def reload(self) -> bool:
+        """
+        Reload the handlers, no matter whether the file changed.
+
+        :return: False if the file could not be loaded and the previous handlers are still active
+        """
+        started_at = time.perf_counter()
+
+        try:
+            self._load()
+        except Exception as e:
+            # The file is only retried once it changes again
+            self._signature = self._stat()
+            logger.error(f'reloading {self._config} failed, keeping the previous commands: {e}')
+            return False
+
+        logger.info(f'reloaded {len(self._handlers)} commands of {self._config} in '
+                    f'{(time.perf_counter() - started_at) * 1000:.1f}ms')
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            if self._stat() != self._signature:
+                self.reload()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='chat-config-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def handlers(self) -> List['ChatHandler']:
+        return self._handlers
 
 
 class ChatHandler(CommandHandler):
 
-    def __init__(self, response: str):
-        self._response = response
+    # Greetings of many viewers at once can be merged, e.g. "Hi a | Hi b"
+    coalesce_replies = True
+
+    # Formatting a static response is cheaper than handing it over to a thread
+    execution_mode = ExecutionMode.INLINE
+
+    def __init__(self, response, counter: Optional[Iterator[int]] = None, cooldown: Optional[Cooldown] = None):
+        """
+        :param response: Response text or a compiled ResponseTemplate
+        :param counter: Source of {count}, e.g. itertools.count(1), shared by handlers that replace each other
+        """
+        self._template = response if isinstance(response, ResponseTemplate) else ResponseTemplate(response)
+        self._counter = counter
+        self.cooldown = cooldown
+
+        # Looked up once, rendering is the only work done per command
+        self._render = self._template.render
+
+        if 'count' in self._template.fields and counter is None:
+            self._counter = itertools.count(1)
 
     def handle(self, user: str, command: str, args: List[str]) -> bool:
-        message = self._response.format(user=user)
+        count = next(self._counter) if self._counter is not None else 0
+        message = self._render(user, self._channel, args, count)
 
         self._send_chat_message(message)
         return True
 
     @property
     def response(self):
-        return self._response
+        return self._template.template
@@ -0,0 +1,24 @@
+from typing import List
+
+from vojaybot.profiler import Diagnostics
+from vojaybot.twitch import CommandHandler
+
+
+class DiagnosticsHandler(CommandHandler):
+    """
+    Lets the broadcaster profile the bot from the chat while it lags, e.g. !diag start and !diag stop, see
+    Diagnostics for the commands. Everybody else is ignored without a reply.
+    """
+
+    def __init__(self, diagnostics: Diagnostics):
+        self._diagnostics = diagnostics
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        message = self._message
+
+        # Without tags, e.g. against a test server, the broadcaster is the user named like the channel
+        if message is None or ('broadcaster' not in message.badges and user != message.channel):
+            return False
+
+        self._send_chat_message(f'@{user}: {self._diagnostics.execute(args[0] if args else "status")}')
+        return True
@@ -1,11 +1,18 @@
 import random
 from typing import List
 
+from vojaybot.execution import ExecutionMode
 from vojaybot.twitch import CommandHandler
 
 
 class DiceHandler(CommandHandler):
 
+    # Dice rolls are short and usually come in waves, so they can be merged, e.g. "@a: 3 | @b: 5 | @c: 1"
+    coalesce_replies = True
+
+    # Replying takes microseconds, so the handler runs directly on the read thread
+    execution_mode = ExecutionMode.INLINE
+
     def handle(self, user: str, command: str, args: List[str]) -> bool:
         self._send_chat_message(f'@{user}: {random.randint(1, 6)}')
         return True
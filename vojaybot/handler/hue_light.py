@@ -1,9 +1,221 @@
-from typing import List, Optional
-
-from phue import Bridge
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
 
+from vojaybot.execution import ExecutionMode
+from vojaybot.metrics import Metrics
+from vojaybot.router import ArgumentGrammar
+from vojaybot.scheduler import MessagePriority
 from vojaybot.twitch import CommandHandler
 
+if TYPE_CHECKING:
+    from phue import Bridge
+
+logger = logging.getLogger(__name__)
+
+
+class HueLightWorker:
+    """
+    Sends light states to the Hue bridge in a background thread, so handlers never wait for the bridge.
+
+    Every light has at most one pending state and new states are merged into it (latest wins), so when chat spams
+    color changes, lights skip intermediate colors instead of falling behind. Switching a light on and changing its
+    color is sent as a single state update. If all lights are set to the same state and a group_id is configured,
+    the whole group is updated with a single request.
+
+    The bridge only handles about 10 light updates and 1 group update per second, the worker never sends more. The
+    thread runs until close is called.
+
+    Submitting returns before the bridge is contacted, failures are only logged unless the caller asks to confirm
+    the change. It then gets a Future per light, which completes with whether the update of the light, including all
+    states merged into it, reached the bridge.
+
+    See: https://developers.meethue.com/develop/application-design-guidance/hue-system-performance/
+    """
+
+    def __init__(
+        self,
+        bridge: 'Bridge',
+        hue_light_ids: List[Union[str, int]],
+        group_id: Optional[Union[str, int]] = None,
+        light_updates_per_second: float = 10.0,
+        group_updates_per_second: float = 1.0,
+        metrics: Optional[Metrics] = None
+    ):
+        self._bridge = bridge
+        self._hue_light_ids = frozenset(hue_light_ids)
+        self._group_id = group_id
+
+        self._light_interval = 1 / light_updates_per_second
+        self._group_interval = 1 / group_updates_per_second
+
+        # Light names are resolved once, phue would request all lights from the bridge for every single update. Names
+        # which could not be resolved are not cached, they are looked up again with the next update of the light.
+        self._resolved_ids: Dict[Union[str, int], int] = {}
+
+        # Pending state per light, in the order the lights were changed first, and the futures of callers waiting for
+        # the update of a light
+        self._pending: OrderedDict[Union[str, int], dict] = OrderedDict()
+        self._waiters: Dict[Union[str, int], List[Future]] = {}
+        self._condition = threading.Condition()
+
+        self._next_light_update = 0.0
+        self._next_group_update = 0.0
+        self._closed = False
+
+        self._update_seconds = metrics.histogram(
+            'vojaybot_hue_update_seconds', 'Duration of Hue bridge updates', ('target', 'result')
+        ) if metrics is not None else None
+
+        if metrics is not None:
+            metrics.callback('vojaybot_hue_pending_lights', 'Lights waiting for an update', lambda: len(self._pending))
+
+        self._thread = threading.Thread(target=self._run, name='hue-light-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, hue_light_ids: List[Union[str, int]], state: dict, confirm: bool = False) -> List[Future]:
+        """
+        Queue a state change, returns immediately.
+
+        :param confirm: Return a Future per light which completes with True once the bridge applied the change, and
+                        with False if updating the light failed
+        :return: The futures if confirm is set, an empty list otherwise
+        """
+        waiters = []
+
+        with self._condition:
+            if self._closed:
+                if confirm:
+                    waiters.append(Future())
+                    waiters[0].set_result(False)
+
+                return waiters
+
+            for hue_light_id in hue_light_ids:
+                # Switching a light off makes every other pending change obsolete
+                if hue_light_id in self._pending and state.get('on') is not False:
+                    self._pending[hue_light_id].update(state)
+                else:
+                    self._pending[hue_light_id] = dict(state)
+
+                if confirm:
+                    waiters.append(Future())
+                    self._waiters.setdefault(hue_light_id, []).append(waiters[-1])
+
+            self._condition.notify()
+
+        return waiters
+
+    def close(self):
+        """
+        Send the pending states and stop the thread, e.g. when the handler is replaced. States submitted afterwards are
+        dropped.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _resolve(self, hue_light_id: Union[str, int]) -> Optional[int]:
+        """
+        :return: The id of the light, None if the bridge does not know a light with that name
+        """
+        if isinstance(hue_light_id, int):
+            return hue_light_id
+
+        light_id = self._resolved_ids.get(hue_light_id)
+
+        if light_id is None:
+            # phue returns False for unknown names
+            light_id = self._bridge.get_light_id_by_name(hue_light_id) or None
+
+            if light_id is not None:
+                self._resolved_ids[hue_light_id] = light_id
+
+        return light_id
+
+    def _is_group_update(self) -> bool:
+        """
+        True if every light waits for the same state, so all of them can be updated with a single group update.
+        """
+        if self._group_id is None or self._pending.keys() != self._hue_light_ids:
+            return False
+
+        states = iter(self._pending.values())
+        state = next(states)
+
+        return all(other == state for other in states)
+
+    def _next_update(self):
+        """
+        Wait until the next update is allowed by the rate limit and take it from the pending states. Waiting is done
+        with the condition, so states submitted in the meantime are merged into the update.
+
+        :return: Tuple of light id (None for a group update), state and the futures waiting for the update, None once
+                 the worker is closed
+        """
+        with self._condition:
+            while True:
+                if not self._pending:
+                    if self._closed:
+                        return None
+
+                    self._condition.wait()
+                    continue
+
+                now = time.monotonic()
+                group = self._is_group_update()
+                next_update = self._next_group_update if group else self._next_light_update
+
+                if now < next_update:
+                    self._condition.wait(next_update - now)
+                    continue
+
+                if group:
+                    state = next(iter(self._pending.values()))
+                    waiters = [waiter for waiters in self._waiters.values() for waiter in waiters]
+                    self._pending.clear()
+                    self._waiters.clear()
+                    self._next_group_update = now + self._group_interval
+
+                    return None, state, waiters
+
+                self._next_light_update = now + self._light_interval
+                hue_light_id, state = self._pending.popitem(last=False)
+
+                return hue_light_id, state, self._waiters.pop(hue_light_id, ())
+
+    def _run(self):
+        while (update := self._next_update()) is not None:
+            hue_light_id, state, waiters = update
+            started_at = time.perf_counter()
+            result = 'error'
+
+            try:
+                if hue_light_id is None:
+                    self._bridge.set_group(self._group_id, state)
+                elif (light_id := self._resolve(hue_light_id)) is None:
+                    raise LookupError(f'the Hue bridge has no light named {hue_light_id!r}')
+                else:
+                    self._bridge.set_light(light_id, state)
+
+                result = 'ok'
+            except Exception:
+                logger.exception(f'updating Hue light {hue_light_id or self._group_id} failed')
+
+            for waiter in waiters:
+                waiter.set_result(result == 'ok')
+
+            if self._update_seconds is not None:
+                target = 'light' if hue_light_id is not None else 'group'
+                self._update_seconds.labels(target, result).observe(time.perf_counter() - started_at)
+
 
 class HueLightHandler(CommandHandler):
 
@@ -22,14 +234,73 @@ class HueLightHandler(CommandHandler):
     STATE_ON_NAMES = ['on', 'an']
     STATE_OFF_NAMES = ['aus', 'off']
 
+    # true -> light on, false -> light off
+    STATES = MappingProxyType({**dict.fromkeys(STATE_ON_NAMES, True), **dict.fromkeys(STATE_OFF_NAMES, False)})
+
     COLOR_COMMAND_ALIASES = ['colors', 'farben']
 
-    def __init__(self, bridge_ip, lights, usage):
-        self._bridge = Bridge(bridge_ip)
+    # Updates are handed over to the HueLightWorker, so handling a command never waits for the bridge. Commands then
+    # succeed before the bridge was contacted, a failed update is only logged. Paid commands should set confirm, which
+    # runs them in a thread, see __init__.
+    execution_mode = ExecutionMode.INLINE
+
+    def __init__(
+        self,
+        bridge_ip,
+        lights,
+        usage,
+        group_id=None,
+        bridge: Optional['Bridge'] = None,
+        metrics: Optional[Metrics] = None,
+        confirm: bool = False,
+        confirm_timeout: float = 10.0
+    ):
+        """
+        :param confirm: Wait until the bridge applied a change and fail the command if it could not be applied, e.g.
+                        when it is paid with a StreamElementsPointsDecorator, which does not charge failed commands.
+                        Commands then wait for the rate limit of the bridge in a thread instead of running inline.
+        :param confirm_timeout: Seconds to wait for the bridge, the command fails afterwards even if the change is
+                                still applied later on
+        """
+        # An already created bridge can be passed instead of bridge_ip, e.g. a stub bridge for load tests
+        if bridge is None:
+            from phue import Bridge
+            bridge = Bridge(bridge_ip)
+
+        self._bridge = bridge
 
         self._lights = lights
         self._usage = usage
 
+        self._confirm = confirm
+        self._confirm_timeout = confirm_timeout
+
+        if confirm:
+            self.execution_mode = ExecutionMode.THREAD
+
+        self._hue_light_ids = tuple(light['hue_light_id'] for light in lights.values())
+
+        lights_by_name = {}
+
+        for key, light in lights.items():
+            for name in (key, *light['aliases']):
+                lights_by_name[name] = light['hue_light_id']
+
+        # Every argument is classified with a single lookup, instead of checking states, colors and light names one
+        # after another
+        self._grammar = ArgumentGrammar(
+            colors_command=dict.fromkeys(self.COLOR_COMMAND_ALIASES),
+            state=self.STATES,
+            color=self.COLORS,
+            light=lights_by_name
+        )
+
+        self._colors = ', '.join(self.COLORS.keys())
+
+        # Light changes are sent to the bridge in the background, handle returns immediately. If group_id is a Hue
+        # group containing exactly the configured lights, changing all lights at once is done with a single request.
+        self._worker = HueLightWorker(self._bridge, list(self._hue_light_ids), group_id, metrics=metrics)
+
     def connect(self):
         """
         If running for the first time, you need to press the Hue bridge button and call this method once.
@@ -37,81 +308,79 @@ class HueLightHandler(CommandHandler):
         """
         self._bridge.connect()
 
-    def _handle_color(self, color_xy, hue_light_ids):
-        for hue_light_id in hue_light_ids:
-            self._bridge.set_light(hue_light_id, 'on', True)
-            self._bridge.set_light(hue_light_id, 'xy', color_xy)
-
-    def _handle_switch(self, on_state, hue_light_ids):
-        for hue_light_id in hue_light_ids:
-            self._bridge.set_light(hue_light_id, 'on', on_state)
-
-    def _get_hue_light_id(self, light_name) -> Optional[str]:
-        for key in self._lights:
-            if light_name == key or light_name in self._lights[key]['aliases']:
-                return self._lights[key]['hue_light_id']
+    def close(self):
+        """
+        Stop the HueLightWorker of this handler, once it is no longer registered, e.g. after a config reload or when
+        the bot stops.
+        """
+        self._worker.close()
 
-        return None
+    def _submit(self, hue_light_ids, state: dict) -> bool:
+        """
+        :return: False if the change was confirmed to fail or not confirmed in time
+        """
+        waiters = self._worker.submit(hue_light_ids, state, self._confirm)
 
-    def _get_hue_light_ids(self):
-        ids = []
+        if not waiters:
+            return True
 
-        for key in self._lights:
-            ids.append(self._lights[key]['hue_light_id'])
+        done, pending = wait(waiters, self._confirm_timeout)
 
-        return ids
+        if pending:
+            logger.warning(f'Hue bridge did not confirm {state} within {self._confirm_timeout}s')
+            return False
 
-    def _get_color(self, name) -> Optional[str]:
-        if name in self.COLORS:
-            return self.COLORS[name]
+        return all(waiter.result() for waiter in done)
 
-        return None
+    def _handle_color(self, color_xy, hue_light_ids) -> bool:
+        return self._submit(hue_light_ids, {'on': True, 'xy': color_xy})
 
-    @staticmethod
-    def _is_valid_state(name):
-        return name in HueLightHandler.STATE_ON_NAMES + HueLightHandler.STATE_OFF_NAMES
+    def _handle_switch(self, on_state, hue_light_ids) -> bool:
+        return self._submit(hue_light_ids, {'on': on_state})
 
-    @staticmethod
-    def _get_state(name):
+    def _handle_light(self, hue_light_id, args: List[str]) -> Optional[bool]:
         """
-        true -> light on
-        false -> light off
+        :return: None if the arguments are invalid
         """
-        return name in HueLightHandler.STATE_ON_NAMES
+        if len(args) < 1 or (match := self._grammar.match(args[0])) is None:
+            return None
+
+        kind, value = match
+
+        # If second argument is a state (e.g. on, off) switch that specific light on or off
+        if kind == 'state':
+            return self._handle_switch(value, [hue_light_id])
+
+        # If second argument is a color (e.g. red) colorize that specific light
+        if kind == 'color':
+            return self._handle_color(value, [hue_light_id])
+
+        return None
 
     def handle(self, user: str, command: str, args: List[str]) -> bool:
         if len(args) < 1:
-            self._send_chat_message(self._usage)
+            self._send_chat_message(self._usage, MessagePriority.ERROR)
             return False
 
-        if args[0] in HueLightHandler.COLOR_COMMAND_ALIASES:
-            self._send_chat_message(f'''@{user}, {', '.join(self.COLORS.keys())}''')
-            return False
+        if match := self._grammar.match(args[0]):
+            kind, value = match
 
-        # If first argument is a state (e.g. on, off), switch all lights on or off
-        if self._is_valid_state(args[0]):
-            state = self._get_state(args[0])
-            self._handle_switch(state, self._get_hue_light_ids())
-            return True
+            if kind == 'colors_command':
+                self._send_chat_message(f'@{user}, {self._colors}')
+                return False
 
-        # If first argument is a color (e.g. red), colorize all lights
-        if color := self._get_color(args[0]):
-            self._handle_color(color, self._get_hue_light_ids())
-            return True
+            # If first argument is a state (e.g. on, off), switch all lights on or off
+            if kind == 'state':
+                return self._handle_switch(value, self._hue_light_ids)
 
-        # If first argument is a Hue light name, only change that specific light
-        if hue_light_id := self._get_hue_light_id(args[0]):
-            # If second argument is a state (e.g. on, off) switch that specific light on or off
-            if self._is_valid_state(args[1]):
-                state = self._get_state(args[1])
-                self._handle_switch(state, [hue_light_id])
-                return True
+            # If first argument is a color (e.g. red), colorize all lights
+            if kind == 'color':
+                return self._handle_color(value, self._hue_light_ids)
 
-            # If second argument is a color (e.g. red) colorize that specific light
-            if color := self._get_color(args[1]):
-                self._handle_color(color, [hue_light_id])
-                return True
+            # If first argument is a Hue light name, only change that specific light
+            if kind == 'light' and (handled := self._handle_light(value, args[1:])) is not None:
+                return handled
 
         # Invalid arguments
-        self._send_chat_message(self._usage)
+        self._send_chat_message(self._usage, MessagePriority.ERROR)
         return False
@@ -0,0 +1,151 @@
+import threading
+import time
+from array import array
+from typing import Dict, List, NamedTuple, Optional
+
+from vojaybot.irc import IrcMessage
+
+
+class HistoryEntry(NamedTuple):
+    message: IrcMessage
+    # Wall clock time the message was received, see time.time
+    received_at: float
+
+    @property
+    def user(self) -> Optional[str]:
+        return self.message.user
+
+    @property
+    def channel(self) -> Optional[str]:
+        return self.message.channel
+
+    @property
+    def text(self) -> str:
+        return self.message.text
+
+
+class ChatHistory:
+    """
+    The most recent chat messages of all channels, e.g. for !quote, !lastseen or repeat detection, shared by all
+    handlers instead of every handler keeping its own lists.
+
+    Messages are kept in a ring of capacity slots, which is allocated once: a list of messages and two arrays with
+    the time each message was received and the slot of the previous message of the same user. Every user with a
+    message in the ring is mapped to the slot of their latest one, so the messages of a user are a chain through
+    the ring, which is followed back for as many messages as requested. Once the latest message of a user is
+    overwritten, the user is removed from the index. Memory therefore only depends on capacity, no matter how many
+    messages or users there are.
+
+    Messages are stored as they were parsed, so recording a message costs a few list and array assignments. Handlers
+    can only read the history, the bot records every chat message before it is routed.
+    """
+
+    def __init__(self, capacity: int = 5000):
+        if capacity < 1:
+            raise ValueError('capacity must be >= 1')
+
+        self._capacity = capacity
+        self._lock = threading.Lock()
+
+        self._messages: List[Optional[IrcMessage]] = [None] * capacity
+        self._users: List[Optional[str]] = [None] * capacity
+        self._received_at = array('d', bytes(8 * capacity))
+
+        # Sequence number of the previous message of the same user, -1 if there is none
+        self._previous = array('q', [-1]) * capacity
+
+        # Sequence number of the latest message of every user in the ring
+        self._latest: Dict[str, int] = {}
+
+        # Sequence number of the next message, the slot of a message is its sequence number modulo capacity
+        self._next = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def __len__(self):
+        return min(self._next, self._capacity)
+
+    def record(self, message: IrcMessage, received_at: Optional[float] = None):
+        """
+        Add a chat message, the oldest one is overwritten once the history is full.
+        """
+        received_at = time.time() if received_at is None else received_at
+        user = message.user
+        latest = self._latest
+
+        with self._lock:
+            sequence = self._next
+            slot = sequence % self._capacity
+
+            # The overwritten message may have been the latest one of its user, then the user leaves the index
+            if (overwritten := self._users[slot]) is not None and latest[overwritten] == sequence - self._capacity:
+                del latest[overwritten]
+
+            self._messages[slot] = message
+            self._users[slot] = user
+            self._received_at[slot] = received_at
+            self._previous[slot] = latest.get(user, -1)
+            latest[user] = sequence
+            self._next = sequence + 1
+
+    def _entry(self, sequence: int) -> HistoryEntry:
+        slot = sequence % self._capacity
+        return HistoryEntry(self._messages[slot], self._received_at[slot])
+
+    def last_seen(self, user: str) -> Optional[float]:
+        """
+        :return: Wall clock time of the latest message of user, None if the user has no message in the history
+        """
+        user = user.lower()
+
+        with self._lock:
+            if (sequence := self._latest.get(user)) is None:
+                return None
+
+            return self._received_at[sequence % self._capacity]
+
+    def last_messages(self, user: str, count: int = 1) -> List[HistoryEntry]:
+        """
+        :return: Up to count latest messages of user, the latest one first
+        """
+        user = user.lower()
+        entries = []
+
+        with self._lock:
+            sequence = self._latest.get(user, -1)
+
+            # Previous messages which were already overwritten are older than the oldest one in the ring
+            while sequence >= 0 and sequence >= self._next - self._capacity and len(entries) < count:
+                entries.append(self._entry(sequence))
+                sequence = self._previous[sequence % self._capacity]
+
+        return entries
+
+    def recent(self, count: int = 10, channel: Optional[str] = None) -> List[HistoryEntry]:
+        """
+        :param channel: Only messages of this channel, which means looking at up to all messages in the history
+        :return: Up to count latest messages, the latest one first
+        """
+        channel = channel.lower().lstrip('#') if channel is not None else None
+        entries = []
+
+        with self._lock:
+            sequence = self._next - 1
+            oldest = max(0, self._next - self._capacity)
+
+            while sequence >= oldest and len(entries) < count:
+                if channel is None or self._messages[sequence % self._capacity].channel == channel:
+                    entries.append(self._entry(sequence))
+
+                sequence -= 1
+
+        return entries
+
+    def users(self) -> List[str]:
+        """
+        :return: Users with messages in the history, the one who wrote most recently first
+        """
+        with self._lock:
+            return sorted(self._latest, key=self._latest.__getitem__, reverse=True)
@@ -0,0 +1,341 @@
+import logging
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from vojaybot.tracing import Stage, Tracer
+
+logger = logging.getLogger(__name__)
+
+CRLF = b'\r\n'
+
+
+class IrcLineReader:
+    """
+    Frames the raw byte stream of an IRC connection into complete lines.
+
+    Data is received with recv_into into a single reusable bytearray, so no intermediate bytes objects are created
+    per chunk. The buffer is scanned for CRLF and each complete line is decoded exactly once, directly from a
+    memoryview of the buffer. Incomplete lines (and incomplete UTF-8 sequences) simply stay in the buffer until the
+    next chunk arrives, so lines crossing chunk boundaries are never broken apart.
+
+    The buffer grows if a single line is longer than the current buffer, up to max_line_length bytes. Longer lines
+    are discarded, since Twitch never sends them and they would otherwise grow the buffer without limit.
+    """
+
+    def __init__(self, sock, read_size: int = 4096, max_line_length: int = 64 * 1024, tracer: Optional[Tracer] = None):
+        if read_size < 1:
+            raise ValueError('read_size must be >= 1')
+
+        self._sock = sock
+        self._tracer = tracer
+        self._read_size = read_size
+        self._max_line_length = max_line_length
+
+        self._buffer = bytearray(read_size * 2)
+        self._view = memoryview(self._buffer)
+
+        # Bytes in self._buffer[self._start:self._end] are received but not yet framed
+        self._start = 0
+        self._end = 0
+
+        # Set while the remainder of an oversized line is skipped
+        self._discarding = False
+
+    def _compact(self):
+        """
+        Move pending bytes to the front of the buffer and make sure there is room for at least read_size more bytes.
+        """
+        pending = self._end - self._start
+
+        if self._start:
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        if len(self._buffer) - self._end >= self._read_size:
+            return
+
+        if pending > self._max_line_length:
+            logger.warning(f'discarding line, it exceeds {self._max_line_length} bytes')
+            self._start = self._end = 0
+            self._discarding = True
+            return
+
+        # The memoryview must be released before a new buffer can replace the old one
+        self._view.release()
+        buffer = bytearray(max(len(self._buffer) * 2, pending + self._read_size))
+        buffer[:pending] = self._buffer[:pending]
+
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+
+    def _frame(self) -> List[str]:
+        start = self._start
+        last = self._buffer.rfind(CRLF, start, self._end)
+
+        if last == -1:
+            return []
+
+        self._start = last + 2
+
+        # Everything up to the last CRLF consists of complete lines, and a CRLF can never be part of a multi byte
+        # UTF-8 character. So all complete lines are decoded at once, directly from the memoryview without copying
+        # them into a bytes object first. A single invalid byte must never take the read loop down, so it is
+        # replaced instead of raising.
+        lines = str(self._view[start:last], 'UTF-8', 'replace').split('\r\n')
+
+        if self._discarding:
+            self._discarding = False
+            del lines[0]
+
+        return lines
+
+    def fill(self) -> int:
+        """
+        Receive the next chunk from the socket into the buffer.
+
+        :return: Number of bytes received, 0 means the connection was closed
+        """
+        self._compact()
+
+        received = self._sock.recv_into(self._view[self._end:], self._read_size)
+        self._end += received
+
+        return received
+
+    def read_lines(self) -> Optional[List[str]]:
+        """
+        Receive the next chunk from the socket.
+
+        :return: All lines completed by the chunk, which might be none, or None if the connection was closed
+        """
+        if (tracer := self._tracer) is not None and tracer.enabled:
+            started_at = time.perf_counter()
+
+            if not self.fill():
+                return None
+
+            received_at = time.perf_counter()
+            lines = [line for line in self._frame() if line]
+
+            tracer.record(Stage.RECV, started_at, received_at)
+            tracer.record(Stage.FRAME, received_at)
+            return lines
+
+        if not self.fill():
+            return None
+
+        return [line for line in self._frame() if line]
+
+    def lines(self) -> Iterator[str]:
+        """
+        Yield every complete line received from the socket, blocks until the connection is closed.
+        """
+        while self.fill():
+            for line in self._frame():
+                if line:
+                    yield line
+
+
+# See: https://ircv3.net/specs/extensions/message-tags#escaping-values
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def _unescape_tag_value(value: str) -> str:
+    chars = []
+    escaped = False
+
+    for char in value:
+        if escaped:
+            chars.append(TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+
+    return ''.join(chars)
+
+
+def _parse_tags(raw_tags: str) -> Dict[str, str]:
+    tags = {}
+
+    for tag in raw_tags.split(';'):
+        key, _, value = tag.partition('=')
+        tags[key] = _unescape_tag_value(value) if '\\' in value else value
+
+    return tags
+
+
+class IrcMessage:
+    """
+    A single parsed IRC message including its IRCv3 tags. Twitch only sends tags if the twitch.tv/tags capability
+    was requested, otherwise tags is an empty dictionary.
+
+    Messages are created once per received line and handed down the whole dispatch path, so the convenience
+    properties are computed lazily from the raw components and only if they are actually used.
+    """
+
+    __slots__ = ('raw_tags', 'prefix', 'command', 'params', 'trailing', 'duplicates', '_tags')
+
+    def __init__(self, raw_tags: Optional[str], prefix: Optional[str], command: str, params: Tuple[str, ...],
+                 trailing: Optional[str]):
+        self.raw_tags = raw_tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+
+        # Similar messages before this one, set by a DuplicateFilter if the bot runs one, see vojaybot.spam
+        self.duplicates = 0
+
+        self._tags = None
+
+    @property
+    def tags(self) -> Dict[str, str]:
+        """
+        Unescaped IRCv3 tags. Tags make up most of a Twitch line, so they are only split up on first access.
+        """
+        if self._tags is None:
+            self._tags = _parse_tags(self.raw_tags) if self.raw_tags else {}
+
+        return self._tags
+
+    def tag(self, key: str) -> Optional[str]:
+        """
+        Value of a single tag. Until all tags were split up, the raw tags are searched directly, which is a lot
+        cheaper if a handler only needs one or two of them.
+        """
+        if self._tags is not None or not self.raw_tags:
+            return self.tags.get(key)
+
+        raw_tags = self.raw_tags
+
+        if raw_tags.startswith(f'{key}='):
+            start = 0
+        elif (start := raw_tags.find(f';{key}=')) != -1:
+            start += 1
+        else:
+            return None
+
+        start += len(key) + 1
+        end = raw_tags.find(';', start)
+        value = raw_tags[start:] if end == -1 else raw_tags[start:end]
+
+        return _unescape_tag_value(value) if '\\' in value else value
+
+    @property
+    def user(self) -> Optional[str]:
+        """
+        Nickname part of the prefix, e.g. vojay for :vojay!vojay@vojay.tmi.twitch.tv
+        """
+        if self.prefix is None:
+            return None
+
+        return self.prefix.partition('!')[0]
+
+    @property
+    def channel(self) -> Optional[str]:
+        """
+        Channel name without leading #, if the first parameter is a channel.
+        """
+        if self.params and self.params[0].startswith('#'):
+            return self.params[0][1:]
+
+        return None
+
+    @property
+    def text(self) -> str:
+        return self.trailing or ''
+
+    @property
+    def user_id(self) -> Optional[str]:
+        return self.tag('user-id')
+
+    @property
+    def msg_id(self) -> Optional[str]:
+        return self.tag('id')
+
+    @property
+    def badges(self) -> Dict[str, str]:
+        """
+        Badges of the sender, e.g. {'broadcaster': '1', 'subscriber': '12'}
+        """
+        badges = self.tag('badges')
+
+        if not badges:
+            return {}
+
+        return dict(badge.partition('/')[::2] for badge in badges.split(','))
+
+    @property
+    def emotes(self) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Emote ids mapped to the character ranges they are used at in text, e.g. {'25': [(0, 4)]}
+        """
+        emotes = self.tag('emotes')
+
+        if not emotes:
+            return {}
+
+        result = {}
+
+        for emote in emotes.split('/'):
+            emote_id, _, positions = emote.partition(':')
+            ranges = (position.partition('-') for position in positions.split(','))
+            result[emote_id] = [(int(start), int(end)) for start, _, end in ranges]
+
+        return result
+
+    def __repr__(self):
+        return f'IrcMessage(command={self.command!r}, user={self.user!r}, channel={self.channel!r}, ' \
+               f'text={self.trailing!r})'
+
+
+def parse_message(line: str) -> IrcMessage:
+    """
+    Parse a single IRC line in one left-to-right scan.
+
+    See: https://ircv3.net/specs/extensions/message-tags and https://tools.ietf.org/html/rfc1459#section-2.3.1
+
+    :param line: A line as received from the server, without CRLF
+    :return: The parsed message
+    :raises ValueError: If the line does not contain a command
+    """
+    raw_tags = None
+    prefix = None
+    position = 0
+
+    if line.startswith('@'):
+        position = line.find(' ')
+
+        if position == -1:
+            raise ValueError(f'invalid IRC message: {line}')
+
+        raw_tags = line[1:position]
+        position += 1
+
+    if line.startswith(':', position):
+        end = line.find(' ', position)
+
+        if end == -1:
+            raise ValueError(f'invalid IRC message: {line}')
+
+        prefix = line[position + 1:end]
+        position = end + 1
+
+    trailing_start = line.find(' :', position)
+
+    if trailing_start == -1:
+        middle = line[position:]
+        trailing = None
+    else:
+        middle = line[position:trailing_start]
+        trailing = line[trailing_start + 2:]
+
+    components = middle.split()
+
+    if not components:
+        raise ValueError(f'invalid IRC message: {line}')
+
+    return IrcMessage(raw_tags, prefix, components[0], tuple(components[1:]), trailing)
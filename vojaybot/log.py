@@ -0,0 +1,194 @@
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Deque, Iterable, List, Optional
+
+from vojaybot.metrics import Metrics
+
+# Every chat message is logged with this logger, so it can be sampled, rate limited or silenced on its own
+CHAT_LOGGER = 'vojaybot.chat'
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue for the QueueListener, records are dropped if the queue is full instead of
+    blocking the thread that logs.
+
+    Unlike the default QueueHandler, records are not formatted before they are queued. They never leave the process,
+    so formatting (e.g. str of an IrcMessage) is left to the listener thread. Only pass arguments to log calls which
+    are not modified afterwards.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ChatLogFilter(logging.Filter):
+    """
+    Samples and rate limits the chat log. sample_rate is the share of chat messages that is logged, max_per_second
+    caps the logged chat messages with a token bucket. The number of suppressed messages is added to the next chat
+    message that is logged.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, max_per_second: Optional[float] = None):
+        super().__init__()
+
+        self._sample_rate = sample_rate
+        self._max_per_second = max_per_second
+
+        self._tokens = max_per_second or 0.0
+        self._refilled_at = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def _allowed(self) -> bool:
+        if self._sample_rate < 1.0 and random.random() >= self._sample_rate:
+            return False
+
+        if self._max_per_second is None:
+            return True
+
+        now = time.monotonic()
+        self._tokens = min(self._max_per_second, self._tokens + (now - self._refilled_at) * self._max_per_second)
+        self._refilled_at = now
+
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        with self._lock:
+            if not self._allowed():
+                self._suppressed += 1
+                return False
+
+            suppressed, self._suppressed = self._suppressed, 0
+
+        if suppressed:
+            record.msg = '%s (%d chat messages suppressed)'
+            record.args = (record.getMessage(), suppressed)
+
+        return True
+
+
+class LogRingHandler(logging.Handler):
+    """
+    Keeps the last capacity formatted log lines in memory, e.g. to show recent log output on demand. Unlike a
+    recording Console, memory does not grow with the length of the stream.
+    """
+
+    def __init__(self, capacity: int = 1000):
+        super().__init__()
+        self._lines: Deque[str] = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self._lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def lines(self) -> List[str]:
+        return list(self._lines)
+
+
+def create_console(banner: bool = True):
+    """
+    Create the rich Console the bot prints to. Output is not recorded, a recording console keeps everything that was
+    ever printed in memory.
+    """
+    from rich.console import Console
+    from rich.markdown import Markdown
+
+    console = Console(color_system='windows')
+
+    if banner:
+        console.print(Markdown('# Vojay Bot'))
+
+    return console
+
+
+def setup_logging(
+    console,
+    level: int = logging.INFO,
+    queued: bool = True,
+    queue_size: int = 10_000,
+    handlers: Iterable[logging.Handler] = (),
+    metrics: Optional[Metrics] = None
+) -> Optional[QueueListener]:
+    """
+    Log to the rich console. If queued, threads logging something only put the record on a queue and a background
+    thread renders it, so slow terminal output never blocks reading or handling messages. If more records are
+    logged than the console keeps up with, the oldest records stay and new ones are dropped once queue_size records
+    are waiting.
+
+    :param console: rich Console to log to
+    :param handlers: Additional handlers, e.g. a LogRingHandler
+    :param metrics: Counts dropped records, if given
+    :return: The started QueueListener or None if not queued
+    """
+    from rich.logging import RichHandler
+
+    rich_handler = RichHandler(console=console)
+    handlers = [rich_handler, *handlers]
+
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter('%(message)s', datefmt='[%X]'))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    if not queued:
+        for handler in handlers:
+            root.addHandler(handler)
+
+        return None
+
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    # Records which are still queued are written before the interpreter exits
+    atexit.register(listener.stop)
+
+    root.addHandler(queue_handler)
+
+    if metrics is not None:
+        metrics.callback(
+            'vojaybot_log_records_dropped_total', 'Log records dropped because the log queue was full',
+            lambda: queue_handler.dropped, kind='counter'
+        )
+
+    return listener
+
+
+def configure_chat_log(sample_rate: float = 1.0, max_per_second: Optional[float] = None, enabled: bool = True):
+    """
+    Sample or rate limit the chat log, see ChatLogFilter. With enabled=False chat messages are not logged at all,
+    commands and everything else still are.
+    """
+    chat_logger = logging.getLogger(CHAT_LOGGER)
+
+    for log_filter in [log_filter for log_filter in chat_logger.filters if isinstance(log_filter, ChatLogFilter)]:
+        chat_logger.removeFilter(log_filter)
+
+    chat_logger.disabled = not enabled
+
+    if sample_rate < 1.0 or max_per_second is not None:
+        chat_logger.addFilter(ChatLogFilter(sample_rate, max_per_second))
@@ -0,0 +1,285 @@
+import bisect
+import logging
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from sub millisecond command handling to slow HTTP requests
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+
+class HistogramSnapshot(NamedTuple):
+    # Cumulative count of observations per upper bound, the last bound is infinity
+    buckets: Tuple[Tuple[float, int], ...]
+    count: int
+    sum: float
+
+
+class Counter:
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self) -> float:
+        return self._value
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets. An observation is a binary search and an increment, no samples are stored.
+    """
+    __slots__ = ('_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, bounds: Sequence[float]):
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self._bounds, value)
+
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self) -> HistogramSnapshot:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        buckets = []
+        cumulative = 0
+
+        for bound, count in zip((*self._bounds, float('inf')), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+
+        return HistogramSnapshot(tuple(buckets), cumulative, total)
+
+
+class MetricFamily:
+    """
+    All series of a metric, one per combination of label values. Series are created on first use, look them up once
+    and keep them where possible, e.g. family.labels('dice').
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        label_names: Sequence[str] = (),
+        factory: Optional[Callable[[], Union[Counter, Histogram]]] = None,
+        callback: Optional[Callable[[], Union[float, Mapping[LabelValues, float]]]] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.label_names = tuple(label_names)
+
+        self._factory = factory
+        self._callback = callback
+        self._series: Dict[LabelValues, Union[Counter, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> Union[Counter, Histogram]:
+        series = self._series.get(values)
+
+        if series is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name} expects labels {self.label_names}, got {values}')
+
+            with self._lock:
+                series = self._series.setdefault(values, self._factory())
+
+        return series
+
+    def snapshot(self) -> Dict[LabelValues, Union[float, HistogramSnapshot]]:
+        if self._callback is not None:
+            try:
+                value = self._callback()
+            except Exception:
+                logger.exception(f'collecting {self.name} failed')
+                return {}
+
+            return dict(value) if isinstance(value, Mapping) else {(): value}
+
+        with self._lock:
+            series = list(self._series.items())
+
+        return {values: metric.snapshot() for values, metric in series}
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    labels = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f'{{{labels}}}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Registry of all metrics of a bot. Metrics are disabled by default, pass a Metrics instance to TwitchBot and the
+    clients to enable them. Without it, the hot paths only check for None.
+
+    Counters and histograms are updated where things happen. Queue depths and backlogs are gauges backed by callbacks,
+    which are only called when metrics are collected, so they cost nothing per message.
+
+    Example:
+
+    metrics = Metrics()
+    bot = TwitchBot(bot_username, channel_name, oauth_token, metrics=metrics)
+    metrics.serve(9090)  # curl http://127.0.0.1:9090/metrics
+    """
+
+    def __init__(self):
+        self._families: Dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, family: MetricFamily) -> MetricFamily:
+        with self._lock:
+            registered = self._families.get(family.name)
+
+            if registered is None:
+                self._families[family.name] = family
+                return family
+
+        # Multiple clients or connections may share a metric, as long as it is the same kind of metric
+        if registered.kind != family.kind or registered.label_names != family.label_names:
+            raise ValueError(f'{family.name} is already registered as a different metric')
+
+        return registered
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> MetricFamily:
+        return self._register(MetricFamily(name, documentation, 'counter', label_names, factory=Counter))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> MetricFamily:
+        return self._register(MetricFamily(
+            name, documentation, 'histogram', label_names, factory=lambda: Histogram(buckets)
+        ))
+
+    def callback(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Union[float, Mapping[LabelValues, float]]],
+        label_names: Sequence[str] = (),
+        kind: str = 'gauge'
+    ) -> MetricFamily:
+        """
+        Register a metric whose value is read when metrics are collected.
+
+        :param callback: Returns the value, or a mapping of label values to value if there are label_names
+        :param kind: gauge, or counter for totals that are already counted somewhere else
+        """
+        with self._lock:
+            # Callbacks are replaced, e.g. when a bot is created again
+            family = MetricFamily(name, documentation, kind, label_names, callback=callback)
+            self._families[name] = family
+
+        return family
+
+    def snapshot(self) -> Dict[str, Dict[LabelValues, Union[float, HistogramSnapshot]]]:
+        """
+        Current value of every series, by metric name and label values.
+        """
+        with self._lock:
+            families = list(self._families.values())
+
+        return {family.name: family.snapshot() for family in families}
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            families = list(self._families.values())
+
+        lines: List[str] = []
+
+        for family in families:
+            lines.append(f'# HELP {family.name} {_escape(family.documentation)}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+
+            for values, value in family.snapshot().items():
+                if isinstance(value, HistogramSnapshot):
+                    for bound, count in value.buckets:
+                        labels = _format_labels((*family.label_names, 'le'), (*values, _format_value(bound)))
+                        lines.append(f'{family.name}_bucket{labels} {count}')
+
+                    labels = _format_labels(family.label_names, values)
+                    lines.append(f'{family.name}_sum{labels} {_format_value(value.sum)}')
+                    lines.append(f'{family.name}_count{labels} {value.count}')
+                else:
+                    lines.append(f'{family.name}{_format_labels(family.label_names, values)} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9090, host: str = '127.0.0.1') -> 'ThreadingHTTPServer':
+        """
+        Serve the metrics in the Prometheus text format on http://host:port/metrics in a background thread. Only
+        local connections are accepted by default.
+
+        :return: The server, call shutdown to stop it
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                data = metrics.render().encode('UTF-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        server.daemon_threads = True
+
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info(f'serving metrics on http://{host}:{server.server_address[1]}/metrics')
+
+        return server
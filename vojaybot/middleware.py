@@ -0,0 +1,267 @@
+import contextvars
+import logging
+import threading
+import types
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from vojaybot.execution import ExecutionKey
+from vojaybot.irc import IrcMessage
+from vojaybot.scheduler import MessagePriority
+from vojaybot.twitch import CommandHandler, CommandHandlerWrapper, call_handler, is_coroutine_function
+
+logger = logging.getLogger(__name__)
+
+# Blocking checks of all pipelines share one pool and post-actions another one, so a backlog of post-actions never
+# delays the checks of new commands
+CHECK_THREADS = 8
+AFTER_THREADS = 4
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def _executor(name: str, size: int) -> ThreadPoolExecutor:
+    # Created on first use, so pipelines can be sent to worker processes and only start threads where they run
+    if (executor := _executors.get(name)) is None:
+        with _executors_lock:
+            if (executor := _executors.get(name)) is None:
+                executor = _executors[name] = ThreadPoolExecutor(size, thread_name_prefix=f'middleware-{name}')
+
+    return executor
+
+
+def _submit(executor: ThreadPoolExecutor, function: Callable, *args) -> Future:
+    # Replies are sent to the channel of current_message, which has to be set in the other thread as well. Every call
+    # gets its own copy, a context can not be entered by two threads at once.
+    return executor.submit(contextvars.copy_context().run, _call, function, *args)
+
+
+def _call(function: Callable, *args) -> Any:
+    result = function(*args)
+
+    # Middleware can be implemented with async def as well, like handlers, see call_handler. Pipelines with such
+    # middleware can not run inline, see MiddlewarePipeline._uses_coroutines
+    if isinstance(result, types.CoroutineType):
+        import asyncio
+        return asyncio.run(result)
+
+    return result
+
+
+class CommandContext:
+    """
+    A single command passing through a MiddlewarePipeline. Middleware keep what a check found out for the later
+    stages of the same command in values, e.g. the balance of the user.
+    """
+
+    __slots__ = ('user', 'command', 'args', 'message', 'values', '_send')
+
+    def __init__(
+        self,
+        user: str,
+        command: str,
+        args: List[str],
+        message: Optional[IrcMessage],
+        send: Callable[[str, MessagePriority], None]
+    ):
+        self.user = user
+        self.command = command
+        self.args = args
+        self.message = message
+        self.values: Dict[Any, Any] = {}
+        self._send = send
+
+    def reply(self, message: str, priority: MessagePriority = MessagePriority.NORMAL):
+        """
+        Send a message to the channel the command was sent in.
+        """
+        self._send(message, priority)
+
+
+class Middleware:
+    """
+    A stage of a MiddlewarePipeline. Every method can also be implemented with async def.
+
+    check decides whether the command is handled, rollback undoes what a passed check did if the command is not
+    handled or fails after all, and after runs once the command succeeded.
+    """
+
+    # Checks which wait for I/O, e.g. HTTP requests. They run concurrently with the other blocking checks of the same
+    # command. Checks which only look at memory or tags run right away, before any blocking check is started.
+    blocking = True
+
+    # Whether after runs once the handler returned, the bot does not wait for it then. Post-actions of a pipeline
+    # run in the background one after another, in the order of the middleware.
+    background = True
+
+    # Commands with the same key are handled in order, see ExecutionKey. The pipeline uses the first key any of its
+    # middleware asks for.
+    execution_key: Optional[ExecutionKey] = None
+
+    def check(self, context: CommandContext) -> bool:
+        return True
+
+    def rollback(self, context: CommandContext):
+        pass
+
+    def after(self, context: CommandContext) -> bool:
+        return True
+
+
+class MiddlewarePipeline(CommandHandlerWrapper):
+    """
+    Wraps a handler with a list of Middleware, instead of nesting one CommandHandlerDecorator per concern.
+
+    Non-blocking checks run first, in order. Then all blocking checks start at once, so a command waits for the
+    slowest of them instead of all of them. The first check which fails ends the wait, checks which did not start
+    yet are cancelled and checks which passed or pass later are rolled back. Middleware therefore must not depend on
+    each other's checks. If all of them pass, the handler is called. If it fails, all checks are rolled back,
+    otherwise the post-actions run.
+
+    Example:
+
+    # The subscriber check only looks at tags and runs first, the follower and the points check both query an API
+    # and run at the same time
+    MiddlewarePipeline(
+        HueLightHandler(...), [SubscriberOnly(), FollowerCheck(...), StreamElementsPointsMiddleware(...)]
+    )
+
+    Post-actions that run in the background can not send replies from a worker process, since a ProcessHandlerPool
+    only sends the replies of a command once its handler returned.
+    """
+
+    def __init__(self, handler: CommandHandler, middleware: Sequence[Middleware]):
+        super().__init__(handler)
+
+        self._middleware = tuple(middleware)
+        self._immediate = tuple(stage for stage in self._middleware if not stage.blocking)
+        self._blocking = tuple(stage for stage in self._middleware if stage.blocking)
+        self._foreground = tuple(stage for stage in self._middleware if not stage.background)
+        self._background = tuple(stage for stage in self._middleware if stage.background)
+
+        keys = [stage.execution_key for stage in self._middleware if stage.execution_key is not None]
+        self.execution_key = keys[0] if keys else handler.execution_key
+
+    @property
+    def middleware(self) -> Sequence[Middleware]:
+        return self._middleware
+
+    def _uses_coroutines(self) -> bool:
+        return super()._uses_coroutines() or any(
+            is_coroutine_function(method) for stage in self._middleware
+            for method in (stage.check, stage.rollback, stage.after)
+        )
+
+    def handle(self, user: str, command: str, args: List[str]) -> bool:
+        context = CommandContext(user, command, args, self._message, self._send_chat_message)
+
+        if (passed := self._check(context)) is None:
+            return False
+
+        try:
+            success = call_handler(self._command_handler, user, command, args)
+        except Exception:
+            self._rollback(passed, context)
+            raise
+
+        if not success:
+            self._rollback(passed, context)
+            return False
+
+        # Every foreground post-action runs, even if an earlier one failed
+        results = [_call(stage.after, context) for stage in self._foreground]
+
+        if self._background:
+            _submit(_executor('after', AFTER_THREADS), self._after, context)
+
+        return all(results)
+
+    def _check(self, context: CommandContext) -> Optional[List[Middleware]]:
+        """
+        :return: The middleware whose checks passed, None if any check failed and the passed ones were rolled back
+        """
+        passed: List[Middleware] = []
+
+        for stage in self._immediate:
+            if not self._check_stage(stage, context, passed):
+                return None
+
+        if not self._blocking:
+            return passed
+
+        # The first blocking check runs on the calling thread, which would only wait otherwise
+        first, *others = self._blocking
+        futures = {_submit(_executor('check', CHECK_THREADS), stage.check, context): stage for stage in others}
+
+        try:
+            success = self._check_stage(first, context, passed, rollback=False)
+
+            for future in as_completed(futures) if success else ():
+                if not future.result():
+                    success = False
+                    break
+
+                passed.append(futures[future])
+        except BaseException:
+            self._abandon(futures, passed, context)
+            raise
+
+        if not success:
+            self._abandon(futures, passed, context)
+            return None
+
+        return passed
+
+    def _check_stage(
+        self,
+        stage: Middleware,
+        context: CommandContext,
+        passed: List[Middleware],
+        rollback: bool = True
+    ) -> bool:
+        try:
+            success = _call(stage.check, context)
+        except BaseException:
+            if rollback:
+                self._rollback(passed, context)
+
+            raise
+
+        if success:
+            passed.append(stage)
+        elif rollback:
+            self._rollback(passed, context)
+
+        return success
+
+    def _abandon(self, futures: Dict[Future, Middleware], passed: List[Middleware], context: CommandContext):
+        """
+        Roll back after a failed check, including the checks which are still running.
+        """
+        self._rollback(passed, context)
+
+        for future, stage in futures.items():
+            # Callbacks run on the thread which finished the check, the rollback may still want to reply
+            if stage not in passed and not future.cancel():
+                future.add_done_callback(partial(self._rollback_late, stage, context, contextvars.copy_context()))
+
+    def _rollback_late(self, stage: Middleware, context: CommandContext, copied: contextvars.Context, future: Future):
+        if future.exception() is None and future.result():
+            copied.run(self._rollback, [stage], context)
+
+    def _rollback(self, passed: List[Middleware], context: CommandContext):
+        # Rolled back in reverse order, like nested decorators would unwind
+        for stage in reversed(passed):
+            try:
+                _call(stage.rollback, context)
+            except Exception:
+                logger.exception(f'rolling back {type(stage).__name__} for {context.command} of {context.user} failed')
+
+    def _after(self, context: CommandContext):
+        for stage in self._background:
+            try:
+                _call(stage.after, context)
+            except Exception:
+                logger.exception(f'{type(stage).__name__} failed after {context.command} of {context.user}')
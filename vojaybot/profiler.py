@@ -0,0 +1,246 @@
+import itertools
+import logging
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional, Tuple
+
+from vojaybot.tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every interval seconds while it is running, so it shows where a running bot
+    spends its time without instrumenting every function like cProfile does. Only the sampling thread does any work,
+    the sampled threads merely wait for the GIL a little more often.
+
+    Stacks are counted in the collapsed format used by flamegraph.pl and speedscope: one line per distinct stack with
+    the thread name and the frames from the outermost to the innermost, separated by semicolons, followed by the
+    number of samples. Frames are named by function and module, e.g. handle (vojaybot.handler.dice:20), so stacks do
+    not reveal where the bot is installed.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self._interval = interval
+        self._max_depth = max_depth
+
+        self._stacks: Counter = Counter()
+        self._samples = 0
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    @property
+    def samples(self) -> int:
+        return self._samples
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._stacks = Counter()
+            self._samples = 0
+            self._stopped.clear()
+
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> str:
+        """
+        :return: The collapsed stacks sampled since start
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._stopped.set()
+                self._thread.join()
+                self._thread = None
+
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    def _run(self):
+        own = threading.get_ident()
+
+        # Thread names are looked up per sample, since threads come and go while the profiler runs
+        while not self._stopped.wait(self._interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+
+            self._samples += 1
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        frames = []
+
+        while frame is not None and len(frames) < self._max_depth:
+            code = frame.f_code
+            module = frame.f_globals.get('__name__') or os.path.basename(code.co_filename)
+            frames.append(f'{code.co_name} ({module}:{code.co_firstlineno})')
+            frame = frame.f_back
+
+        frames.append(thread_name)
+        return ';'.join(reversed(frames))
+
+
+class Diagnostics:
+    """
+    Starts and stops tracing and profiling of a running bot and writes the results to output_dir. Used by the
+    DiagnosticsHandler command and the local ControlServer, which both understand the same commands:
+
+    * start: enable tracing and start the profiler
+    * stop: stop both and write <timestamp>.collapsed (stacks for a flame graph) and <timestamp>.spans.txt (the time
+      spent per stage since start), the timestamp gets a counter if another profile was written in the same second
+    * status: whether a profile is running and for how long
+
+    Every command answers with a single line, short enough for the chat. Chat replies only name the profile, the paths
+    of the written files are logged and only sent to the ControlServer, with detailed replies.
+    """
+
+    def __init__(self, tracer: Tracer, output_dir: str = 'profiles', interval: float = 0.005):
+        self._tracer = tracer
+        self._output_dir = output_dir
+        self._profiler = SamplingProfiler(interval)
+        self._started_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracer(self) -> Tracer:
+        return self._tracer
+
+    @property
+    def profiler(self) -> SamplingProfiler:
+        return self._profiler
+
+    def execute(self, command: str, detailed: bool = False) -> str:
+        """
+        :param detailed: Include local details like paths in the reply, which must not be posted to the chat
+        """
+        command = command.strip().lower()
+
+        if command == 'start':
+            return self.start()
+
+        if command == 'stop':
+            return self.stop(detailed)
+
+        if command == 'status':
+            return self.status()
+
+        return f'unknown command {command!r}, use start, stop or status'
+
+    def start(self) -> str:
+        with self._lock:
+            if self._started_at is not None:
+                return 'profiling is already running'
+
+            self._started_at = time.perf_counter()
+            self._tracer.enabled = True
+            self._profiler.start()
+
+        logger.info('started profiling')
+        return 'profiling started'
+
+    def stop(self, detailed: bool = False) -> str:
+        with self._lock:
+            if self._started_at is None:
+                return 'profiling is not running'
+
+            started_at, self._started_at = self._started_at, None
+            self._tracer.enabled = False
+            collapsed = self._profiler.stop()
+
+        seconds = time.perf_counter() - started_at
+        paths = self._write(collapsed, self._tracer.format_summary(since=started_at))
+
+        logger.info(f'stopped profiling after {seconds:.1f}s, wrote {paths[0]} and {paths[1]}')
+        summary = f'profiled {seconds:.1f}s with {self._profiler.samples} samples'
+
+        if detailed:
+            return f'{summary}, see {paths[0]} and {paths[1]}'
+
+        return f'{summary}, saved as profile {os.path.basename(paths[0])[:-len(".collapsed")]}'
+
+    def status(self) -> str:
+        started_at = self._started_at
+
+        if started_at is None:
+            return 'profiling is not running'
+
+        return f'profiling for {time.perf_counter() - started_at:.1f}s, {self._profiler.samples} samples so far'
+
+    def _write(self, collapsed: str, summary: str) -> Tuple[str, str]:
+        os.makedirs(self._output_dir, exist_ok=True)
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+
+        # Profiles stopped within the same second get a counter, e.g. 20240101-120000-2, instead of overwriting
+        # each other. Files are created exclusively, so concurrent stops can not pick the same name either.
+        for attempt in itertools.count(1):
+            prefix = os.path.join(self._output_dir, timestamp if attempt == 1 else f'{timestamp}-{attempt}')
+
+            try:
+                file = open(f'{prefix}.collapsed', 'x', encoding='UTF-8')
+            except FileExistsError:
+                continue
+
+            break
+
+        with file:
+            file.write(collapsed)
+
+        with open(f'{prefix}.spans.txt', 'w', encoding='UTF-8') as file:
+            file.write(f'{summary}\n')
+
+        return f'{prefix}.collapsed', f'{prefix}.spans.txt'
+
+
+class ControlServer:
+    """
+    Accepts Diagnostics commands on a local TCP port, one command per line, e.g. with
+
+    echo stop | nc 127.0.0.1 9091
+
+    Only local connections are accepted by default, anybody who can connect can write files to the output directory
+    of the Diagnostics.
+    """
+
+    def __init__(self, diagnostics: Diagnostics, port: int = 9091, host: str = '127.0.0.1'):
+        class RequestHandler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for line in self.rfile:
+                    if command := line.decode('UTF-8', 'replace').strip():
+                        self.wfile.write(f'{diagnostics.execute(command, detailed=True)}\n'.encode('UTF-8'))
+
+        self._server = socketserver.ThreadingTCPServer((host, port), RequestHandler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._server.server_address
+
+    def start(self) -> 'ControlServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='control-server', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
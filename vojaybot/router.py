@@ -0,0 +1,102 @@
+from types import MappingProxyType
+from typing import Any, Collection, Dict, Hashable, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+
+class Route(NamedTuple):
+    handler: Any
+    command: str
+    args: List[str]
+
+
+class CommandRouter:
+    """
+    Maps chat messages to handlers. Commands and aliases are normalized once at registration into a single lookup
+    table, so routing a message is one dictionary lookup on its first word.
+
+    Most chat messages are no commands or commands without handler. Those are rejected by looking at the first
+    character and the first word only, the message is neither lowercased nor split into its arguments in that case.
+    """
+
+    def __init__(self):
+        self._table: Dict[str, Any] = {}
+
+    def register(self, command: str, handler: Any, *aliases: str):
+        for name in (command, *aliases):
+            # Commands are registered as lower case strings to make it more easy for users to use them
+            self._table[name.lower().lstrip('!')] = handler
+
+    def replace(self, old: Collection[Any], routes: Iterable[Tuple[str, Any, Sequence[str]]]):
+        """
+        Replace the handlers in old by new routes of command, handler and aliases at once. The new table is built
+        aside and swapped in with a single assignment, so a concurrent route call either sees all old or all new
+        handlers, without any lock on the routing path.
+        """
+        old = set(old)
+        table = {name: handler for name, handler in self._table.items() if handler not in old}
+
+        for command, handler, aliases in routes:
+            for name in (command, *aliases):
+                table[name.lower().lstrip('!')] = handler
+
+        self._table = table
+
+    @property
+    def handlers(self) -> Mapping[str, Any]:
+        return MappingProxyType(self._table)
+
+    def route(self, text: str) -> Optional[Route]:
+        if text[:1] != '!':
+            return None
+
+        # Like str.split, any whitespace separates the command from its arguments, e.g. tabs or several spaces
+        words = text.split(None, 1)
+        command = words[0][1:]
+        args = words[1] if len(words) > 1 else ''
+
+        # The table is read once, it may be replaced by another thread in the meantime. Commands are usually typed
+        # in lower case, only otherwise a lower case copy is needed.
+        table = self._table
+        handler = table.get(command)
+
+        if handler is None:
+            command = command.lower()
+            handler = table.get(command)
+
+            if handler is None:
+                return None
+
+        # All user input is converted to lower case to simplify handling in command handlers. The route is created
+        # with tuple.__new__, which skips the comparably slow NamedTuple constructor.
+        return tuple.__new__(Route, (handler, command, args.lower().split()))
+
+
+class ArgumentGrammar:
+    """
+    Compiles the vocabularies a handler understands into one frozen lookup map from argument to (kind, value), so
+    classifying an argument is a single dictionary lookup instead of checking every vocabulary one after another.
+
+    Example:
+
+    grammar = ArgumentGrammar(state={'on': True, 'off': False}, color={'red': (0.64, 0.32)})
+    grammar.match('red')  # ('color', (0.64, 0.32))
+    """
+
+    def __init__(self, **vocabularies: Mapping[str, Any]):
+        table: Dict[str, Tuple[str, Any]] = {}
+
+        for kind, vocabulary in vocabularies.items():
+            for token, value in vocabulary.items():
+                token = token.lower()
+
+                if token in table and table[token][0] != kind:
+                    raise ValueError(f'{token} is ambiguous, it is a {table[token][0]} and a {kind}')
+
+                table[token] = (kind, value)
+
+        self._table = MappingProxyType(table)
+
+    def match(self, token: Hashable) -> Optional[Tuple[str, Any]]:
+        return self._table.get(token)
+
+    def tokens(self, kind: str) -> List[str]:
+        return [token for token, (token_kind, _) in self._table.items() if token_kind == kind]
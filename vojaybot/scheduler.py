@@ -0,0 +1,349 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Deque, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from vojaybot.execution import OverflowPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class MessagePriority(IntEnum):
+    """
+    Messages with a lower value are sent first, messages with the same priority in the order they were queued.
+    """
+    SYSTEM = 0
+    ERROR = 1
+    NORMAL = 2
+
+
+class RateLimit(NamedTuple):
+    """
+    Twitch allows a certain amount of PRIVMSG per period. The token bucket starts with burst tokens and is refilled
+    with (messages - burst) / period tokens per second, so no window of period seconds ever contains more than
+    messages sent messages.
+
+    See: https://dev.twitch.tv/docs/irc/guide#command--message-limits
+    """
+    messages: int
+    period: float
+    burst: int
+
+    @property
+    def rate(self) -> float:
+        return (self.messages - self.burst) / self.period
+
+
+RATE_LIMIT_NORMAL = RateLimit(messages=20, period=30.0, burst=5)
+RATE_LIMIT_MODERATOR = RateLimit(messages=100, period=30.0, burst=20)
+
+
+# Twitch rejects messages which are longer than that
+MAX_MESSAGE_LENGTH = 500
+
+COALESCE_SEPARATOR = ' | '
+
+# Priority of messages put back by SendScheduler.requeue, ahead of MessagePriority.SYSTEM
+_REQUEUED = -1
+
+
+class SendSchedulerStats(NamedTuple):
+    queued: int
+    sent: int
+    dropped: int
+    coalesced: int
+    overflowed: int
+    queue_depth: int
+    wait_time_avg: float
+    wait_time_max: float
+
+
+class _QueuedMessage:
+    __slots__ = ('priority', 'sequence', 'queued_at', 'expires_at', 'channel', 'text', 'merge_key')
+
+    def __init__(self, priority, sequence, queued_at, expires_at, channel, text, merge_key):
+        self.priority = priority
+        self.sequence = sequence
+        self.queued_at = queued_at
+        self.expires_at = expires_at
+        self.channel = channel
+        self.text = text
+        self.merge_key = merge_key
+
+    def __lt__(self, other):
+        # The sequence keeps the order of messages with the same priority
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class SendScheduler:
+    """
+    Outbound message queue of TwitchBot which respects the Twitch rate limits. Handlers add messages with put, the
+    writer of the bot takes them with get, which blocks until the next message is allowed to be sent.
+
+    Messages are sent by priority, so system and error replies jump the queue. Messages which waited longer than
+    their TTL are dropped instead of being sent, since a reply that arrives minutes late only confuses viewers.
+
+    If coalesce_window is set, messages queued for the same channel with the same merge_key are merged into a single
+    message, e.g. "@a: 3 | @b: 5 | @c: 1", as long as it stays within the Twitch message length limit. Such messages
+    are held back for coalesce_window seconds to give other replies the chance to join, and they keep accepting
+    replies while they wait for the rate limit. During spam waves this saves most of the rate limit tokens.
+
+    With max_queued, at most that many messages wait to be sent. If the queue is full, the overflow policy decides
+    which message is dropped, by default the oldest one of the lowest priority. Every dropped message is counted as
+    overflowed.
+    """
+
+    def __init__(
+        self,
+        rate_limit: RateLimit = RATE_LIMIT_NORMAL,
+        ttl: float = 30.0,
+        coalesce_window: Optional[float] = None,
+        max_queued: Optional[int] = None,
+        overflow: OverflowPolicy = OverflowPolicy.DROP_LOWEST_PRIORITY
+    ):
+        self._rate_limit = rate_limit
+        self._ttl = ttl
+        self._coalesce_window = coalesce_window
+        self._max_queued = max_queued
+        self._overflow = OverflowPolicy(overflow)
+
+        self._tokens = float(rate_limit.burst)
+        self._refilled_at = time.monotonic()
+
+        self._heap: List[_QueuedMessage] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # Messages which are held back by the coalesce window, ordered by the time they were queued
+        self._held: Deque[_QueuedMessage] = deque()
+
+        # Latest not yet sent message per channel and merge key, either held back or already in the heap
+        self._mergeable: Dict[Tuple[str, Hashable], _QueuedMessage] = {}
+
+        self._queued = 0
+        self._sent = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._overflowed = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def _merge(self, message: str, priority: MessagePriority, merge_key: Tuple[str, Hashable]) -> bool:
+        queued = self._mergeable.get(merge_key)
+
+        if queued is None or queued.priority != priority:
+            return False
+
+        if len(queued.text) + len(COALESCE_SEPARATOR) + len(message) > MAX_MESSAGE_LENGTH:
+            return False
+
+        queued.text = f'{queued.text}{COALESCE_SEPARATOR}{message}'
+        self._coalesced += 1
+
+        return True
+
+    def put(
+        self,
+        channel: str,
+        message: str,
+        priority: MessagePriority = MessagePriority.NORMAL,
+        merge_key: Optional[Hashable] = None,
+        ttl: Optional[float] = None
+    ) -> bool:
+        """
+        Queue a message.
+
+        :param channel: Channel the message is sent to
+        :param message: Text of the message
+        :param priority: Messages with a higher priority are sent first
+        :param merge_key: Messages with the same key can be merged into one, None if the message must be sent as is
+        :param ttl: Seconds after which the message is dropped if it was not sent yet, defaults to the scheduler TTL
+        :return: False if the queue is full and the message was dropped
+        """
+        now = time.monotonic()
+        coalesce = self._coalesce_window is not None and merge_key is not None
+
+        if coalesce:
+            merge_key = (channel, merge_key)
+
+        with self._condition:
+            self._queued += 1
+
+            if coalesce and self._merge(message, priority, merge_key):
+                return True
+
+            if self._max_queued is not None and len(self._heap) + len(self._held) >= self._max_queued \
+                    and not self._make_room(priority):
+                self._overflowed += 1
+                logger.debug('send queue is full, dropping message %s', message)
+                return False
+
+            queued = _QueuedMessage(
+                priority,
+                next(self._sequence),
+                now,
+                now + (self._ttl if ttl is None else ttl),
+                channel,
+                message,
+                merge_key
+            )
+
+            if coalesce:
+                self._mergeable[merge_key] = queued
+                self._held.append(queued)
+            else:
+                heapq.heappush(self._heap, queued)
+
+            self._condition.notify()
+
+        return True
+
+    def _make_room(self, priority: MessagePriority) -> bool:
+        """
+        Drop a queued message according to the overflow policy.
+
+        :return: False if the new message has to be dropped instead
+        """
+        # A linear scan, the queue is bounded and only full under overload
+        candidates = [*self._heap, *self._held]
+
+        if self._overflow is OverflowPolicy.REJECT or not candidates:
+            return False
+
+        if self._overflow is OverflowPolicy.DROP_OLDEST:
+            # Requeued messages were taken before all others, they are only dropped if nothing else is left
+            victim = min(candidates, key=lambda queued: (queued.priority == _REQUEUED, queued.sequence))
+        else:
+            victim = max(candidates, key=lambda queued: (queued.priority, -queued.sequence))
+
+            if priority > victim.priority:
+                return False
+
+        if victim in self._held:
+            self._held.remove(victim)
+        else:
+            self._heap.remove(victim)
+            heapq.heapify(self._heap)
+
+        if victim.merge_key is not None and self._mergeable.get(victim.merge_key) is victim:
+            del self._mergeable[victim.merge_key]
+
+        self._overflowed += 1
+        logger.debug('send queue is full, dropping message %s', victim.text)
+
+        return True
+
+    def requeue(self, channel: str, message: str):
+        """
+        Put back a message that was returned by get but could not be sent, e.g. because the connection was lost. It
+        is sent before all other messages once a connection is available again and does not count as sent. Messages
+        put back by several calls are sent in the order of these calls. On overflow they are dropped last.
+        """
+        now = time.monotonic()
+
+        with self._condition:
+            self._sent -= 1
+            self._tokens = min(self._rate_limit.burst, self._tokens + 1)
+
+            heapq.heappush(self._heap, _QueuedMessage(
+                _REQUEUED, next(self._sequence), now, now + self._ttl, channel, message, None
+            ))
+
+            self._condition.notify()
+
+    def _release_held(self, now) -> Optional[float]:
+        """
+        Move messages whose coalesce window passed into the heap.
+
+        :return: Seconds until the next held message is released, None if no message is held back
+        """
+        while self._held:
+            released_at = self._held[0].queued_at + self._coalesce_window
+
+            if released_at > now:
+                return released_at - now
+
+            heapq.heappush(self._heap, self._held.popleft())
+
+        return None
+
+    def _refill(self, now):
+        self._tokens = min(self._rate_limit.burst, self._tokens + (now - self._refilled_at) * self._rate_limit.rate)
+        self._refilled_at = now
+
+    def _pop(self) -> _QueuedMessage:
+        queued = heapq.heappop(self._heap)
+
+        if queued.merge_key is not None and self._mergeable.get(queued.merge_key) is queued:
+            del self._mergeable[queued.merge_key]
+
+        return queued
+
+    def _drop_expired(self, now):
+        # Only the head of the heap is checked, stale messages further back are dropped as soon as they move up
+        while self._heap and self._heap[0].expires_at <= now:
+            queued = self._pop()
+            self._dropped += 1
+            logger.info(f'dropping stale message {queued.text}')
+
+    def get(self) -> Optional[Tuple[str, str]]:
+        """
+        Block until a message is queued and the rate limit allows to send it.
+
+        :return: Tuple of channel and message or None if the scheduler was closed
+        """
+        with self._condition:
+            while not self._closed:
+                now = time.monotonic()
+                release_in = self._release_held(now)
+                self._drop_expired(now)
+
+                if not self._heap:
+                    # Wake up when the next held back message is released, or earlier if a new message is queued
+                    self._condition.wait(release_in)
+                    continue
+
+                self._refill(now)
+
+                if self._tokens < 1:
+                    # Wake up as soon as the next token is available, or earlier if a new message is queued
+                    self._condition.wait((1 - self._tokens) / self._rate_limit.rate)
+                    continue
+
+                queued = self._pop()
+                self._tokens -= 1
+
+                wait_time = now - queued.queued_at
+                self._sent += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+
+                return queued.channel, queued.text
+
+            return None
+
+    def close(self):
+        """
+        Wake up all waiting writers, get returns None from now on.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self) -> SendSchedulerStats:
+        with self._condition:
+            return SendSchedulerStats(
+                queued=self._queued,
+                sent=self._sent,
+                dropped=self._dropped,
+                coalesced=self._coalesced,
+                overflowed=self._overflowed,
+                queue_depth=len(self._heap) + len(self._held),
+                wait_time_avg=self._wait_time_total / self._sent if self._sent else 0.0,
+                wait_time_max=self._wait_time_max
+            )
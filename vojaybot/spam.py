@@ -0,0 +1,238 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from enum import IntEnum
+from typing import Dict, Optional
+
+from vojaybot.irc import IrcMessage
+
+_MASK = (1 << 64) - 1
+
+# Twitch rejects a message which is identical to the previous one of the same user, spammers append invisible
+# characters to get around that
+_INVISIBLE = dict.fromkeys(map(ord, '\u034f\u200b\u200c\u200d\u2060\ufeff\U000e0000'))
+
+# Characters per shingle of the fingerprint
+_SHINGLE = 3
+
+# Bit planes of the shingle counters, fingerprints use at most 2 ** _PLANES - 1 shingles
+_PLANES = 8
+
+
+class FilterAction(IntEnum):
+    """
+    What the bot does with a chat message, if several filters disagree the highest value wins.
+    """
+    # Logged and routed as usual
+    PASS = 0
+    # Logged and routed as usual, handlers can look at how the filter tagged the message, e.g. message.duplicates
+    TAG = 1
+    # Routed, but not written to the chat log, so a spam wave does not flood the log
+    COLLAPSE = 2
+    # Neither logged nor routed nor kept in the chat history
+    DROP = 3
+
+
+class MessageFilter(ABC):
+    """
+    A stage TwitchBot runs for every chat message before it is logged or routed, see TwitchBot(message_filters=...).
+    Runs on the thread reading from Twitch, so it has to be fast and thread-safe if the bot has several connections.
+    """
+
+    @abstractmethod
+    def check(self, message: IrcMessage) -> FilterAction:
+        pass
+
+
+def normalize(text: str) -> str:
+    """
+    The part of a chat message that matters for comparing it with others: lower case, without invisible characters
+    and with single spaces.
+    """
+    # Translating with a dict looks up every character, most chat is plain ASCII without any invisible characters
+    if not text.isascii():
+        text = text.translate(_INVISIBLE)
+
+    return ' '.join(text.lower().split())
+
+
+def fingerprint(text: str) -> int:
+    """
+    64 bit SimHash of the character shingles of a normalized text. Similar texts have fingerprints which differ in few
+    bits only, e.g. copies with a few more or other characters.
+
+    Every bit of the fingerprint is the majority vote of that bit across the hashes of all shingles. The votes are
+    counted for all 64 bits at once, with bit-sliced counters on plain integers, instead of one bit at a time.
+    """
+    # Strings are hashed with a random seed per process, so fingerprints are only comparable within a process
+    if len(text) <= _SHINGLE:
+        return hash(text) & _MASK
+
+    # Bit i of the counters of all 64 bit positions is kept in plane i, the count of position j is the sum of
+    # (plane i >> j & 1) << i
+    p0 = p1 = p2 = p3 = p4 = p5 = p6 = p7 = 0
+    shingles = min(len(text) - _SHINGLE + 1, (1 << _PLANES) - 1)
+
+    for i in range(shingles):
+        carry = hash(text[i:i + _SHINGLE]) & _MASK
+
+        # Adds one to the counters of all bits set in the hash. Unrolled, since looping over a list of planes takes
+        # half again as long, and carries rarely run further than a plane or two.
+        p0, carry = p0 ^ carry, p0 & carry
+        if carry:
+            p1, carry = p1 ^ carry, p1 & carry
+            if carry:
+                p2, carry = p2 ^ carry, p2 & carry
+                if carry:
+                    p3, carry = p3 ^ carry, p3 & carry
+                    if carry:
+                        p4, carry = p4 ^ carry, p4 & carry
+                        if carry:
+                            p5, carry = p5 ^ carry, p5 & carry
+                            if carry:
+                                p6, carry = p6 ^ carry, p6 & carry
+                                if carry:
+                                    p7 ^= carry
+
+    planes = (p0, p1, p2, p3, p4, p5, p6, p7)
+
+    # Bits whose count is at least the majority, compared from the most significant plane down
+    majority = shingles // 2 + 1
+    greater = 0
+    equal = _MASK
+
+    for plane in range(_PLANES - 1, -1, -1):
+        if majority >> plane & 1:
+            equal &= planes[plane]
+        else:
+            greater |= equal & planes[plane]
+            equal &= ~planes[plane] & _MASK
+
+    return greater | equal
+
+
+class DuplicateFilter(MessageFilter):
+    """
+    Detects copy-paste spam: messages which are the same or nearly the same as messages other users (or the same
+    user) sent within the last window seconds. Every message is tagged with message.duplicates, the number of similar
+    messages before it within the window. From the threshold-th duplicate on, the filter returns action, by default
+    COLLAPSE, so spam waves still reach handlers, but are only logged until they become spam.
+
+    Messages are compared by SimHash fingerprint, two messages are similar if their fingerprints differ in at most
+    max_distance bits. Recent fingerprints are kept in a fixed ring of capacity entries. To find a similar one
+    without comparing against all of them, the fingerprint is split into 4 bands of 16 bits: fingerprints differing
+    in at most 3 bits are equal in at least one band, so each band indexes a fixed table of the latest entry with
+    that band value. Both sizes are fixed, so memory does not depend on the chat rate. Under heavy traffic the
+    oldest entries are overwritten, which only means that very old messages are not recognized anymore.
+
+    Spam waves mostly consist of exact copies, so fingerprints of recently seen texts are cached. Unique chat costs a
+    fingerprint per message, a few tens of microseconds, see benchmark/spam_filter.py. The filter is therefore not
+    enabled by default, busy channels should measure whether the read thread can afford it.
+
+    Handlers can check the message they handle, e.g. self._message.duplicates, or whether the chat is in a spam wave
+    right now with in_wave, e.g. to skip paid commands.
+    """
+
+    def __init__(
+        self,
+        window: float = 30.0,
+        threshold: int = 3,
+        action: FilterAction = FilterAction.COLLAPSE,
+        max_distance: int = 3,
+        capacity: int = 4096,
+        cache_size: int = 4096
+    ):
+        if not 0 <= max_distance <= 3:
+            raise ValueError('max_distance must be between 0 and 3, the 4 bands can not find more distant ones')
+
+        self._window = window
+        self._threshold = threshold
+        self._action = FilterAction(action)
+        self._max_distance = max_distance
+        self._capacity = capacity
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+        # Ring of clusters of similar messages: fingerprint of the first message, time of the latest one and count
+        self._fingerprints = array('Q', bytes(8 * capacity))
+        self._seen_at = array('d', [float('-inf')]) * capacity
+        self._counts = array('q', bytes(8 * capacity))
+        self._next = 0
+
+        # Per band of 16 bits, the ring index of the latest cluster with that band value, -1 if there is none
+        self._bands = [(shift, array('q', [-1]) * (1 << 16)) for shift in (0, 16, 32, 48)]
+
+        self._cache: Dict[str, int] = {}
+
+        self._flagged = 0
+        self._flagged_at = float('-inf')
+
+    @property
+    def flagged(self) -> int:
+        """
+        Messages the action was applied to.
+        """
+        return self._flagged
+
+    def in_wave(self, now: Optional[float] = None) -> bool:
+        """
+        Whether a message was flagged as spam within the window.
+        """
+        return (time.monotonic() if now is None else now) - self._flagged_at < self._window
+
+    def _fingerprint(self, text: str) -> int:
+        # Keyed by the text as sent, copies are found without even normalizing them
+        if (value := self._cache.get(text)) is None:
+            # Cleared instead of evicting single entries, it is refilled by the next wave within a few messages
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+
+            value = self._cache[text] = fingerprint(normalize(text))
+
+        return value
+
+    def duplicates(self, text: str, now: Optional[float] = None) -> int:
+        """
+        Record a message and count similar messages before it within the window.
+        """
+        value = self._fingerprint(text)
+        now = time.monotonic() if now is None else now
+        oldest = now - self._window
+        seen_at = self._seen_at
+
+        with self._lock:
+            for shift, table in self._bands:
+                if (index := table[value >> shift & 0xFFFF]) == -1 or seen_at[index] < oldest:
+                    continue
+
+                # int.bit_count would need Python 3.10
+                if bin(self._fingerprints[index] ^ value).count('1') <= self._max_distance:
+                    seen_at[index] = now
+                    self._counts[index] += 1
+
+                    return self._counts[index]
+
+            index = self._next % self._capacity
+            self._next += 1
+
+            self._fingerprints[index] = value
+            seen_at[index] = now
+            self._counts[index] = 0
+
+            for shift, table in self._bands:
+                table[value >> shift & 0xFFFF] = index
+
+        return 0
+
+    def check(self, message: IrcMessage) -> FilterAction:
+        now = time.monotonic()
+        message.duplicates = duplicates = self.duplicates(message.text, now)
+
+        if duplicates < self._threshold:
+            return FilterAction.PASS
+
+        self._flagged += 1
+        self._flagged_at = now
+
+        return self._action
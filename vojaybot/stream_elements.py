@@ -1,10 +1,19 @@
-import json
+import functools
 import logging
-from typing import List
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
 
-import requests
+from vojaybot.execution import ExecutionKey
+from vojaybot.metrics import Metrics
+from vojaybot.scheduler import MessagePriority
+from vojaybot.middleware import CommandContext, Middleware, MiddlewarePipeline
+from vojaybot.twitch import CommandHandler
 
-from vojaybot.twitch import CommandHandler, CommandHandlerDecorator
+if TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger(__name__)
 
@@ -12,96 +21,652 @@ logger = logging.getLogger(__name__)
 class StreamElementsClient:
     """
     See: https://docs.streamelements.com/reference
+
+    All requests share a single Session, so connections are kept alive and reused instead of doing a new TCP and TLS
+    handshake for every call. Every request is bounded by connect and read timeouts. Rate limited (429) requests are
+    retried with exponential backoff, honoring the Retry-After header. Server errors (5xx) and connection errors are
+    only retried for reads, since retrying a points update that might have been applied already could reduce the
+    points twice.
     """
 
-    def __init__(self, jwt_token, channel_id, base_uri='https://api.streamelements.com/kappa/v2'):
+    RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(
+        self,
+        jwt_token,
+        channel_id,
+        base_uri='https://api.streamelements.com/kappa/v2',
+        pool_size=8,
+        connect_timeout=3.05,
+        read_timeout=5.0,
+        max_retries=2,
+        backoff_factor=0.25,
+        max_backoff=5.0,
+        metrics: Optional[Metrics] = None
+    ):
         self._jwt_token = jwt_token
         self._channel_id = channel_id
         self._base_uri = base_uri
 
+        self._timeout = (connect_timeout, read_timeout)
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._max_backoff = max_backoff
+
         self._headers = {
             'Accept': 'application/json',
             'Authorization': f'Bearer {jwt_token}'
         }
 
-    def get_points(self, user: str) -> int:
+        # requests is only imported once a client is created, importing it takes longer than everything else
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Retries are handled by _request, since they depend on the request method
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+
+        self._session = requests.Session()
+        self._session.headers.update(self._headers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        # Every attempt is measured on its own, retries show up as additional requests
+        self._request_seconds = metrics.histogram(
+            'vojaybot_streamelements_request_seconds', 'Duration of StreamElements API requests', ('method', 'status')
+        ) if metrics is not None else None
+
+    def _backoff(self, attempt: int, response: Optional['requests.Response']) -> float:
+        if response is not None and (retry_after := response.headers.get('Retry-After')):
+            try:
+                return min(float(retry_after), self._max_backoff)
+            except ValueError:
+                # Retry-After can also be a HTTP date, fall back to exponential backoff in that case
+                pass
+
+        return min(self._backoff_factor * 2 ** attempt, self._max_backoff)
+
+    def _should_retry(self, method: str, status_code: int) -> bool:
+        if status_code == 429:
+            return True
+
+        return method == 'GET' and status_code in self.RETRY_STATUS_CODES
+
+    def _request(self, method: str, url: str, **kwargs) -> Optional['requests.Response']:
+        """
+        Send a request with the shared session, retrying it if possible.
+
+        :return: The response, which might not be ok, or None if no response was received at all
+        """
+        import requests
+
+        response = None
+
+        for attempt in range(self._max_retries + 1):
+            if attempt:
+                time.sleep(self._backoff(attempt - 1, response))
+
+            started_at = time.perf_counter()
+
+            try:
+                response = self._session.request(method, url, timeout=self._timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+
+                if self._request_seconds is not None:
+                    self._request_seconds.labels(method, 'error').observe(time.perf_counter() - started_at)
+
+                # The request never reached the server if connecting failed, so it is safe to retry it. Other errors
+                # are only retried for reads.
+                if isinstance(e, requests.ConnectTimeout) or method == 'GET':
+                    logger.info(f'request to {url} failed with {e}, attempt {attempt + 1}')
+                    continue
+
+                logger.info(f'request to {url} failed with {e}')
+                return None
+
+            if self._request_seconds is not None:
+                duration = time.perf_counter() - started_at
+                self._request_seconds.labels(method, str(response.status_code)).observe(duration)
+
+            if not self._should_retry(method, response.status_code):
+                return response
+
+            logger.info(f'request to {url} failed with status {response.status_code}, attempt {attempt + 1}')
+
+        return response
+
+    def try_get_points(self, user: str) -> Optional[int]:
+        """
+        Like get_points, but distinguishes failed requests from an empty account.
+
+        :return: The amount of points or None if the request failed
+        """
         url = f'{self._base_uri}/points/{self._channel_id}/{user}'
-        response = requests.request('GET', url, headers=self._headers)
+        response = self._request('GET', url)
 
-        if not response.ok:
-            logger.info(f'request to {url} failed with {response.text}')
-            return 0
+        if response is None or not response.ok:
+            logger.info(f'request to {url} failed with {response.text if response is not None else "no response"}')
+            return None
 
-        return int(json.loads(response.text)['points'])
+        return int(response.json()['points'])
 
-    def reduce_points(self, user: str, points: int) -> int:
+    def get_points(self, user: str) -> int:
+        points = self.try_get_points(user)
+        return points if points is not None else 0
+
+    def _update_points(self, user: str, delta: int) -> Optional[int]:
+        url = f'{self._base_uri}/points/{self._channel_id}/{user}/{delta}'
+        response = self._request('PUT', url)
+
+        if response is None or not response.ok:
+            logger.info(f'request to {url} failed with {response.text if response is not None else "no response"}')
+            return None
+
+        return int(response.json()['newAmount'])
+
+    def try_reduce_points(self, user: str, points: int) -> Optional[int]:
+        """
+        Like reduce_points, but distinguishes failed requests from an empty account.
+
+        :return: The new amount of points or None if the request failed
+        """
+        if points < 0:
+            raise ValueError('points must be >= 0')
+
+        return self._update_points(user, -points)
+
+    def try_add_points(self, user: str, points: int) -> Optional[int]:
+        """
+        :return: The new amount of points or None if the request failed
+        """
         if points < 0:
             raise ValueError('points must be >= 0')
 
-        url = f'{self._base_uri}/points/{self._channel_id}/{user}/-{points}'
-        response = requests.request("PUT", url, headers=self._headers)
+        return self._update_points(user, points)
+
+    def reduce_points(self, user: str, points: int) -> int:
+        points_new = self.try_reduce_points(user, points)
+        return points_new if points_new is not None else 0
+
+    def bulk_update_points(self, deltas: Iterable[Tuple[str, int]], chunk_size: int = 100) -> Dict[str, bool]:
+        """
+        Add (or with a negative delta reduce) points of many users with as few requests as possible, using the
+        StreamElements bulk endpoint. Deltas of the same user are summed up, users are sent in chunks of chunk_size.
+
+        A chunk is either applied completely or not at all, so if a request fails only the users of that chunk are
+        reported as failed and can be retried later.
+
+        :param deltas: Pairs of user and points to add
+        :param chunk_size: Maximum number of users per request
+        :return: Success per user
+        """
+        summed: Dict[str, int] = {}
+
+        for user, delta in deltas:
+            summed[user] = summed.get(user, 0) + delta
 
-        if not response.ok:
-            logger.info(f'request to {url} failed with {response.text}')
-            return 0
+        users = [{'username': user, 'current': delta} for user, delta in summed.items() if delta]
+        results = dict.fromkeys((user for user, delta in summed.items() if not delta), True)
 
-        return int(json.loads(response.text)['newAmount'])
+        url = f'{self._base_uri}/points/{self._channel_id}'
 
+        for i in range(0, len(users), chunk_size):
+            chunk = users[i:i + chunk_size]
+            response = self._request('PUT', url, json={'mode': 'add', 'users': chunk})
+            success = response is not None and response.ok
 
-class StreamElementsPointsDecorator(CommandHandlerDecorator):
+            if not success:
+                logger.info(f'bulk request to {url} for {len(chunk)} users failed with '
+                            f'{response.text if response is not None else "no response"}')
+
+            results.update(dict.fromkeys((user['username'] for user in chunk), success))
+
+        return results
+
+    def close(self):
+        self._session.close()
+
+
+class AsyncStreamElementsClient:
+    """
+    Awaitable wrapper of StreamElementsClient for handlers implemented with async def handle. It is backed by threads,
+    not by an async HTTP client: requests are sent by the wrapped StreamElementsClient in a thread pool of this
+    client, so they share its connection pool, timeouts and retries without blocking the event loop. At most
+    max_workers requests run at once, further ones wait in the pool, which also bounds the connections to
+    StreamElements.
     """
-    This Decorator can be used to decorate any CommandHandler with the StreamElements points system. Before the
-    decorated handler is executed, the _pre_handle function checks if the viewer has enough points to execute
-    the command based on the configured costs.
 
-    If he has not enough points, he receives the transaction_failed_msg. If he has enough points, the decorated
-    handler is executed and as soon as this was successful (means: it returned True) the costs are removed from
-    his account and he receives the transaction_succeed_msg.
+    def __init__(self, client: StreamElementsClient, max_workers: int = 4):
+        self._client = client
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='stream-elements')
 
-    You can use the following placeholders in transaction_failed_msg and transaction_succeed_msg:
+    async def _run(self, function, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args))
 
-    * user: Name of the viewer that wants to execute the command
-    * costs: Configured costs for the command
-    * points: Amount of StreamElements points before the transaction
-    * points_new: Amount of StreamElements points after the transaction
+    async def get_points(self, user: str) -> int:
+        return await self._run(self._client.get_points, user)
 
-    Example: Hi {user}, not enough points ({points} < {costs})
+    async def reduce_points(self, user: str, points: int) -> int:
+        return await self._run(self._client.reduce_points, user, points)
 
-    This allows to adjust the messages to your stream configuration (e.g. when the StreamElements points have a custom
-    name for you).
+    def close(self):
+        """
+        Wait for running requests and stop the threads, the wrapped client stays open.
+        """
+        self._executor.shutdown()
+
+
+class StreamElementsPointsLedger:
+    """
+    Keeps StreamElements balances in memory, so paid commands do not need to wait for the StreamElements API.
+
+    Balances are fetched once and cached for ttl seconds, at most max_users balances are kept and the least recently
+    used ones are evicted first. Deductions are applied to the cached balance atomically, which makes it impossible
+    for two concurrent commands to spend the same points twice. A background thread reconciles the deductions with
+    StreamElements every flush_interval seconds, failed updates are kept and retried with the next flush.
+
+    Balances with deductions that are not reconciled yet are neither refreshed nor evicted, since the fetched balance
+    could not tell whether the deductions were already applied. Balances which could not be fetched are not cached,
+    commands fail until StreamElements answers again instead of treating everybody as broke for ttl seconds.
+    """
+
+    def __init__(self, se_client: StreamElementsClient, ttl=60.0, max_users=10000, flush_interval=5.0):
+        self._se_client = se_client
+        self._ttl = ttl
+        self._max_users = max_users
+        self._flush_interval = flush_interval
+
+        # user -> (points, fetched_at), ordered from least to most recently used
+        self._balances: OrderedDict[str, Tuple[int, float]] = OrderedDict()
+
+        # Deductions that were not sent to StreamElements yet, and deductions that are being sent right now
+        self._pending: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+
+        # Balances which are being fetched right now, with the fetched balance or None if fetching it failed
+        self._loading: Dict[str, Future] = {}
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+
+    def _has_outstanding(self, user: str) -> bool:
+        return user in self._pending or user in self._in_flight
+
+    def _cached(self, user: str, now: float) -> Optional[int]:
+        if cached := self._balances.get(user):
+            points, fetched_at = cached
+
+            if now - fetched_at < self._ttl or self._has_outstanding(user):
+                self._balances.move_to_end(user)
+                return points
+
+        return None
+
+    def _evict(self):
+        while len(self._balances) > self._max_users:
+            for user in self._balances:
+                if not self._has_outstanding(user):
+                    del self._balances[user]
+                    break
+            else:
+                # Every cached user has outstanding deductions, they are evicted after the next flush
+                return
+
+    def _load(self, user: str) -> Optional[int]:
+        """
+        Return the balance of a user, fetching it from StreamElements if it is not cached. Must not be called while
+        holding the lock, the request would block every other command. If multiple commands of the same user miss
+        the cache at once, only one of them fetches the balance and the others wait for it.
+
+        :return: The balance or None if it could not be fetched. Failures are not cached, the next command of the
+                 user tries again.
+        """
+        with self._lock:
+            if (points := self._cached(user, time.monotonic())) is not None:
+                return points
+
+            loading = self._loading.get(user)
+
+            if loading is None:
+                self._loading[user] = Future()
+
+        if loading is not None:
+            # Commands which waited for a failed request fail as well, instead of sending one request after another
+            return self._load(user) if loading.result() is not None else None
+
+        fetched = None
+
+        try:
+            fetched = self._se_client.try_get_points(user)
+
+            if fetched is not None:
+                with self._lock:
+                    self._balances[user] = (fetched, time.monotonic())
+                    self._evict()
+
+            return fetched
+        finally:
+            with self._lock:
+                self._loading.pop(user).set_result(fetched)
+
+    def get_points(self, user: str) -> Optional[int]:
+        """
+        :return: The balance of the user or None if it could not be fetched
+        """
+        return self._load(user)
+
+    def try_debit(self, user: str, points: int) -> Optional[Tuple[bool, int, int]]:
+        """
+        Atomically deduct points, if the user has enough of them.
+
+        :return: Tuple of success, points before and points after the deduction, None if the balance could not be
+                 fetched
+        """
+        if points < 0:
+            raise ValueError('points must be >= 0')
+
+        if (loaded := self._load(user)) is None:
+            return None
+
+        with self._lock:
+            # The balance is read and changed under the lock. If it was evicted right after loading it, it had no
+            # outstanding deductions, so the loaded balance is still correct.
+            balance, fetched_at = self._balances.get(user) or (loaded, time.monotonic())
+
+            if balance < points:
+                return False, balance, balance
+
+            self._balances[user] = (balance - points, fetched_at)
+            self._pending[user] = self._pending.get(user, 0) + points
+
+        self._ensure_flush_thread()
+        return True, balance, balance - points
+
+    def refund(self, user: str, points: int):
+        """
+        Give back points that were deducted with try_debit, e.g. because the command failed.
+        """
+        with self._lock:
+            if cached := self._balances.get(user):
+                self._balances[user] = (cached[0] + points, cached[1])
+
+            # The deduction might already be on its way to StreamElements, in that case the refund is a negative
+            # deduction that gets reconciled with the next flush
+            self._pending[user] = self._pending.get(user, 0) - points
+
+            if self._pending[user] == 0:
+                del self._pending[user]
+
+    def _reconcile(self, deductions: Dict[str, int]) -> Dict[str, bool]:
+        """
+        Send deductions to StreamElements, all users at once with the bulk endpoint.
+
+        :return: Success per user
+        """
+        return self._se_client.bulk_update_points((user, -points) for user, points in deductions.items())
+
+    def flush(self):
+        """
+        Reconcile all pending deductions with StreamElements, usually called by the background thread.
+        """
+        with self._flush_lock:
+            with self._lock:
+                deductions, self._pending = self._pending, {}
+                self._in_flight = deductions
+
+            if not deductions:
+                return
+
+            results = self._reconcile(deductions)
+
+            with self._lock:
+                for user, points in deductions.items():
+                    if not results.get(user):
+                        # Keep failed deductions, they are retried with the next flush
+                        self._pending[user] = self._pending.get(user, 0) + points
+
+                self._in_flight = {}
+                self._evict()
+
+            failed = sum(1 for success in results.values() if not success)
+            logger.info(f'reconciled points of {len(deductions)} users with StreamElements, {failed} failed')
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('reconciling points with StreamElements failed')
+
+    def _ensure_flush_thread(self):
+        if self._flush_thread is None:
+            with self._lock:
+                if self._flush_thread is None:
+                    self._flush_thread = threading.Thread(target=self._run, name='points-ledger', daemon=True)
+                    self._flush_thread.start()
+
+    def close(self):
+        """
+        Stop the background thread and reconcile all remaining deductions.
+        """
+        self._stopped.set()
+
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+
+        self.flush()
+
+
+class StreamElementsPointsMiddleware(Middleware):
+    """
+    Middleware which charges costs StreamElements points for a command, see StreamElementsPointsDecorator for the
+    messages and their placeholders.
+
+    With a StreamElementsPointsLedger, the costs are deducted from the cached balance by the check and refunded by
+    the rollback, the check only waits for StreamElements if the balance is not cached yet, and the reply is sent in
+    the background.
+
+    Without a ledger, the check fetches the balance and the points are reduced once the command succeeded, before
+    the command returns. Costs of passed commands are held back from fetched balances until StreamElements confirmed
+    their reduction, and holds are only dropped once no check of the same user is waiting for a balance, which might
+    have been fetched before the reduction was applied. A command can therefore be rejected although the user could
+    afford it, but a balance of this middleware is never spent twice. Commands with different middleware instances
+    do not see each other's holds, share a ledger for them.
     """
 
+    # Without a ledger, the balance check and the deduction of two commands of the same user would interleave
+    execution_key = ExecutionKey.USER
+
     def __init__(
         self,
-        handler: CommandHandler,
         costs: int,
         se_client: StreamElementsClient,
         transaction_succeed_msg: str = 'Hi {user}, for {command} you used {costs} points, {points_new} points left',
-        transaction_failed_msg: str = 'Hi {user}, not enough points ({points} < {costs})'
+        transaction_failed_msg: str = 'Hi {user}, not enough points ({points} < {costs})',
+        ledger: Optional[StreamElementsPointsLedger] = None
     ):
-        super().__init__(handler)
-
         self._costs = costs
         self._se_client = se_client
+        self._ledger = ledger
 
         self._transaction_succeed_msg = transaction_succeed_msg
         self._transaction_failed_msg = transaction_failed_msg
 
+        # Per user the costs held back from fetched balances, the costs whose reduction was confirmed while a check
+        # was waiting for a balance, and the number of such checks
+        self._held: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+        # The reduction is only confirmed by the post-action, a command may not return before that without a ledger
+        self.background = ledger is not None
+
     def _format_message(self, message, user, command, points, points_new):
         return message.format(user=user, command=command, points=points, points_new=points_new, costs=self._costs)
 
-    def _pre_handle(self, user: str, command: str, args: List[str]) -> bool:
-        points = self._se_client.get_points(user)
+    def _release(self, user: str, reduced: bool = False):
+        """
+        Stop holding back the costs of a command, once its points were reduced or it failed without reducing them.
+        """
+        with self._lock:
+            entry = self._held.get(user)
+
+            # Free commands hold nothing, their entry is already gone once no check is waiting
+            if entry is None:
+                return
+
+            # A check which is still waiting might have fetched the balance before the points were reduced
+            if reduced and entry[2]:
+                entry[1] += self._costs
+                return
+
+            entry[0] -= self._costs
+            self._forget(user, entry)
+
+    def _forget(self, user: str, entry: List[int]):
+        if not any(entry):
+            del self._held[user]
+
+    def _check_balance(self, user: str) -> Optional[Tuple[bool, int, int]]:
+        with self._lock:
+            entry = self._held.setdefault(user, [0, 0, 0])
+            entry[2] += 1
+
+        points = None
+
+        try:
+            points = self._se_client.try_get_points(user)
+        finally:
+            with self._lock:
+                entry = self._held[user]
+
+                # Holds count from the time before the balance was fetched until the end of the check, so holds of
+                # reductions which were applied while fetching are still subtracted
+                available = points - entry[0] if points is not None else 0
+                success = points is not None and available >= self._costs
+
+                if success:
+                    entry[0] += self._costs
+
+                entry[2] -= 1
+
+                if not entry[2]:
+                    entry[0] -= entry[1]
+                    entry[1] = 0
 
-        if points < self._costs:
-            self._send_chat_message(self._format_message(self._transaction_failed_msg, user, command, points, points))
+                self._forget(user, entry)
+
+        if points is None:
+            return None
+
+        # Rejected users are told the points they could spend, not the balance including held back costs
+        return success, points if success else available, available - self._costs if success else available
+
+    def check(self, context: CommandContext) -> bool:
+        user = context.user
+
+        if self._ledger is not None:
+            result = self._ledger.try_debit(user, self._costs)
+        else:
+            result = self._check_balance(user)
+
+        if result is None:
+            # Telling the user they have no points would be wrong, StreamElements did not answer
+            logger.warning(f'balance of {user} could not be fetched, rejecting {context.command}')
+            return False
+
+        success, points, points_new = result
+
+        if not success:
+            message = self._format_message(self._transaction_failed_msg, user, context.command, points, points)
+            context.reply(message, MessagePriority.ERROR)
             return False
 
+        context.values[self] = (points, points_new)
         return True
 
-    def _post_handle(self, user: str, command: str, args: List[str]) -> bool:
-        points = self._se_client.get_points(user)
-        points_new = self._se_client.reduce_points(user, self._costs)
+    def rollback(self, context: CommandContext):
+        if self._ledger is not None:
+            self._ledger.refund(context.user, self._costs)
+        else:
+            self._release(context.user)
+
+    def after(self, context: CommandContext) -> bool:
+        points, points_new = context.values[self]
+
+        if self._ledger is None:
+            reduced = None
+
+            try:
+                reduced = self._se_client.try_reduce_points(context.user, self._costs)
+            finally:
+                # If the request failed, it is unknown whether the points were reduced, holding them back forever
+                # would lock the user out instead
+                self._release(context.user, reduced=reduced is not None)
+
+            if reduced is None:
+                logger.warning(f'reducing {self._costs} points of {context.user} for {context.command} failed')
+                return False
 
-        self._send_chat_message(self._format_message(self._transaction_succeed_msg, user, command, points, points_new))
+            points_new = reduced
+
+        message = self._format_message(self._transaction_succeed_msg, context.user, context.command, points, points_new)
+        context.reply(message)
         return True
+
+
+class StreamElementsPointsDecorator(MiddlewarePipeline):
+    """
+    This Decorator can be used to decorate any CommandHandler with the StreamElements points system. Before the
+    decorated handler is executed, it checks if the viewer has enough points to execute the command based on the
+    configured costs.
+
+    If he has not enough points, he receives the transaction_failed_msg. If he has enough points, the decorated
+    handler is executed and as soon as this was successful (means: it returned True) the costs are removed from
+    his account and he receives the transaction_succeed_msg.
+
+    You can use the following placeholders in transaction_failed_msg and transaction_succeed_msg:
+
+    * user: Name of the viewer that wants to execute the command
+    * command: The command the viewer used
+    * costs: Configured costs for the command
+    * points: Amount of StreamElements points before the transaction
+    * points_new: Amount of StreamElements points after the transaction
+
+    Example: Hi {user}, not enough points ({points} < {costs})
+
+    This allows to adjust the messages to your stream configuration (e.g. when the StreamElements points have a custom
+    name for you).
+
+    Without a ledger, a paid command waits for a request to StreamElements before and another one after the
+    decorated handler, and costs are held back until StreamElements confirmed their reduction, see
+    StreamElementsPointsMiddleware. With a StreamElementsPointsLedger, the costs are deducted from a cached balance
+    before the decorated handler is executed and refunded if it fails, so concurrent commands can not spend the same
+    points twice, and StreamElements is updated and the viewer notified in the background. Share one ledger between
+    all decorators, so all commands see the same balances.
+
+    The decorator is a MiddlewarePipeline with a StreamElementsPointsMiddleware. Further middleware, e.g. a check
+    whether the viewer follows the channel, run concurrently with the points check instead of being nested around
+    it, so the command waits for the slowest check only.
+
+    Paid commands of the same viewer are handled one after another.
+    """
+
+    def __init__(
+        self,
+        handler: CommandHandler,
+        costs: int,
+        se_client: StreamElementsClient,
+        transaction_succeed_msg: str = 'Hi {user}, for {command} you used {costs} points, {points_new} points left',
+        transaction_failed_msg: str = 'Hi {user}, not enough points ({points} < {costs})',
+        ledger: Optional[StreamElementsPointsLedger] = None,
+        middleware: Sequence[Middleware] = ()
+    ):
+        points = StreamElementsPointsMiddleware(
+            costs, se_client, transaction_succeed_msg, transaction_failed_msg, ledger
+        )
+
+        super().__init__(handler, (points, *middleware))
@@ -0,0 +1,140 @@
+import re
+from functools import lru_cache
+from string import Formatter
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+# args[0], args[1], ... for single arguments
+_ARG_FIELD = re.compile(r'args\[(\d+)]')
+
+_CONVERSIONS = {'s': 'str', 'r': 'repr', 'a': 'ascii'}
+
+FIELDS = frozenset(('user', 'channel', 'args', 'count'))
+
+
+@lru_cache(maxsize=1024)
+def _compile(template: str) -> Tuple[Callable[[str, str, List[str], int], str], FrozenSet[str]]:
+    """
+    Compile a template into a function of user, channel, args and count. Cached, so reloading a config only compiles
+    the templates which actually changed.
+
+    :return: The function and the placeholders used by the template
+    """
+    # Literals and format specs are passed to the generated code as constants, so the source only ever contains
+    # names chosen here and nothing from the template itself
+    constants: Dict[str, Any] = {}
+    parts: List[str] = []
+    fields = set()
+
+    def constant(value) -> str:
+        name = f'_c{len(constants)}'
+        constants[name] = value
+        return name
+
+    try:
+        parsed = list(Formatter().parse(template))
+    except ValueError as e:
+        raise ValueError(f'invalid template {template!r}: {e}') from None
+
+    for literal, field, spec, conversion in parsed:
+        if literal:
+            parts.append(constant(literal))
+
+        if field is None:
+            continue
+
+        if field in ('user', 'channel'):
+            expression = field
+        elif field == 'args':
+            expression = "' '.join(args)"
+        elif field == 'count':
+            expression = 'count' if spec or conversion else 'str(count)'
+        elif match := _ARG_FIELD.fullmatch(field):
+            index = int(match.group(1))
+            expression = f"(args[{index}] if len(args) > {index} else '')"
+            field = 'args'
+        else:
+            raise ValueError(
+                f'unknown placeholder {{{field}}} in {template!r}, use one of {", ".join(sorted(FIELDS))}'
+            )
+
+        fields.add(field)
+
+        if conversion:
+            if conversion not in _CONVERSIONS:
+                raise ValueError(f'unknown conversion !{conversion} in {template!r}')
+
+            expression = f'{_CONVERSIONS[conversion]}({expression})'
+
+        if spec:
+            if '{' in spec:
+                raise ValueError(f'nested placeholders are not supported in {template!r}')
+
+            # Invalid specs fail here instead of when rendering
+            try:
+                format(0 if field == 'count' and not conversion else '', spec)
+            except ValueError as e:
+                raise ValueError(f'invalid format spec {spec!r} in {template!r}: {e}') from None
+
+            expression = f'format({expression}, {constant(spec)})'
+
+        parts.append(expression)
+
+    if not parts:
+        body = "''"
+    elif len(parts) == 1:
+        body = parts[0]
+    else:
+        body = f"''.join(({', '.join(parts)},))"
+
+    namespace = {
+        '__builtins__': {}, 'str': str, 'repr': repr, 'ascii': ascii, 'format': format, 'len': len, **constants
+    }
+    return eval(f'lambda user, channel, args, count: {body}', namespace), frozenset(fields)
+
+
+class ResponseTemplate:
+    """
+    A chat response with placeholders, which is compiled once into a Python function instead of being parsed by
+    str.format for every reply. Unknown placeholders are rejected when the template is created, not when the first
+    viewer uses the command.
+
+    Placeholders:
+
+    {user}     User who sent the command
+    {channel}  Channel the command was sent in
+    {args}     All arguments, separated by spaces
+    {args[0]}  First argument, empty if there is none
+    {count}    How often the command was used, including this time
+
+    Format specs and conversions work like with str.format, e.g. {count:,} or {user!r}.
+
+    Example:
+
+    template = ResponseTemplate('Hug number {count} goes from {user} to {args[0]}')
+    template.render('vojay', 'vojay', ['chat'], 42)  # 'Hug number 42 goes from vojay to chat'
+    """
+
+    def __init__(self, template: str):
+        self._template = template
+        self._render, self._fields = _compile(template)
+
+    @property
+    def template(self) -> str:
+        return self._template
+
+    @property
+    def fields(self) -> FrozenSet[str]:
+        """
+        Placeholders used by the template, args for single arguments as well.
+        """
+        return self._fields
+
+    def render(self, user: str, channel: Optional[str] = None, args: Optional[List[str]] = None, count: int = 0) -> str:
+        return self._render(user, channel or '', args or (), count)
+
+    def __reduce__(self):
+        # The compiled function can not be pickled, e.g. for a worker process, it is compiled again instead
+        return ResponseTemplate, (self._template,)
+
+    def __repr__(self):
+        return f'ResponseTemplate({self._template!r})'
@@ -0,0 +1,122 @@
+import itertools
+import time
+from enum import IntEnum
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+class Stage(IntEnum):
+    """
+    Stages every chat line passes through, in order.
+    """
+    # Waiting for and receiving the next chunk from the socket, mostly idle time while the chat is quiet
+    RECV = 0
+    # Splitting received data into lines and decoding them
+    FRAME = 1
+    PARSE = 2
+    # Message filters, chat log, history, command lookup and cooldowns
+    ROUTE = 3
+    # A command handler, named by its command
+    HANDLE = 4
+    # Writing a chat message to the socket
+    SEND = 5
+
+
+class Span(NamedTuple):
+    stage: Stage
+    # Command of HANDLE spans, None for the other stages
+    name: Optional[str]
+    # Seconds of time.perf_counter, which is monotonic
+    started_at: float
+    duration: float
+
+
+class StageSummary(NamedTuple):
+    count: int
+    total: float
+    p50: float
+    p99: float
+    max: float
+
+
+class Tracer:
+    """
+    Records how long each Stage takes, so a lagging bot shows where the time goes. Tracing is off until enabled is
+    set, until then every stage only costs checking the flag.
+
+    The latest capacity spans are kept in a ring which is allocated once. Recording a span takes no lock: the slot is
+    taken from an itertools.count, whose next is atomic, and the span is stored with a single list assignment, so
+    spans of different threads never tear each other apart. Readers copy the ring and sort it by start time.
+    """
+
+    def __init__(self, capacity: int = 65_536):
+        if capacity < 1:
+            raise ValueError('capacity must be >= 1')
+
+        self._capacity = capacity
+        self._spans: List[Optional[Tuple[Stage, Optional[str], float, float]]] = [None] * capacity
+        self._sequence = itertools.count()
+
+        self.enabled = False
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def record(self, stage: Stage, started_at: float, ended_at: Optional[float] = None, name: Optional[str] = None):
+        """
+        Record a span which started at started_at, see time.perf_counter. It ends now unless ended_at is given.
+        """
+        ended_at = time.perf_counter() if ended_at is None else ended_at
+        self._spans[next(self._sequence) % self._capacity] = (stage, name, started_at, ended_at - started_at)
+
+    def clear(self):
+        self._spans = [None] * self._capacity
+
+    def spans(self, since: Optional[float] = None) -> List[Span]:
+        """
+        :param since: Only spans which started at or after this time, see time.perf_counter
+        :return: Spans in the ring, the oldest first
+        """
+        spans = [Span(*span) for span in list(self._spans) if span is not None]
+
+        if since is not None:
+            spans = [span for span in spans if span.started_at >= since]
+
+        spans.sort(key=lambda span: span.started_at)
+        return spans
+
+    def summary(self, since: Optional[float] = None) -> Dict[Tuple[Stage, Optional[str]], StageSummary]:
+        """
+        :return: Count and durations per stage, and per command for HANDLE, in the order of the stages
+        """
+        durations: Dict[Tuple[Stage, Optional[str]], List[float]] = {}
+
+        for span in self.spans(since):
+            durations.setdefault((span.stage, span.name), []).append(span.duration)
+
+        summary = {}
+
+        for key in sorted(durations, key=lambda key: (key[0], key[1] or '')):
+            values = sorted(durations[key])
+            count = len(values)
+
+            summary[key] = StageSummary(
+                count, sum(values), values[count // 2], values[min(count - 1, count * 99 // 100)], values[-1]
+            )
+
+        return summary
+
+    def format_summary(self, since: Optional[float] = None) -> str:
+        """
+        :return: The summary as a table, durations in milliseconds
+        """
+        lines = [f'{"stage":<24} {"count":>8} {"total":>10} {"p50":>9} {"p99":>9} {"max":>9}']
+
+        for (stage, name), summary in self.summary(since).items():
+            label = f'{stage.name.lower()} {name}' if name is not None else stage.name.lower()
+            lines.append(
+                f'{label:<24} {summary.count:>8} {summary.total * 1000:>10.1f} {summary.p50 * 1000:>9.3f} '
+                f'{summary.p99 * 1000:>9.3f} {summary.max * 1000:>9.3f}'
+            )
+
+        return '\n'.join(lines)
@@ -1,50 +1,201 @@
 import logging
-import socket
-import ssl
+import os
 import threading
 import time
+import types
 from abc import ABC, abstractmethod
-from concurrent.futures.thread import ThreadPoolExecutor
-from queue import Queue
-from typing import List, Dict
-
-from rich import box
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.markdown import Markdown
-from rich.progress import Progress, BarColumn
-from rich.table import Table
-
-console = Console(color_system='windows', record=True)
-console.print(Markdown('# Vojay Bot'))
-
-# https://youtrack.jetbrains.com/issue/PY-39762
-# noinspection PyArgumentList
-logging.basicConfig(
-    format='%(message)s',
-    datefmt='[%X]',
-    level=logging.INFO,
-    handlers=[RichHandler(console=console)]
+from concurrent.futures import Future
+from contextvars import ContextVar
+from functools import partial
+from typing import Callable, Collection, Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from vojaybot.connection import (
+    DEFAULT_RECONNECT_POLICY, TWITCH_IRC_SERVER, IrcServer, JoinLimiter, ReconnectPolicy, TwitchConnection
+)
+from vojaybot.cooldown import Cooldown, CooldownTracker
+from vojaybot.execution import (
+    DEFAULT_POOL, PROCESS_POOL, ExecutionKey, ExecutionMode, HandlerPool, OverflowPolicy, ProcessHandlerPool, ShedError
 )
+from vojaybot.history import ChatHistory
+from vojaybot.irc import IrcMessage, parse_message
+from vojaybot.log import CHAT_LOGGER
+from vojaybot.metrics import Metrics
+from vojaybot.router import CommandRouter, Route
+from vojaybot.scheduler import RATE_LIMIT_MODERATOR, RATE_LIMIT_NORMAL, MessagePriority, RateLimit, SendScheduler
+from vojaybot.spam import FilterAction, MessageFilter
+from vojaybot.tracing import Stage, Tracer
 
 logger = logging.getLogger(__name__)
+chat_logger = logging.getLogger(CHAT_LOGGER)
+
+# Under overload, commands and replies wait in bounded queues, so memory and latency stay bounded as well
+DEFAULT_MAX_PENDING_COMMANDS = 1000
+DEFAULT_MAX_QUEUED_MESSAGES = 1000
+
+DEFAULT_HISTORY_SIZE = 5000
+
+
+# The message that is currently handled, set for the duration of CommandHandler.handle
+current_message: ContextVar[Optional[IrcMessage]] = ContextVar('current_message', default=None)
+
+
+# inspect.CO_COROUTINE, inspect itself takes a while to import
+_CO_COROUTINE = 0x80
+
+
+def is_coroutine_function(function: Callable) -> bool:
+    """
+    Like inspect.iscoroutinefunction for functions and bound methods, e.g. CommandHandler.handle.
+    """
+    code = getattr(getattr(function, '__func__', function), '__code__', None)
+    return code is not None and bool(code.co_flags & _CO_COROUTINE)
 
-# This queue is used to process messages that should be send back to Twitch
-twitch_send_message_queue = Queue()
+
+def call_handler(handler: 'CommandHandler', user: str, command: str, args: List[str]) -> bool:
+    """
+    Call handle of any CommandHandler from synchronous code. If the handler is implemented with async def handle,
+    the coroutine is run to completion in a new event loop of the calling thread. That thread is blocked until then,
+    so TwitchBot.register_handler rejects ExecutionMode.INLINE for such handlers and for wrappers around them.
+    """
+    result = handler.handle(user, command, args)
+
+    if isinstance(result, types.CoroutineType):
+        # asyncio takes a while to import, so it is only imported once there actually is an async handler
+        import asyncio
+        return asyncio.run(result)
+
+    return result
 
 
 class CommandHandler(ABC):
+    """
+    Base class of all handlers. handle can either be implemented as a regular function or with async def, e.g. to
+    use non-blocking I/O when running the bot with AsyncTwitchBot. Synchronous handlers are offloaded to a thread
+    pool by AsyncTwitchBot, asynchronous handlers are run in their own event loop by TwitchBot.
+    """
+
+    # Set by TwitchBot.register_handler, takes care of sending messages back to Twitch
+    message_processor: Optional[Callable[[str, MessagePriority, Optional[Hashable]], None]] = None
+
+    # Set by TwitchBot.register_handler, recent chat messages of all channels. None in worker processes and if the
+    # bot keeps no history.
+    chat_history: Optional[ChatHistory] = None
+
+    # Handlers with many short replies (e.g. one per user) can opt in to let the bot merge their replies into fewer
+    # messages, if the bot was started with a coalesce window
+    coalesce_replies = False
+
+    # Where the handler runs unless register_handler is told otherwise, see ExecutionMode
+    execution_mode = ExecutionMode.THREAD
+
+    # Commands with the same key are handled in order instead of in parallel, see ExecutionKey
+    execution_key: Optional[ExecutionKey] = None
+
+    # Minimum time between commands of the handler, checked before a command is handed to an executor
+    cooldown: Optional[Cooldown] = None
 
     @abstractmethod
     def handle(self, user: str, command: str, args: List[str]) -> bool:
         pass
 
-    @staticmethod
-    def _send_chat_message(message: str) -> None:
-        twitch_send_message_queue.put(message)
+    def __getstate__(self):
+        # The message processor and the history belong to the bot, handlers sent to a worker process get their own
+        # message processor and no history
+        state = self.__dict__.copy()
+        state.pop('message_processor', None)
+        state.pop('chat_history', None)
+
+        return state
+
+    def _uses_coroutines(self) -> bool:
+        """
+        Whether handling a command runs a coroutine, which call_handler runs in a new event loop of the calling thread.
+        Such handlers can not run inline, they would block the read thread or fail within the loop of AsyncTwitchBot.
+        """
+        return is_coroutine_function(self.handle)
+
+    def resource_key(self, user: str, command: str, args: List[str]) -> Hashable:
+        """
+        The resource a command works on, commands for the same resource are handled in order if the handler is
+        registered with ExecutionKey.RESOURCE. All commands of the handler by default.
+        """
+        return self
+
+    @property
+    def _message(self) -> Optional[IrcMessage]:
+        """
+        The parsed IrcMessage that triggered the current handle call, which gives access to Twitch tags like user-id,
+        badges or emotes. None if handle was not called by TwitchBot.
+        """
+        return current_message.get()
+
+    @property
+    def _channel(self) -> Optional[str]:
+        """
+        The channel the current command was sent in, replies are automatically sent to the same channel.
+        """
+        message = current_message.get()
+        return message.channel if message is not None else None
+
+    def _send_chat_message(
+        self,
+        message: str,
+        priority: MessagePriority = MessagePriority.NORMAL,
+        merge_key: Optional[Hashable] = None
+    ) -> None:
+        """
+        Send a message to the chat.
+
+        :param message: Text of the message
+        :param priority: Messages with a higher priority are sent first
+        :param merge_key: Messages with the same merge_key may be merged into one message, even across handlers.
+                          Defaults to this handler if it opted in with coalesce_replies.
+        """
+        if self.message_processor is None:
+            logger.warning(f'{type(self).__name__} is not registered, dropping message {message}')
+            return
+
+        if merge_key is None and self.coalesce_replies:
+            merge_key = self
+
+        self.message_processor(message, priority, merge_key)
+
+
+class CommandHandlerWrapper(CommandHandler, ABC):
+    """
+    Base of handlers which wrap another handler. Only the wrapper is registered, so everything the bot sets on it is
+    passed on to the wrapped handler.
+    """
+
+    def __init__(self, handler: CommandHandler):
+        self._command_handler = handler
+
+    @property
+    def message_processor(self):
+        return self._command_handler.message_processor
+
+    @message_processor.setter
+    def message_processor(self, message_processor):
+        # The wrapped handler has to send its messages the same way
+        self._command_handler.message_processor = message_processor
+
+    @property
+    def chat_history(self):
+        return self._command_handler.chat_history
 
+    @chat_history.setter
+    def chat_history(self, chat_history):
+        self._command_handler.chat_history = chat_history
 
-class CommandHandlerDecorator(CommandHandler, ABC):
+    def _uses_coroutines(self) -> bool:
+        return super()._uses_coroutines() or self._command_handler._uses_coroutines()
+
+
+class CommandHandlerDecorator(CommandHandlerWrapper, ABC):
+    """
+    Runs _pre_handle, the decorated handler and _post_handle one after another. To combine several checks without
+    adding up their latencies, see vojaybot.middleware.MiddlewarePipeline.
+    """
 
     @abstractmethod
     def _pre_handle(self, user: str, command: str, args: List[str]) -> bool:
@@ -54,8 +205,11 @@ class CommandHandlerDecorator(CommandHandler, ABC):
     def _post_handle(self, user: str, command: str, args: List[str]) -> bool:
         pass
 
-    def __init__(self, handler: CommandHandler):
-        self._command_handler = handler
+    def _on_handle_failed(self, user: str, command: str, args: List[str]):
+        """
+        Called if _pre_handle succeeded but the decorated handler failed, e.g. to roll back what _pre_handle did.
+        """
+        pass
 
     def handle(self, user: str, command: str, args: List[str]) -> bool:
         pre_success = self._pre_handle(user, command, args)
@@ -63,9 +217,14 @@ class CommandHandlerDecorator(CommandHandler, ABC):
         if not pre_success:
             return False
 
-        handler_success = self._command_handler.handle(user, command, args)
+        try:
+            handler_success = call_handler(self._command_handler, user, command, args)
+        except Exception:
+            self._on_handle_failed(user, command, args)
+            raise
 
         if not handler_success:
+            self._on_handle_failed(user, command, args)
             return False
 
         post_success = self._post_handle(user, command, args)
@@ -73,162 +232,839 @@ class CommandHandlerDecorator(CommandHandler, ABC):
         return pre_success and handler_success and post_success
 
 
+Reply = Tuple[str, MessagePriority, Optional[Hashable]]
+
+# Handlers of the ProcessHandlerPool the current worker process belongs to
+_process_handlers: Tuple[CommandHandler, ...] = ()
+
+# JoinLimiter shared by all worker processes of run_worker_processes, set in each of them before the bot is created
+_worker_join_limiter: Optional[JoinLimiter] = None
+
+
+def _init_process_handlers(handlers: Tuple[CommandHandler, ...]):
+    global _process_handlers
+    _process_handlers = handlers
+
+
+def _handle_in_process(index: int, message: IrcMessage, command: str, args: List[str]) -> Tuple[bool, List[Reply]]:
+    """
+    Handle a command in a worker process. The send queue lives in the bot process, so replies are collected and
+    returned together with the result, the bot queues them once the handler returned.
+    """
+    handler = _process_handlers[index]
+    replies: List[Reply] = []
+
+    def collect(text: str, priority: MessagePriority, merge_key: Optional[Hashable]):
+        # The handler is a copy, the bot merges replies by its own instance instead
+        replies.append((text, priority, None if merge_key is handler else merge_key))
+
+    handler.message_processor = collect
+    token = current_message.set(message)
+
+    try:
+        success = call_handler(handler, message.user, command, args)
+    finally:
+        current_message.reset(token)
+
+    return success, replies
+
+
+class _Execution(NamedTuple):
+    # None for inline handlers
+    pool: Optional[HandlerPool]
+    # Index of the handler in its ProcessHandlerPool, None for inline and thread handlers
+    index: Optional[int]
+    # None if commands of the handler may be handled in parallel
+    key: Optional[ExecutionKey]
+
+    def key_of(self, handler: CommandHandler, user: str, command: str, args: List[str]) -> Optional[Hashable]:
+        if self.key is None:
+            return None
+
+        # Keys are tagged with their kind, a user and a resource of the same name must not block each other
+        if self.key is ExecutionKey.USER:
+            return self.key, user
+
+        if self.key is ExecutionKey.COMMAND:
+            return self.key, handler
+
+        return self.key, handler.resource_key(user, command, args)
+
+
 class TwitchBot:
+    """
+    The bot joins one or more channels, channel_name can either be a single channel or a list of channels. Handlers
+    are shared by all channels and replies are sent to the channel the command was sent in.
 
-    @staticmethod
-    def _parse(data):
-        components = data.split()
-        command = components[1]
+    Channels are spread across connection_count IRC connections, each of them with its own read and write thread and
+    its own rate limit. To spread the load across multiple cores, see run_worker_processes.
 
-        if command == 'PRIVMSG':
-            # See: https://tools.ietf.org/html/rfc1459#section-2.3.1
-            user, host = components[0].split('!')[1].split('@')
-            channel = components[2]
-            message = ' '.join(components[3:])[1:]
+    The bot connects to Twitch unless another server is given, e.g. a local server for load tests. rate_limit
+    overrides the rate limit chosen by moderator, which is mostly useful for such servers as well.
 
-            return {'user': user, 'host': host, 'channel': channel, 'message': message}
+    Every handler runs inline, in a thread pool or in a process pool, see register_handler. Handlers run by the
+    default thread pool unless they declare another execution_mode, the pool has command_handling_thread_pool_size
+    threads. Further pools with their own limits are added with add_thread_pool and add_process_pool.
 
-        return None
+    All queues are bounded. At most max_pending_commands commands wait for the default pool, the oldest one is
+    dropped if another one arrives, replace the default pool with add_thread_pool for other limits. At most
+    max_queued_messages replies wait for each connection, the oldest reply with the lowest priority is dropped if
+    another one is queued. Chat messages which are no commands are never queued at all. Shed commands and replies
+    are counted in the metrics.
 
-    def _send(self, message):
-        self._irc.send(bytes(f'{message}\r\n', 'UTF-8'))
+    Commands on cooldown are dropped before they reach a pool, see Cooldown. The cooldown of the bot applies to all
+    commands, e.g. cooldown=Cooldown(user=1) lets every viewer send one command per second at most.
 
-    def _send_chat_message(self, message):
-        self._send(f'PRIVMSG #{self._channel_name} :{message}')
+    The latest history_size chat messages of all channels are kept in a ChatHistory, which handlers can query with
+    chat_history. A history_size of 0 disables it.
 
-    def _handle_ping(self):
-        self._irc.send('PONG :tmi.twitch.tv\r\n'.encode('UTF-8'))
+    Every chat message passes the message_filters before it is logged, recorded or routed, e.g. a DuplicateFilter
+    against copy-paste spam. The strictest FilterAction of all filters applies.
 
-    def _handle_chat(self, raw_message):
-        parsed_message = self._parse(raw_message)
-        logger.info(parsed_message)
+    Every line is traced through its stages by tracer once tracing is enabled, see Tracer and Diagnostics, which also
+    profiles the bot while it is running.
 
-        user = parsed_message['user']
-        chat_message = parsed_message['message']
+    Pass a Metrics instance to collect command counts and latencies, executor backlog, send queue depths and send
+    timings, see Metrics.serve to expose them.
 
-        if chat_message.startswith('!'):
-            # All user input is converted to lower case to simplify handling in command handlers
-            message_components = chat_message.lower().split()
+    Lost connections are reconnected with exponential backoff, replies which are queued in the meantime are sent once
+    the bot is connected again. With reconnect=ReconnectPolicy(standby=True), every connection keeps a second,
+    logged in connection ready, so a RECONNECT sent by Twitch is handled without missing any chat messages. The bot
+    runs until stop is called or Twitch rejects the login.
 
-            command = message_components[0][1:].lower()
-            args = message_components[1:]
+    Creating a bot has no side effects on logging or the terminal. If a rich console is given (see
+    vojaybot.log.create_console), the bot prints its handlers and the connection progress to it, otherwise it only
+    logs.
+    """
 
-            if command in self._handlers:
-                logger.info(f'{user} sent command {command} with args {args}')
+    def _handle_ping(self, connection: TwitchConnection, message: IrcMessage):
+        connection.send(f'PONG :{message.text}')
 
-                handler = self._handlers[command]
-                success = handler.handle(user, command, args)
+    def _route(self, message: IrcMessage) -> Optional[Route]:
+        """
+        Find the handler responsible for a chat message.
 
-                logger.info(f'command {command} {"succeeded" if success else "failed"}')
-            else:
-                logger.info(f'no handler for command {command}')
+        :return: Route with handler, command and args or None if the message is no command with a registered handler
+        """
+        if not self._tracer.enabled:
+            return self._find_route(message)
 
-    def _handle(self, raw_message):
-        if raw_message.startswith('PING :tmi.twitch.tv'):
-            self._handle_ping()
-        else:
-            components = raw_message.split()
-            command = components[1]
+        started_at = time.perf_counter()
 
-            if command == 'PRIVMSG':
-                self._handle_chat(raw_message)
+        try:
+            return self._find_route(message)
+        finally:
+            self._tracer.record(Stage.ROUTE, started_at)
 
-    def __init__(self, bot_username, channel_name, oauth_token, command_handling_thread_pool_size=4):
-        self._bot_username = bot_username
-        self._channel_name = channel_name
-        self._oauth_token = oauth_token
+    def _find_route(self, message: IrcMessage) -> Optional[Route]:
+        action = FilterAction.PASS
+
+        for message_filter in self._message_filters:
+            action = max(action, message_filter.check(message))
+
+        if action:
+            self._filtered[action] += 1
 
-        # Incoming commands are handled by threads in this ThreadPoolExecutor
-        self._executor = ThreadPoolExecutor(command_handling_thread_pool_size)
+            if action is FilterAction.DROP:
+                return None
 
-        self._handlers: Dict[str, CommandHandler] = {}
+        # Messages are logged lazily, they are only turned into text if the chat log is enabled and the record is
+        # not sampled out, and then by the logging thread. Spam waves are kept out of the log, but still reach
+        # handlers and the history.
+        if action < FilterAction.COLLAPSE:
+            chat_logger.info(message)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self._history is not None:
+            self._history.record(message)
 
-        context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
-        self._irc = context.wrap_socket(sock)
+        if (route := self._router.route(message.text)) is None:
+            return None
 
-    def register_handler(self, command: str, handler: CommandHandler, *aliases: str):
-        handler.message_processor = self._send_chat_message
+        # Commands on cooldown are dropped right here, before they are logged or cost a worker anything
+        if (self._cooldown is not None or self._cooldowns) and not self._cooled_down(message, route):
+            return None
 
-        # Commands are registered as lower case strings to make it more easy for users to use them
-        self._handlers[command.lower()] = handler
+        logger.info('%s sent command %s with args %s in %s', message.user, route.command, route.args, message.channel)
+        return route
 
-        for alias in aliases:
-            self._handlers[alias] = handler
+    def _cooled_down(self, message: IrcMessage, route: Route) -> bool:
+        now = time.monotonic()
 
-    def _read(self):
-        while True:
-            data = self._irc.recv(1024)
-            raw_message = data.decode('UTF-8')
+        # The cooldown of the bot is checked first, so flooding with different commands does not start their own
+        # cooldowns
+        for tracker in (self._cooldown, self._cooldowns.get(route.handler)):
+            if tracker is None or tracker.acquire(message.user, message.channel, now):
+                continue
 
-            for line in raw_message.splitlines():
-                logger.debug(line)
+            if (notice := tracker.notice(message.user, message.channel, route.command, now)) is not None:
+                self._put_message(notice, MessagePriority.NORMAL, ('cooldown', tracker.name), message.channel)
+
+            return False
 
+        return True
+
+    def _handle_chat(self, message: IrcMessage, route: Route) -> bool:
+        handler, command, args = route
+
+        # The message is handed down to the handler, so it can access everything Twitch sent along with the
+        # command (e.g. tags like user-id or badges) without parsing it again
+        token = current_message.set(message)
+        started_at = time.perf_counter() if self._tracer.enabled else None
+
+        try:
+            success = call_handler(handler, message.user, command, args)
+        finally:
+            current_message.reset(token)
+
+            if started_at is not None:
+                self._tracer.record(Stage.HANDLE, started_at, name=command)
+
+        logger.info('command %s %s', command, 'succeeded' if success else 'failed')
+        return success
+
+    def _handle_chat_measured(self, message: IrcMessage, route: Route, submitted_at: Optional[float]):
+        started_at = time.perf_counter()
+
+        if submitted_at is not None:
+            self._command_queue_seconds.observe(started_at - submitted_at)
+
+        result = 'error'
+
+        try:
+            result = 'succeeded' if self._handle_chat(message, route) else 'failed'
+        finally:
+            self._command_seconds.labels(route.command).observe(time.perf_counter() - started_at)
+            self._commands.labels(route.command, result).inc()
+
+    def _on_line(self, connection: TwitchConnection, raw_message: str):
+        if self._metrics is not None:
+            self._messages_received.inc()
+
+        started_at = time.perf_counter() if self._tracer.enabled else None
+
+        try:
+            # Every line is parsed exactly once, the resulting message is passed along the whole dispatch path
+            message = parse_message(raw_message)
+        except ValueError:
+            logger.warning(f'ignoring invalid message {raw_message}')
+            return
+
+        if started_at is not None:
+            self._tracer.record(Stage.PARSE, started_at)
+
+        # Filters, history, cooldowns and notices run on the read thread, an exception in any of them must only cost
+        # this line and not stop reading the connection
+        try:
+            if message.command == 'PING':
+                self._handle_ping(connection, message)
+            elif message.command == 'RECONNECT':
+                # Twitch is about to close the connection, e.g. for server maintenance
+                connection.request_reconnect()
+            elif message.command == 'PRIVMSG' and (route := self._route(message)):
+                # Parsing and routing is cheap, so it is done right away by the read thread. Other chat messages
+                # never leave the read thread, commands are handled according to the execution mode of their handler.
+                self._submit(message, route)
+        except Exception:
+            logger.exception(f'ignoring message which could not be dispatched: {raw_message}')
+
+    def _submit(self, message: IrcMessage, route: Route):
+        pool, index, key = execution = self._executions[route.handler]
+
+        if pool is None:
+            # Inline handlers only take microseconds, handing them over to another thread would take longer. An
+            # exception must never take the read thread down.
+            try:
+                if self._metrics is None:
+                    self._handle_chat(message, route)
+                else:
+                    self._handle_chat_measured(message, route, None)
+            except Exception:
+                logger.exception(f'command {route.command} raised an exception')
+
+            return
+
+        submitted_at = time.perf_counter() if self._metrics is not None else None
+
+        if key is not None:
+            key = execution.key_of(route.handler, message.user, route.command, route.args)
+
+        try:
+            if index is not None:
+                # CPU bound handlers run in another process, so they do not hold the GIL of this one
+                future = pool.submit(_handle_in_process, index, message, route.command, route.args, key=key)
+
+                if future is not None:
+                    future.add_done_callback(partial(self._on_handled_in_process, message, route, submitted_at))
+            elif self._metrics is None:
                 # Keep in mind that due to the global interpreter lock (GIL) only one thread at a time can be
-                # executed. This is not multiprocessing, however it is still useful because Python can
-                # switch between the threads whenever one of them is ready to do some work. It hardly depends on
-                # what the commands are actually doing but this way, we at least offer the possibility to
-                # utilize this feature. In the future this might be replaced with actual multiprocessing.
-                self._executor.submit(self._handle, line)
-
-    def _write(self):
-        while True:
-            # Handlers are able to access the message queue instance, whenever they want to send a message to Twitch,
-            # they can simply add it to the queue and this function then takes care of actually sending it.
-            message = twitch_send_message_queue.get()
-            self._send_chat_message(message)
+                # executed. Threads are still useful for handlers which mostly wait for I/O, e.g. HTTP requests.
+                future = pool.submit(self._handle_chat, message, route, key=key)
+            else:
+                future = pool.submit(self._handle_chat_measured, message, route, submitted_at, key=key)
+        except Exception:
+            # E.g. worker processes could not be started, since a handler can not be pickled
+            logger.exception(f'command {route.command} could not be handed over to pool {pool.name}')
+            return
+
+        if future is None:
+            self._on_rejected(pool, message, route.command)
+
+    def _on_rejected(self, pool: HandlerPool, message: IrcMessage, command: str):
+        logger.warning('pool %s is busy, rejecting command %s of %s', pool.name, command, message.user)
+
+        if pool.busy_message is not None:
+            # Busy replies are merged into one message per pool, if the bot has a coalesce window
+            busy_message = pool.busy_message.format(user=message.user)
+            self._put_message(busy_message, MessagePriority.NORMAL, ('busy', pool.name), message.channel)
+
+    def _queue_replies(self, handler: CommandHandler, replies: List[Reply]):
+        """
+        Queue replies collected in a worker process, expects current_message to be set.
+        """
+        for text, priority, merge_key in replies:
+            if merge_key is None and handler.coalesce_replies:
+                merge_key = handler
+
+            self._put_message(text, priority, merge_key)
+
+    def _on_handled_in_process(self, message: IrcMessage, route: Route, submitted_at: Optional[float], future: Future):
+        result = 'error'
+
+        try:
+            success, replies = future.result()
+            result = 'succeeded' if success else 'failed'
+
+            token = current_message.set(message)
+
+            try:
+                self._queue_replies(route.handler, replies)
+            finally:
+                current_message.reset(token)
+        except ShedError:
+            result = 'shed'
+        except Exception:
+            logger.exception(f'command {route.command} raised an exception')
+        finally:
+            if submitted_at is not None:
+                # Includes the time spent waiting for a worker process and sending the command there and back
+                self._command_seconds.labels(route.command).observe(time.perf_counter() - submitted_at)
+                self._commands.labels(route.command, result).inc()
+
+        logger.info('command %s %s', route.command, result)
+
+    def __init__(
+        self,
+        bot_username,
+        channel_name,
+        oauth_token,
+        command_handling_thread_pool_size=4,
+        read_size=4096,
+        moderator=False,
+        message_ttl=30.0,
+        coalesce_window=None,
+        connection_count=1,
+        server: IrcServer = TWITCH_IRC_SERVER,
+        rate_limit: Optional[RateLimit] = None,
+        metrics: Optional[Metrics] = None,
+        console=None,
+        reconnect: ReconnectPolicy = DEFAULT_RECONNECT_POLICY,
+        max_pending_commands: Optional[int] = DEFAULT_MAX_PENDING_COMMANDS,
+        max_queued_messages: Optional[int] = DEFAULT_MAX_QUEUED_MESSAGES,
+        cooldown: Optional[Cooldown] = None,
+        history_size: int = DEFAULT_HISTORY_SIZE,
+        message_filters: Sequence[MessageFilter] = (),
+        tracer: Optional[Tracer] = None
+    ):
+        self._bot_username = bot_username
+        self._oauth_token = oauth_token
+        self._server = server
+        self._reconnect = reconnect
+        self._console = console
+
+        if rate_limit is None:
+            rate_limit = RATE_LIMIT_MODERATOR if moderator else RATE_LIMIT_NORMAL
+
+        channel_names = [channel_name] if isinstance(channel_name, str) else channel_name
+        self._channels = [channel.lower().lstrip('#') for channel in channel_names]
+
+        if not self._channels:
+            raise ValueError('at least one channel is required')
+
+        if connection_count < 1:
+            raise ValueError('connection_count must be >= 1')
+
+        # Commands are handled by threads of the default pool, unless their handler is registered otherwise
+        self._pools: Dict[str, HandlerPool] = {
+            DEFAULT_POOL: HandlerPool(
+                DEFAULT_POOL, command_handling_thread_pool_size, max_pending_commands, OverflowPolicy.DROP_OLDEST
+            )
+        }
+        self._executions: Dict[CommandHandler, _Execution] = {}
+        self._retired_handlers: List[CommandHandler] = []
+
+        # Only handlers with a cooldown have a tracker, the one of the bot applies to all commands
+        self._cooldowns: Dict[CommandHandler, CooldownTracker] = {}
+        self._cooldown = CooldownTracker('all', cooldown) if cooldown is not None else None
+
+        self._history = ChatHistory(history_size) if history_size > 0 else None
+
+        # Tracing is off until it is enabled, e.g. by Diagnostics, then every stage of every line is recorded
+        self._tracer = tracer if tracer is not None else Tracer()
+
+        self._message_filters = tuple(message_filters)
+        self._filtered = dict.fromkeys(FilterAction, 0)
+
+        self._router = CommandRouter()
+
+        self._connections: List[TwitchConnection] = []
+        self._connections_by_channel: Dict[str, TwitchConnection] = {}
+
+        # The JOIN limit applies to the account, so all connections share one limiter, and so do worker processes
+        self._join_limiter = _worker_join_limiter if _worker_join_limiter is not None else JoinLimiter()
+
+        for i in range(min(connection_count, len(self._channels))):
+            # Outgoing messages are rate limited per connection, moderators are allowed to send a lot more messages
+            # than regular users. With a coalesce window, replies of handlers that opted in are merged into fewer
+            # messages.
+            scheduler = SendScheduler(rate_limit, message_ttl, coalesce_window, max_queued_messages)
+
+            channels = self._channels[i::connection_count]
+            connection = TwitchConnection(
+                f'connection-{i}', bot_username, oauth_token, channels, scheduler, self._on_line, read_size, server,
+                metrics, reconnect, self._tracer, self._join_limiter
+            )
+
+            self._connections.append(connection)
+            self._connections_by_channel.update(dict.fromkeys(channels, connection))
+
+        self._metrics = metrics
+
+        if metrics is not None:
+            self._register_metrics(metrics)
+
+    def _register_metrics(self, metrics: Metrics):
+        self._messages_received = metrics.counter(
+            'vojaybot_messages_received_total', 'IRC messages received from Twitch'
+        ).labels()
+        self._commands = metrics.counter(
+            'vojaybot_commands_total', 'Handled commands by result', ('command', 'result')
+        )
+        self._command_seconds = metrics.histogram(
+            'vojaybot_command_duration_seconds', 'Time spent in CommandHandler.handle', ('command',)
+        )
+        self._command_queue_seconds = metrics.histogram(
+            'vojaybot_command_queue_seconds', 'Time commands waited for a free handler thread'
+        ).labels()
+
+        metrics.callback(
+            'vojaybot_executor_backlog', 'Commands waiting for a free worker',
+            lambda: {(name,): pool.pending for name, pool in self._pools.items()}, ('pool',)
+        )
+        metrics.callback(
+            'vojaybot_executor_keys', 'Keys with commands in flight, see ExecutionKey',
+            lambda: {(name,): pool.keys for name, pool in self._pools.items()}, ('pool',)
+        )
+
+        def shed_commands():
+            return {
+                (name, reason): getattr(pool, reason)
+                for name, pool in self._pools.items() for reason in ('rejected', 'dropped', 'expired')
+            }
+
+        def cooldowns():
+            # Trackers are shared by handlers which replaced each other, each of them is counted once
+            trackers = {id(tracker): tracker for tracker in (*self._cooldowns.values(), self._cooldown) if tracker}
+            rejected = {}
+
+            for tracker in trackers.values():
+                rejected[(tracker.name,)] = rejected.get((tracker.name,), 0) + tracker.rejected
+
+            return rejected
+
+        metrics.callback(
+            'vojaybot_commands_cooldown_total', 'Commands which were dropped because they were on cooldown',
+            cooldowns, ('command',), kind='counter'
+        )
+        metrics.callback(
+            'vojaybot_spam_messages_total', 'Chat messages which were tagged, collapsed or dropped by message filters',
+            lambda: {(action.name.lower(),): count for action, count in self._filtered.items() if action}, ('action',),
+            kind='counter'
+        )
+        metrics.callback(
+            'vojaybot_commands_shed_total', 'Commands which were not handled because their pool was overloaded',
+            shed_commands, ('pool', 'reason'), kind='counter'
+        )
+
+        def scheduler_stats(field):
+            return lambda: {
+                (connection.name,): getattr(connection.scheduler.stats(), field) for connection in self._connections
+            }
+
+        metrics.callback(
+            'vojaybot_send_queue_depth', 'Messages waiting to be sent', scheduler_stats('queue_depth'), ('connection',)
+        )
+        metrics.callback(
+            'vojaybot_send_wait_seconds_max', 'Longest time a sent message waited in the queue',
+            scheduler_stats('wait_time_max'), ('connection',)
+        )
+
+        for field in ('sent', 'dropped', 'coalesced', 'overflowed'):
+            metrics.callback(
+                f'vojaybot_messages_{field}_total', f'Chat messages {field} by the send scheduler',
+                scheduler_stats(field), ('connection',), kind='counter'
+            )
+
+    def _put_message(
+        self,
+        message: str,
+        priority: MessagePriority,
+        merge_key: Optional[Hashable],
+        channel: Optional[str] = None
+    ):
+        # Replies are sent to the channel the command was sent in. Messages sent outside of a command, e.g. by a
+        # background thread, go to the first channel.
+        if channel is None and (current := current_message.get()) is not None:
+            channel = current.channel
+
+        if channel not in self._connections_by_channel:
+            channel = self._channels[0]
+
+        self._connections_by_channel[channel].scheduler.put(channel, message, priority, merge_key)
+
+    def add_thread_pool(
+        self,
+        name: str,
+        size: int,
+        max_pending: Optional[int] = None,
+        overflow: OverflowPolicy = OverflowPolicy.REJECT,
+        max_age: Optional[float] = None,
+        busy_message: Optional[str] = None
+    ) -> HandlerPool:
+        """
+        Add a named thread pool, e.g. for all handlers talking to the same service. The default pool can be replaced
+        as long as no handler was registered for it.
+
+        Example:
+
+        bot.add_thread_pool('hue', 2, max_pending=10, busy_message='@{user}, the lights are busy, try again later')
+
+        :param size: Number of threads
+        :param max_pending: Commands waiting for a free thread, unlimited if None
+        :param overflow: Whether further commands are rejected or the oldest waiting command is dropped for them
+        :param max_age: Commands which waited longer than that many seconds are dropped instead of being handled
+        :param busy_message: Reply to rejected commands, may contain a {user} placeholder
+        """
+        return self._add_pool(HandlerPool(name, size, max_pending, overflow, max_age, busy_message))
+
+    def add_process_pool(
+        self,
+        name: str = PROCESS_POOL,
+        size: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        overflow: OverflowPolicy = OverflowPolicy.REJECT,
+        max_age: Optional[float] = None,
+        busy_message: Optional[str] = None
+    ) -> ProcessHandlerPool:
+        """
+        Add a named process pool for CPU bound handlers. The worker processes are started when the first command is
+        handled. See add_thread_pool for the limits.
+
+        :param size: Number of worker processes, defaults to the number of cores
+        """
+        return self._add_pool(ProcessHandlerPool(
+            name, size or os.cpu_count() or 1, max_pending, overflow, max_age, busy_message,
+            initializer=_init_process_handlers
+        ))
+
+    def _add_pool(self, pool: HandlerPool) -> HandlerPool:
+        if (existing := self._pools.get(pool.name)) is not None and (
+                pool.name != DEFAULT_POOL or any(execution.pool is existing for execution in self._executions.values())
+        ):
+            raise ValueError(f'pool {pool.name} already exists')
+
+        self._pools[pool.name] = pool
+        return pool
+
+    def register_handler(
+        self,
+        command: str,
+        handler: CommandHandler,
+        *aliases: str,
+        mode: Optional[ExecutionMode] = None,
+        pool: Optional[str] = None,
+        key: Optional[ExecutionKey] = None,
+        cooldown: Optional[Cooldown] = None
+    ):
+        """
+        Register a handler for a command and its aliases.
+
+        Example:
+
+        bot.add_thread_pool('hue', 2, max_pending=10)
+        bot.register_handler('light', HueLightHandler(...), 'licht', pool='hue', cooldown=Cooldown(user=30))
+        bot.register_handler('mandelbrot', MandelbrotHandler(), mode=ExecutionMode.PROCESS)
+        bot.register_handler('gamble', GambleHandler(), key=ExecutionKey.USER)
+
+        :param mode: Where the handler runs, defaults to the execution_mode of the handler. Handlers which run
+                     coroutines in call_handler, e.g. pipelines with async middleware, can not run inline.
+        :param pool: Name of the pool, defaults to the default thread pool or the process pool. The process pool is
+                     created with default limits if it does not exist yet.
+        :param key: Commands with the same key are handled in order, e.g. all commands of a user. Defaults to the
+                    execution_key of the handler, commands are handled in parallel without key. Inline handlers are
+                    always handled in order.
+        :param cooldown: Minimum time between commands, defaults to the cooldown of the handler
+        """
+        execution = self._execution_of(handler, mode, pool, key)
+
+        if (cooldown := cooldown or handler.cooldown) is not None:
+            self._cooldowns[handler] = CooldownTracker(command, cooldown)
+
+        handler.message_processor = self._put_message
+        handler.chat_history = self._history
+        self._executions[handler] = execution
+        self._router.register(command, handler, *aliases)
+
+    def replace_handlers(
+        self,
+        old: Collection[CommandHandler],
+        new: Iterable[Tuple[str, CommandHandler, Sequence[str]]]
+    ):
+        """
+        Replace registered handlers by new handlers with their commands and aliases at once, e.g. when a config file
+        changed. Can be called while the bot runs, from any thread. Commands are either routed to all old or to all
+        new handlers, commands which were already routed finish with their old handler. New handlers run with their
+        own execution_mode, execution_key and cooldown in the default pools. Commands keep their cooldown state, if
+        their cooldown did not change.
+
+        :param old: Handlers which are removed together with all of their commands and aliases
+        :param new: Tuples of command, handler and aliases
+        """
+        new = list(new)
+        executions = {handler: self._execution_of(handler) for _, handler, _ in new}
+
+        previous = {tracker.name: tracker for handler in old if (tracker := self._cooldowns.get(handler))}
+        trackers = {}
+
+        for command, handler, _ in new:
+            if handler.cooldown is not None:
+                tracker = previous.get(command)
+                trackers[handler] = tracker if tracker is not None and tracker.cooldown == handler.cooldown \
+                    else CooldownTracker(command, handler.cooldown)
+
+        # Nothing is changed until everything is prepared, so invalid handlers leave the bot as it was
+        for handler in executions:
+            handler.message_processor = self._put_message
+            handler.chat_history = self._history
+
+        self._cooldowns.update(trackers)
+        self._executions.update(executions)
+        self._router.replace(old, new)
+
+        # A command routed right before the swap may still look up the execution of its old handler, so executions
+        # are only removed by the next replacement, long after such commands were submitted
+        for handler in self._retired_handlers:
+            self._executions.pop(handler, None)
+            self._cooldowns.pop(handler, None)
+
+        self._retired_handlers = [handler for handler in old if handler not in executions]
+
+    def _execution_of(
+        self,
+        handler: CommandHandler,
+        mode: Optional[ExecutionMode] = None,
+        pool: Optional[str] = None,
+        key: Optional[ExecutionKey] = None
+    ) -> _Execution:
+        mode = ExecutionMode(mode or handler.execution_mode)
+        key = key or handler.execution_key
+
+        if mode is ExecutionMode.INLINE:
+            if not self._can_run_inline(handler):
+                raise ValueError(
+                    f'{type(handler).__name__} runs coroutines, which can not be run inline, use another execution mode'
+                )
+
+            return _Execution(None, None, None)
+
+        pool_name = pool or (PROCESS_POOL if mode is ExecutionMode.PROCESS else DEFAULT_POOL)
+
+        if pool_name not in self._pools and pool_name == PROCESS_POOL:
+            self.add_process_pool()
+
+        if (handler_pool := self._pools.get(pool_name)) is None:
+            raise ValueError(f'pool {pool_name} does not exist, see add_thread_pool and add_process_pool')
+
+        if handler_pool.mode is not mode:
+            raise ValueError(f'pool {pool_name} is no {mode.value} pool')
+
+        index = handler_pool.register(handler) if isinstance(handler_pool, ProcessHandlerPool) else None
+        return _Execution(handler_pool, index, ExecutionKey(key) if key else None)
+
+    def _can_run_inline(self, handler: CommandHandler) -> bool:
+        # asyncio.run would block the read thread until the coroutine is done
+        return not handler._uses_coroutines()
+
+    @property
+    def channels(self) -> List[str]:
+        return self._channels
+
+    @property
+    def connections(self) -> List[TwitchConnection]:
+        return self._connections
+
+    @property
+    def history(self) -> Optional[ChatHistory]:
+        return self._history
+
+    @property
+    def tracer(self) -> Tracer:
+        return self._tracer
+
+    @property
+    def pools(self) -> List[HandlerPool]:
+        return list(self._pools.values())
+
+    @property
+    def scheduler(self) -> SendScheduler:
+        """
+        SendScheduler of the first connection, see connections for the schedulers of all connections.
+        """
+        return self._connections[0].scheduler
+
+    def _print_markdown(self, text: str):
+        if self._console is None:
+            logger.info(text)
+            return
+
+        from rich.markdown import Markdown
+        self._console.print(Markdown(text))
 
     def _connect(self):
+        if self._console is None:
+            for connection in self._connections:
+                connection.connect()
+
+            return
+
+        from rich.progress import BarColumn, Progress
+
         with Progress(
                 'Connecting to Twitch IRC',
                 '|',
                 BarColumn(bar_width=None),
                 '|',
                 auto_refresh=True,
-                console=console
+                console=self._console
         ) as progress:
-            connection_task = progress.add_task('', total=4)
-            self._irc.connect(('irc.chat.twitch.tv', 6697))
-            time.sleep(0.1)
-            progress.update(connection_task, advance=1)
+            connection_task = progress.add_task('', total=len(self._connections))
 
-            self._send(f'PASS {self._oauth_token}')
-            time.sleep(0.1)
-            progress.update(connection_task, advance=1)
+            for connection in self._connections:
+                connection.connect()
+                progress.update(connection_task, advance=1)
 
-            self._send(f'NICK {self._bot_username}')
-            time.sleep(0.1)
-            progress.update(connection_task, advance=1)
+    def _print_handlers(self):
+        if self._console is None:
+            handlers = ', '.join(f'{command} ({type(handler).__name__})' for command, handler in
+                                 self._router.handlers.items())
+            logger.info(f'starting bot for {", ".join(self._channels)} with the handlers {handlers}')
+            return
 
-            self._send(f'JOIN #{self._channel_name}')
-            time.sleep(0.1)
-            progress.update(connection_task, advance=1)
+        from rich import box
+        from rich.table import Table
 
-    def run(self):
-        console.print(Markdown('Starting bot with the following `handlers` registered...'))
-        console.print(Markdown('## Registered Handler'))
+        self._print_markdown(f'Starting bot for `{", ".join(self._channels)}` with the following `handlers` '
+                             f'registered...')
+        self._print_markdown('## Registered Handler')
 
         table = Table(show_header=True, header_style='bold magenta', expand=True, box=box.SIMPLE_HEAVY)
 
         table.add_column('command', style='cyan')
         table.add_column('handler')
+        table.add_column('runs')
 
-        for command, handler in self._handlers.items():
-            table.add_row(command, type(handler).__name__)
+        for command, handler in self._router.handlers.items():
+            pool, _, key = self._executions[handler]
+            runs = f'{pool.mode.value} ({pool.name})' if pool else 'inline'
+            table.add_row(command, type(handler).__name__, f'{runs}, by {key.value}' if key else runs)
 
-        console.print(table)
+        self._console.print(table)
 
+    def run(self):
+        self._print_handlers()
         self._connect()
 
-        console.print(Markdown('Twitch connection successful and bot started! `Have fun`!'))
-        console.print(Markdown('## Log'))
+        self._print_markdown('Twitch connection successful and bot started! `Have fun`!')
+        self._print_markdown('## Log')
+
+        threads = []
+
+        for connection in self._connections:
+            threads.append(threading.Thread(target=connection.read, name=f'{connection.name}-read'))
+            threads.append(threading.Thread(target=connection.write, name=f'{connection.name}-write'))
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self._shutdown_pools()
+
+    def _shutdown_pools(self):
+        # Commands which are still handled finish in the background, replies are not sent anymore
+        for pool in self._pools.values():
+            pool.shutdown(wait=False)
+
+    def stop(self):
+        """
+        Close all connections, run returns once the read and write threads noticed. Can be called from any thread.
+        """
+        for connection in self._connections:
+            connection.close()
+
+
+def _run_worker(bot_factory: Callable[[List[str]], TwitchBot], channels: List[str], join_limiter: JoinLimiter):
+    global _worker_join_limiter
+    _worker_join_limiter = join_limiter
+
+    bot_factory(channels).run()
+
+
+def run_worker_processes(bot_factory: Callable[[List[str]], TwitchBot], channels: List[str], worker_processes: int):
+    """
+    Spread channels across multiple processes, each of them running its own TwitchBot, so the load scales with the
+    number of cores. Handlers are not shared between processes, which is why every worker creates its own bot with
+    the given factory. The factory must be a module level function, so it can be passed to the worker processes.
+    All bots share one JoinLimiter, the JOIN limit of Twitch applies to the account and not to each process.
+
+    Example:
+
+    def create_bot(channels):
+        bot = TwitchBot(bot_username, channels, oauth_token, connection_count=2)
+        bot.register_handler('dice', DiceHandler())
+        return bot
+
+    if __name__ == '__main__':
+        run_worker_processes(create_bot, ['channel_1', 'channel_2', 'channel_3', 'channel_4'], 2)
+
+    :param bot_factory: Function creating a bot for a list of channels
+    :param channels: All channels to join
+    :param worker_processes: Number of processes to spread the channels across
+    """
+    import multiprocessing
+
+    join_limiter = JoinLimiter(shared=True)
+    processes = []
 
-        read_thread = threading.Thread(target=self._read)
-        write_thread = threading.Thread(target=self._write)
+    for i in range(min(worker_processes, len(channels))):
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(bot_factory, channels[i::worker_processes], join_limiter),
+            name=f'vojaybot-worker-{i}'
+        )
 
-        read_thread.start()
-        write_thread.start()
+        process.start()
+        processes.append(process)
 
-        read_thread.join()
-        write_thread.join()
+    for process in processes:
+        process.join()